@@ -1,15 +1,38 @@
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from sse_starlette.sse import EventSourceResponse
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from utils.sales_report import sales_report_schema, sales_report_retrievers
-from utils.models import DataRetriever
+from utils.models import DataRetriever, Page
+from utils.batch import BatchRunner, ReportTarget
+from utils.metrics import registry
+from utils.examples import example_sets, example_store
+from utils.providers import load_tokenizers
+from utils.pdf_converter import stop_pdf_converter
+from utils.page_renderer import DOCX_MIME_TYPE, PDF_MIME_TYPE, page_renderer
+from utils.scheduler import PREGENERATE, PregenerationScheduler
+from utils.jobs import JobWorkerPool, job_store, make_event_id, parse_event_id
+from typing import Callable, Dict, List, Literal, Union
+import os
 import asyncio
 import json 
-from time import sleep
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await load_tokenizers()
+    job_pool.start()
+    if PREGENERATE:
+        pregeneration_scheduler.start()
+    yield
+    await pregeneration_scheduler.stop()
+    await job_pool.stop()
+    await stop_pdf_converter()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -24,6 +47,9 @@ company_name_map = {
     "Energy": "comp2",
 }
 
+# Keeps the latest reports of every department in the report store
+pregeneration_scheduler = PregenerationScheduler(company_name_map, sales_report_retrievers, sales_report_schema)
+
 
 class RetrievalRequest(BaseModel):
     year: int
@@ -31,64 +57,169 @@ class RetrievalRequest(BaseModel):
     company: str
 
 
+class BatchRequest(BaseModel):
+    targets: List[ReportTarget]
+    regenerate: bool = False
+
+
+class ApprovedSection(BaseModel):
+    tag_id: str = Field(..., alias="tagId")
+    text: Union[str, List[str]]
+
+    class Config:
+        populate_by_name = True
+
+
+class RenderRequest(BaseModel):
+    page: Page
+    selected_variations: Dict[str, int] = Field(default_factory=dict, alias="selectedVariations")
+    format: Literal["pdf", "docx"] = "pdf"
+    prefetch: bool = False
+
+    class Config:
+        populate_by_name = True
+
+
+async def generate_report(params: dict, emit: Callable):
+    # Job handler behind /retrieval: populates one report, emitting its progress
+    department = params["department"]
+    data_retriever = DataRetriever(
+        year=params["year"],
+        month=params["month"],
+        company=company_name_map[department],
+        department=department,
+        retrieval_functions=sales_report_retrievers,
+        document_schema=sales_report_schema.model_copy(deep=True),
+        force_regenerate=params["regenerate"],
+    )
+    total_pages = len(data_retriever.document_schema.pages)
+    total_tags = sum(len(page.tags) for page in data_retriever.document_schema.pages)
+    tags_processed = 0
+
+    emit("init", {"total_pages": total_pages})
+
+    page_indices = {id(page): i for i, page in enumerate(data_retriever.document_schema.pages)}
+    page_tags_processed = [0] * total_pages
+
+    async def on_tag_done(page, tag):
+        nonlocal tags_processed
+        page_index = page_indices[id(page)]
+        tags_processed += 1
+        page_tags_processed[page_index] += 1
+        progress = {
+            "page": page_index + 1,
+            "total_pages": total_pages,
+            "tag": page_tags_processed[page_index],
+            "total_tags": len(page.tags),
+            "tagId": tag.id,
+            "overall_progress": tags_processed / total_tags,
+            "variations": tag.variations,
+            "from_snapshot": tag.id in data_retriever.snapshot_hits,
+            "stats": data_retriever.tag_stats[(page.page_number, tag.id)].model_dump(),
+        }
+        emit("progress", progress)
+
+    def on_delta(page, tag, provider, text):
+        delta = {
+            "page": page_indices[id(page)] + 1,
+            "tagId": tag.id,
+            "provider": provider,
+            "text": text,
+        }
+        emit("delta", delta)
+
+    await data_retriever.populate_all(on_tag_done, on_delta)
+    emit("done", await data_retriever.get_document_data())
+
+
+job_pool = JobWorkerPool({"report": generate_report})
+
+
 @app.get("/retrieval")
-async def extraction(year: int, month: int, department: str):
+async def extraction(request: Request, year: int, month: int, department: str, regenerate: bool = False):
+    if department not in company_name_map:
+        raise HTTPException(status_code=400, detail=f"Unknown department: {department}")
+    params = {"year": year, "month": month, "department": department, "regenerate": regenerate}
+
+    # A reconnecting EventSource sends the id of the last event it got, which
+    # names its job, so it resumes that job instead of starting another
+    job_id, after = parse_event_id(request.headers.get("last-event-id"))
+    job = await asyncio.to_thread(job_store.get, job_id) if job_id else None
+    if job is None or job["params"] != params:
+        job_id, _ = await asyncio.to_thread(job_store.submit, "report", params, reuse=not regenerate)
+        after = 0
+    job_pool.start()
+
     async def event_generator():
-        data_retriever = DataRetriever(
-            year=year,
-            month=month,
-            company=company_name_map[department],
-            department=department,
-            retrieval_functions=sales_report_retrievers,
-            document_schema=sales_report_schema,
+        async for seq, event, data in job_pool.subscribe(job_id, after):
+            yield {"id": make_event_id(job_id, seq), "event": event, "data": data}
+
+    return EventSourceResponse(event_generator(), headers={"X-Job-Id": job_id})
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return job
+
+
+@app.post("/batch")
+async def batch_extraction(request: BatchRequest):
+    unknown = sorted({target.department for target in request.targets} - set(company_name_map))
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown departments: {unknown}")
+
+    async def event_generator():
+        events = asyncio.Queue()
+        runner = BatchRunner(
+            request.targets,
+            company_name_map,
+            sales_report_retrievers,
+            sales_report_schema,
+            force_regenerate=request.regenerate,
         )
-        total_pages = len(data_retriever.document_schema.pages)
-        total_tags = sum(len(page.tags) for page in data_retriever.document_schema.pages)
-        tags_processed = 0
 
-        yield {
-            "event": "init",
-            "data": json.dumps({"total_pages": total_pages}),
-        }
-        
-        progress_queue = asyncio.Queue()
-
-        async def process_page(page_index, page):
-            nonlocal tags_processed
-            for tag_index, tag in enumerate(page.tags):
-                await data_retriever.populate_tag(page, tag)
-                tags_processed += 1
-                progress = {
-                    "page": page_index + 1,
-                    "total_pages": total_pages,
-                    "tag": tag_index + 1,
-                    "total_tags": len(page.tags),
-                    "tagId": tag.id,
-                    "overall_progress": tags_processed / total_tags
-                }
-                await progress_queue.put(progress)
-
-        tasks = [asyncio.create_task(process_page(i, page)) for i, page in enumerate(data_retriever.document_schema.pages)]
-        
-        async def progress_reporter():
-            while any(task for task in tasks if not task.done()) or not progress_queue.empty():
-                progress_event = await progress_queue.get()
-                yield {
-                    "event": "progress",
-                    "data": json.dumps(progress_event),
-                }
-
-        async for progress_event in progress_reporter():
-            print(f"Yielding progress: {progress_event}")
-            yield progress_event
-
-        # Wait for all tasks to complete before yielding 'done'
-        await asyncio.gather(*tasks)
-
-        print("Yielding done, with data: ", await data_retriever.get_document_data())
-        yield {
-            "event": "done",
-            "data": json.dumps(await data_retriever.get_document_data()),
-        }
+        async def emit(event, data):
+            await events.put({"event": event, "data": json.dumps(data)})
+
+        task = asyncio.create_task(runner.run(emit))
+        task.add_done_callback(lambda _: events.put_nowait(None))
+
+        while (event := await events.get()) is not None:
+            yield event
+
+        await task
+
+    return EventSourceResponse(event_generator())
+
+
+@app.post("/render")
+async def render_page(request: RenderRequest):
+    if not os.path.exists(page_renderer.get_template_path(request.page.page_number)):
+        raise HTTPException(status_code=404, detail=f"No template for page {request.page.page_number}")
+    try:
+        content = await page_renderer.render(request.page, request.selected_variations, request.format)
+    except Exception as e:
+        print(f"Rendering page {request.page.page_number} failed: {e!r}")
+        raise HTTPException(status_code=502, detail=f"Rendering failed: {e!r}")
+    if request.prefetch:
+        page_renderer.prefetch(request.page, request.selected_variations, request.format)
+    return Response(content, media_type=PDF_MIME_TYPE if request.format == "pdf" else DOCX_MIME_TYPE)
+
+
+@app.post("/examples")
+async def approve_section(section: ApprovedSection):
+    # Approved sections become few-shot examples for later reports of the tag
+    if section.tag_id not in example_sets:
+        raise HTTPException(status_code=404, detail=f"Tag {section.tag_id} does not use examples")
+    section_id, created = await asyncio.to_thread(
+        example_store.add, section.tag_id, example_sets[section.tag_id].to_text(section.text)
+    )
+    return {"id": section_id, "created": created}
+
 
-    return EventSourceResponse(event_generator())
\ No newline at end of file
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,40 @@
+import asyncio
+import hashlib
+from typing import AsyncIterator
+from utils.providers import Provider, providers
+
+
+class FakeProvider(Provider):
+    # Answers derive only from the prompt and input, so runs are repeatable.
+    # Every answer holds "|"-separated bullets whose first line reads like a
+    # "### Title", which keeps every parser in the retrievers exercised.
+    def __init__(self, name: str, latency: float = 0.0, chunks: int = 8):
+        super().__init__(model=f"fake-{name}", max_concurrency=16)
+        self.name = name
+        self.cache_name = f"fake-{name}"
+        self.latency = latency
+        self.chunks = chunks
+
+    def respond(self, prompt: str, input: str) -> str:
+        digest = hashlib.sha256(f"{self.name}\n{prompt}\n{input}".encode()).hexdigest()
+        bullets = [f"### Finding {digest[i:i + 6]}\nSynthetic observation {i // 6} over {len(input)} characters of context" for i in range(0, 24, 6)]
+        return " |\n".join(bullets)
+
+    async def complete(self, prompt: str, input: str) -> str:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.respond(prompt, input)
+
+    async def stream(self, prompt: str, input: str) -> AsyncIterator[str]:
+        response = self.respond(prompt, input)
+        size = -(-len(response) // self.chunks)
+        for i in range(0, len(response), size):
+            if self.latency:
+                await asyncio.sleep(self.latency / self.chunks)
+            yield response[i:i + size]
+
+
+def install_fake_providers(latency: float = 0.0):
+    # Swapped in place: openai_utils iterates this same dict object
+    for name in list(providers):
+        providers[name] = FakeProvider(name, latency)
@@ -0,0 +1,70 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+PERIODS = [(year, month) for year in (2023, 2024) for month in range(1, 13)]
+CATEGORIES = [f"Category {i}" for i in range(10)]
+
+
+def generate_sales_data(rows: int, rng: np.random.Generator) -> pd.DataFrame:
+    # Every period holds the same products, so MoM and YoY lookups always find data
+    products_per_period = max(rows // len(PERIODS), 1)
+    period_index = np.arange(rows) // products_per_period % len(PERIODS)
+    product_index = np.arange(rows) % products_per_period
+    years = np.array([year for year, _ in PERIODS])[period_index]
+    months = np.array([month for _, month in PERIODS])[period_index]
+    quantity = rng.integers(10, 500, rows)
+    revenue = quantity * rng.integers(100, 1000, rows)
+    return pd.DataFrame({
+        "Date": [f"{year}-{month:02d}-01" for year, month in zip(years, months)],
+        "Month": months,
+        "Year": years,
+        "Product Name": [f"Product {i}" for i in product_index],
+        "Category": np.array(CATEGORIES)[product_index % len(CATEGORIES)],
+        "Sales Quantity": quantity,
+        "Sales Revenue ($)": revenue,
+        "Margin ($)": revenue * rng.integers(20, 50, rows) // 100,
+    })
+
+
+def generate_customer_metrics(rows: int, rng: np.random.Generator) -> pd.DataFrame:
+    # The metrics the report reads come first, padded with synthetic ones up to the row count
+    rows = max(rows, 2 * len(PERIODS))
+    metrics = ["Customer Retention Rate (%)", "Customer Acquisition Rate (%)"]
+    metrics += [f"Synthetic Metric {i}" for i in range(rows // len(PERIODS) + 1 - len(metrics))]
+    index = np.arange(rows)
+    return pd.DataFrame({
+        "Metric": np.array(metrics)[index // len(PERIODS)],
+        "Month": np.array([month for _, month in PERIODS])[index % len(PERIODS)],
+        "Year": np.array([year for year, _ in PERIODS])[index % len(PERIODS)],
+        "Value": rng.integers(50, 200, rows),
+    })
+
+
+def generate_campaigns(rows: int, rng: np.random.Generator) -> pd.DataFrame:
+    index = np.arange(rows)
+    return pd.DataFrame({
+        "Month": np.array([month for _, month in PERIODS])[index % len(PERIODS)],
+        "Year": np.array([year for year, _ in PERIODS])[index % len(PERIODS)],
+        "Campaign Title": [f"Campaign {i}" for i in index],
+        "Description": [f"Synthetic campaign {i} offering {d}% off selected products." for i, d in zip(index, rng.integers(5, 40, rows))],
+    })
+
+
+def generate_company(data_dir: str, company: str, rows: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    generate_sales_data(rows, rng).to_csv(os.path.join(data_dir, f"{company}_sales_data.csv"), index=False)
+    generate_customer_metrics(rows, rng).to_csv(os.path.join(data_dir, f"{company}_customer_metrics.csv"), index=False)
+    generate_campaigns(rows, rng).to_csv(os.path.join(data_dir, f"{company}_campaigns.csv"), index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic retriever datasets")
+    parser.add_argument("data_dir")
+    parser.add_argument("--company", default="comp1")
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate_company(args.data_dir, args.company, args.rows, args.seed)
@@ -0,0 +1,267 @@
+"""Retriever micro-benchmarks over synthetic data.
+
+Run from backend/:
+
+    python -m benchmarks.run --sizes 1e2,1e3,1e4,1e5 --output results.json
+    python -m benchmarks.run --sizes 1e2,1e3 --compare results.json
+
+Each size gets its own generated dataset. Every benchmark is timed once cold,
+with the dataset, context bundle and LLM response caches emptied, and then
+--repeat times warm. LLM providers are replaced by deterministic local fakes.
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# The customer tags always read comp1, so the synthetic files take its name
+COMPANY = "comp1"
+YEAR = 2024
+MONTH = 6
+DEPARTMENT = "Energy"
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the report retrievers")
+    parser.add_argument("--sizes", default="1e2,1e3,1e4,1e5", help="comma separated row counts, e.g. 1e2,1e7")
+    parser.add_argument("--repeat", type=int, default=5, help="warm runs per benchmark")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds each fake provider call takes")
+    parser.add_argument("--work-dir", help="keeps generated data between runs; a temporary dir by default")
+    parser.add_argument("--only", help="comma separated benchmark names to run")
+    parser.add_argument("--output", help="where to write the JSON results")
+    parser.add_argument("--compare", help="earlier results to check for regressions")
+    parser.add_argument("--threshold", type=float, default=1.5, help="slowdown ratio counted as a regression")
+    return parser.parse_args()
+
+
+args = parse_args()
+work_dir = args.work_dir or tempfile.mkdtemp(prefix="report-bench-")
+cache_dir = os.path.join(work_dir, "cache")
+
+# Settings are read when utils is imported, so they are pointed at the work dir first
+os.environ["CACHE_DIR"] = cache_dir
+os.environ.pop("LLM_CACHE_PATH", None)
+os.environ.pop("REPORT_STORE_PATH", None)
+for key in ("OPENAI_API_KEY", "ANTHROPIC_API_KEY", "GROQ_API_KEY"):
+    os.environ.setdefault(key, "benchmark")
+
+import pandas as pd  # noqa: E402
+import utils.retrievers as r  # noqa: E402
+from utils.context_bundle import context_bundle_store  # noqa: E402
+from utils.datasets import dataset_cache  # noqa: E402
+from utils.llm_cache import regenerate_scope  # noqa: E402
+from utils.models import DataRetriever  # noqa: E402
+from utils.sales_report import sales_report_retrievers, sales_report_schema  # noqa: E402
+from benchmarks.fakes import install_fake_providers  # noqa: E402
+from benchmarks.generate_data import generate_company  # noqa: E402
+
+BULLETS = ["### Title\nFirst line\nSecond line"] * 4
+
+# name -> zero-argument callable, sync or async
+retriever_benchmarks = {
+    "_filter_sales_df": lambda: r._filter_sales_df(r.load_dataset(COMPANY, "sales_data"), MONTH, YEAR),
+    "_get_previous_month": lambda: r._get_previous_month(MONTH, YEAR),
+    "_get_product_sales_table_text": lambda: r._get_product_sales_table_text(MONTH, YEAR, COMPANY),
+    "_get_product_sales_table": lambda: r._get_product_sales_table(MONTH, YEAR, COMPANY),
+    "_get_sales_revenue": lambda: r._get_sales_revenue(MONTH, YEAR, COMPANY),
+    "_get_gross_margin": lambda: r._get_gross_margin(MONTH, YEAR, COMPANY),
+    "_get_sales_growth_mom": lambda: r._get_sales_growth_mom(MONTH, YEAR, COMPANY),
+    "_get_sales_growth_yoy": lambda: r._get_sales_growth_yoy(MONTH, YEAR, COMPANY),
+    "_get_customer_data": lambda: r._get_customer_data(MONTH, YEAR, "Customer Retention Rate (%)", COMPANY),
+    "_get_campaign_data": lambda: r._get_campaign_data(MONTH, COMPANY),
+    "_get_financial_metrics_text": lambda: r._get_financial_metrics_text(MONTH, YEAR, COMPANY),
+    "_get_context_bundle": lambda: r._get_context_bundle(MONTH, YEAR, COMPANY),
+    "_get_executive_summary": lambda: r._get_executive_summary(MONTH, YEAR, DEPARTMENT, COMPANY),
+    "_get_fin_perf_bullets": lambda: r._get_fin_perf_bullets(MONTH, YEAR, COMPANY),
+    "_get_product_sales_bullets": lambda: r._get_product_sales_bullets(MONTH, YEAR, COMPANY),
+    "_get_category_sales_chart": lambda: r._get_category_sales_chart(MONTH, YEAR, COMPANY),
+    "_get_recommendations_intro": lambda: r._get_recommendations_intro(MONTH, YEAR, DEPARTMENT, COMPANY),
+    "_get_recommendation_bullets": lambda: r._get_recommendation_bullets(MONTH, YEAR, COMPANY),
+    "_get_recommendation_bullet_titles": lambda: r._get_recommendation_bullet_titles(BULLETS),
+    "_get_recommendation_bullet_contents": lambda: r._get_recommendation_bullet_contents(BULLETS),
+}
+
+
+def make_data_retriever() -> DataRetriever:
+    return DataRetriever(
+        year=YEAR,
+        month=MONTH,
+        company=COMPANY,
+        department=DEPARTMENT,
+        retrieval_functions=sales_report_retrievers,
+        document_schema=sales_report_schema.model_copy(deep=True),
+        use_report_store=False,
+    )
+
+
+def make_populate_tag(tag_id: str):
+    async def run():
+        data_retriever = make_data_retriever()
+        for page in data_retriever.document_schema.pages:
+            for tag in page.tags:
+                if tag.id == tag_id:
+                    await data_retriever.populate_tag(page, tag)
+                    if tag.variations == [{"id": 0, "text": "Tag executor failed"}]:
+                        raise RuntimeError(f"populate_tag {tag_id} failed")
+                    return
+    return run
+
+
+def get_benchmarks() -> dict:
+    missing = [
+        name for name, func in vars(r).items()
+        if inspect.isfunction(func) and func.__module__ == r.__name__ and name not in retriever_benchmarks
+    ]
+    if missing:
+        print(f"Retrievers without a benchmark: {', '.join(missing)}")
+
+    benchmarks = {f"retriever:{name}": run for name, run in retriever_benchmarks.items()}
+    tag_ids = {tag.id for page in sales_report_schema.pages for tag in page.tags}
+    for tag_id in sorted(tag_ids):
+        benchmarks[f"populate_tag:{tag_id}"] = make_populate_tag(tag_id)
+    benchmarks["populate_all"] = lambda: make_data_retriever().populate_all()
+
+    if args.only:
+        only = set(args.only.split(","))
+        benchmarks = {name: run for name, run in benchmarks.items() if name in only or name.split(":")[-1] in only}
+    return benchmarks
+
+
+def clear_caches():
+    dataset_cache.clear()
+    with context_bundle_store.lock:
+        context_bundle_store.bundles.clear()
+    shutil.rmtree(context_bundle_store.cache_dir, ignore_errors=True)
+
+
+def time_call(run, regenerate: bool) -> float:
+    # Cold calls bypass the LLM cache reads, so the fakes answer every time
+    start = time.perf_counter()
+    with regenerate_scope(regenerate):
+        result = run()
+        if inspect.isawaitable(result):
+            asyncio.run(result)
+    return time.perf_counter() - start
+
+
+def prepare_data(rows: int) -> str:
+    data_dir = os.path.join(work_dir, "data", str(rows))
+    if not os.path.exists(os.path.join(data_dir, f"{COMPANY}_campaigns.csv")):
+        print(f"Generating {rows} rows into {data_dir}")
+        generate_company(data_dir, COMPANY, rows)
+    return data_dir
+
+
+def run_size(rows: int, benchmarks: dict) -> list:
+    dataset_cache.data_dir = prepare_data(rows)
+    results = []
+    for name, run in benchmarks.items():
+        clear_caches()
+        entry = {"rows": rows, "benchmark": name}
+        try:
+            entry["cold_s"] = time_call(run, regenerate=True)
+            warm = [time_call(run, regenerate=False) for _ in range(args.repeat)]
+        except Exception as e:
+            print(f"{name} at {rows} rows failed: {e!r}")
+            entry["error"] = repr(e)
+            results.append(entry)
+            continue
+        entry["warm_median_s"] = statistics.median(warm)
+        entry["warm_min_s"] = min(warm)
+        print(f"{rows:>10} {name:<50} cold {entry['cold_s'] * 1000:10.2f}ms  warm {entry['warm_median_s'] * 1000:10.2f}ms")
+        results.append(entry)
+    return results
+
+
+def add_scaling(results: list):
+    # Exponent of cold time against rows between consecutive sizes: ~1 is
+    # linear, clearly above 1 is where scaling breaks
+    previous = {}
+    for entry in sorted(results, key=lambda e: e["rows"]):
+        before = previous.get(entry["benchmark"])
+        if before and "cold_s" in entry and "cold_s" in before and before["cold_s"] > 0:
+            entry["scaling"] = round(math.log(entry["cold_s"] / before["cold_s"]) / math.log(entry["rows"] / before["rows"]), 3)
+        previous[entry["benchmark"]] = entry
+
+
+def compare(results: list, baseline_path: str) -> list:
+    with open(baseline_path) as f:
+        baseline = {(e["rows"], e["benchmark"]): e for e in json.load(f)["results"]}
+    regressions = []
+    for entry in results:
+        before = baseline.get((entry["rows"], entry["benchmark"]))
+        if not before:
+            continue
+        for field in ("cold_s", "warm_median_s"):
+            if field in entry and before.get(field) and entry[field] / before[field] > args.threshold:
+                regressions.append({
+                    "rows": entry["rows"],
+                    "benchmark": entry["benchmark"],
+                    "field": field,
+                    "baseline": before[field],
+                    "current": entry[field],
+                    "ratio": round(entry[field] / before[field], 2),
+                })
+    return regressions
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main():
+    install_fake_providers(args.llm_latency)
+    sizes = [int(float(size)) for size in args.sizes.split(",")]
+    benchmarks = get_benchmarks()
+
+    results = []
+    for rows in sizes:
+        results += run_size(rows, benchmarks)
+    add_scaling(results)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": get_commit(),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "llm_latency": args.llm_latency,
+        },
+        "results": results,
+    }
+    if args.compare:
+        report["regressions"] = compare(results, args.compare)
+        for regression in report["regressions"]:
+            print(f"Regression: {regression['benchmark']} at {regression['rows']} rows, {regression['field']} x{regression['ratio']}")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    failed = any("error" in entry for entry in results)
+    if failed or report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
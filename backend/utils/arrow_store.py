@@ -0,0 +1,189 @@
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from decouple import config
+from utils.datasets import DatasetCache, apply_filters, restore_csv_nulls
+from utils.metrics import record_csv_load, record_rows_scanned
+
+ARROW_STORE_DIR = config("ARROW_STORE_DIR", default=os.path.join(config("CACHE_DIR", default=".cache"), "arrow"))
+
+# Position of each row in the source CSV, so rows read back from several
+# partitions come out in file order with the same index as the CSV frame
+ROW_COLUMN = "__row"
+OTHER_PARTITION = "other"
+
+
+def get_partition_key(year: Any, month: Any) -> str:
+    if pd.isna(year) or pd.isna(month) or year != int(year) or month != int(month):
+        return OTHER_PARTITION
+    return f"{int(year)}-{int(month)}"
+
+
+def write_partitions(df: pd.DataFrame, target_dir: str) -> Dict[str, str]:
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.append_column(ROW_COLUMN, pa.array(np.arange(len(df), dtype=np.int64)))
+    # Uncompressed IPC files can be memory-mapped without decoding, so every
+    # worker process reads the same pages from the OS cache
+    feather.write_feather(table.slice(0, 0), os.path.join(target_dir, "schema.arrow"), compression="uncompressed")
+
+    if "Year" in df.columns and "Month" in df.columns:
+        keys = [get_partition_key(year, month) for year, month in zip(df["Year"], df["Month"])]
+    else:
+        keys = [OTHER_PARTITION] * len(df)
+
+    partitions = {}
+    for key, rows in pd.Series(keys).groupby(keys, sort=False).indices.items():
+        file_name = f"{key}.arrow"
+        feather.write_feather(table.take(rows), os.path.join(target_dir, file_name), compression="uncompressed")
+        partitions[key] = file_name
+    return partitions
+
+
+class ArrowDatasetCache(DatasetCache):
+    """Serves datasets from Arrow IPC files ingested from the CSVs.
+
+    Each CSV is split into one memory-mapped file per (year, month), so a
+    query reads only the partitions and columns it asks for. The CSV stays the
+    source of truth: a copy is ingested per CSV fingerprint, and a changed CSV
+    is ingested again on its next read. Full frames still go through the LRU
+    of the CSV backend.
+    """
+
+    def __init__(self, store_dir: str = ARROW_STORE_DIR, **kwargs):
+        super().__init__(**kwargs)
+        self.store_dir = store_dir
+        self.manifests: Dict[str, dict] = {}
+        self.derived_values: Dict[str, Tuple[Tuple[int, int], Dict[str, Any]]] = {}
+        self.ingest_lock = threading.Lock()
+
+    def get_store_path(self, company: str, name: str) -> str:
+        return os.path.join(self.store_dir, f"{company}_{name}")
+
+    def get_manifest(self, company: str, name: str) -> dict:
+        fingerprint = self.fingerprint(company, name)
+        version_dir = os.path.join(self.get_store_path(company, name), "{}-{}".format(*fingerprint))
+        manifest = self.manifests.get(version_dir)
+        if manifest is not None:
+            return manifest
+
+        with self.ingest_lock:
+            manifest_path = os.path.join(version_dir, "manifest.json")
+            if not os.path.exists(manifest_path):
+                self.ingest(company, name, version_dir)
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            manifest["dir"] = version_dir
+            self.manifests[version_dir] = manifest
+        return manifest
+
+    def ingest(self, company: str, name: str, version_dir: str):
+        # Written to a temporary dir and renamed, so other processes either see
+        # a complete version or ingest their own
+        start = time.perf_counter()
+        df = pd.read_csv(self.get_path(company, name))
+        record_csv_load(name, time.perf_counter() - start)
+
+        store_path = self.get_store_path(company, name)
+        tmp_dir = f"{version_dir}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        try:
+            partitions = write_partitions(df, tmp_dir)
+            with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+                json.dump({"columns": df.columns.tolist(), "rows": len(df), "partitions": partitions}, f)
+            os.rename(tmp_dir, version_dir)
+        except OSError:
+            # Another process finished the same version first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.exists(os.path.join(version_dir, "manifest.json")):
+                raise
+        print(f"Ingested {company} {name} into {version_dir} in {time.perf_counter() - start:.2f}s")
+
+        # Older versions go; processes still mapping them keep their pages until they reopen
+        for entry in os.listdir(store_path):
+            path = os.path.join(store_path, entry)
+            if path != version_dir and not entry.endswith(".tmp"):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def read_table(
+        self,
+        company: str,
+        name: str,
+        periods: Optional[List[Tuple[int, int]]] = None,
+        columns: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        manifest = self.get_manifest(company, name)
+        if periods is None:
+            keys = list(manifest["partitions"])
+        else:
+            keys = [f"{year}-{month}" for year, month in dict.fromkeys(periods)]
+        files = [manifest["partitions"][key] for key in keys if key in manifest["partitions"]] or ["schema.arrow"]
+
+        selected = (columns if columns is not None else manifest["columns"]) + [ROW_COLUMN]
+        table = pa.concat_tables([
+            feather.read_table(os.path.join(manifest["dir"], file_name), columns=selected, memory_map=True)
+            for file_name in files
+        ])
+        rows = table.column(ROW_COLUMN).to_numpy()
+        if len(files) > 1:
+            order = np.argsort(rows, kind="stable")
+            table, rows = table.take(order), rows[order]
+        record_rows_scanned(len(rows))
+
+        df = restore_csv_nulls(table.select(selected[:-1]).to_pandas())
+        df.index = pd.RangeIndex(len(rows)) if periods is None else pd.Index(rows)
+        return df
+
+    def read(self, company: str, name: str) -> pd.DataFrame:
+        return self.read_table(company, name)
+
+    def load(
+        self,
+        company: str,
+        name: str,
+        periods: Optional[List[Tuple[int, int]]] = None,
+        columns: Optional[List[str]] = None,
+        filters: Optional[Dict[str, Any]] = None,
+    ) -> pd.DataFrame:
+        if periods is None and columns is None and filters is None:
+            return super().load(company, name)
+        if filters is None:
+            return self.read_table(company, name, periods, columns)
+        read_columns = None if columns is None else list(dict.fromkeys(columns + list(filters)))
+        df = apply_filters(self.read_table(company, name, periods, read_columns), filters)
+        return df if columns is None else df[columns]
+
+    def load_derived(
+        self,
+        company: str,
+        name: str,
+        key: str,
+        builder: Callable[[pd.DataFrame], Any],
+        columns: Optional[List[str]] = None,
+        group_by: Optional[List[str]] = None,
+    ) -> Any:
+        # Built from just the columns the builder reads, without a full frame in the LRU
+        path = self.get_path(company, name)
+        fingerprint = self.fingerprint(company, name)
+        with self.lock:
+            cached = self.derived_values.get(path)
+            if cached is not None and cached[0] == fingerprint and key in cached[1]:
+                return cached[1][key]
+        value = builder(self.read_table(company, name, columns=columns))
+        with self.lock:
+            cached = self.derived_values.get(path)
+            if cached is None or cached[0] != fingerprint:
+                cached = self.derived_values[path] = (fingerprint, {})
+            return cached[1].setdefault(key, value)
+
+    def clear(self):
+        super().clear()
+        with self.lock:
+            self.manifests.clear()
+            self.derived_values.clear()
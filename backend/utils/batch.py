@@ -0,0 +1,153 @@
+import asyncio
+import inspect
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from pydantic import BaseModel
+from decouple import config
+from utils.memo import ReportMemo, memo_scope
+from utils.models import DataRetriever, DocumentSchema
+from utils.report_store import report_store
+
+BATCH_MAX_REPORTS = config("BATCH_MAX_REPORTS", default=4, cast=int)
+BATCH_PROCESS_WORKERS = config("BATCH_PROCESS_WORKERS", default=2, cast=int)
+
+process_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global process_pool
+    if process_pool is None:
+        process_pool = ProcessPoolExecutor(max_workers=BATCH_PROCESS_WORKERS)
+    return process_pool
+
+
+def prepare_company(calls: List[Tuple[Callable, tuple]]) -> Dict[tuple, Any]:
+    # Runs in a pool process: loads the company's datasets once, runs its sync
+    # retrievers under one memo, and returns that memo's results, nested calls
+    # included. Calls that fail here are left to the reports to run and report.
+    memo = ReportMemo()
+    with memo_scope(memo):
+        for func, args in calls:
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"Batch could not prepare {func.__name__}{args}: {e!r}")
+    return memo.results
+
+
+class ReportTarget(BaseModel):
+    department: str
+    year: int
+    month: int
+
+
+class BatchRunner:
+    def __init__(
+        self,
+        targets: List[ReportTarget],
+        company_name_map: Dict[str, str],
+        retrieval_functions: dict,
+        document_schema: DocumentSchema,
+        force_regenerate: bool = False,
+        max_reports: int = BATCH_MAX_REPORTS,
+    ):
+        self.targets = targets
+        self.company_name_map = company_name_map
+        self.retrievers = [
+            DataRetriever(
+                year=target.year,
+                month=target.month,
+                company=company_name_map[target.department],
+                department=target.department,
+                retrieval_functions=retrieval_functions,
+                document_schema=document_schema.model_copy(deep=True),
+                force_regenerate=force_regenerate,
+            )
+            for target in targets
+        ]
+        self.semaphore = asyncio.Semaphore(max_reports)
+        self.total_tags = [
+            sum(len(page.tags) for page in retriever.document_schema.pages) for retriever in self.retrievers
+        ]
+        self.tags_processed = [0] * len(targets)
+
+    def get_sync_calls(self, retriever: DataRetriever) -> List[Tuple[Callable, tuple]]:
+        # The sync data retrievers of the report's tags and of the stages they
+        # depend on, with their arguments resolved, leaving out stored tags
+        entries = retriever.retrieval_functions
+        tag_ids = {tag.id for page in retriever.document_schema.pages for tag in page.tags}
+        wanted, unresolved = set(), [tag_id for tag_id in tag_ids if tag_id in entries]
+        while unresolved:
+            tag_id = unresolved.pop()
+            wanted.add(tag_id)
+            unresolved.extend(dep for dep in entries[tag_id].get("depends_on", []) if dep in entries and dep not in wanted)
+
+        calls = []
+        for tag_id in wanted:
+            func_or_lambda = entries[tag_id]["retriever"]
+            if callable(func_or_lambda) or inspect.iscoroutinefunction(func_or_lambda[0]):
+                continue
+            if tag_id in tag_ids and retriever.use_report_store and not retriever.force_regenerate:
+                if report_store.get(retriever.get_tag_key(tag_id)) is not None:
+                    continue
+            func, args = func_or_lambda
+            calls.append((func, tuple(arg(retriever) if callable(arg) else arg for arg in args)))
+        return calls
+
+    async def prepare(self):
+        calls: Dict[str, Dict[Tuple[Callable, tuple], None]] = {}
+        for retriever in self.retrievers:
+            company_calls = calls.setdefault(retriever.company, {})
+            # Looks up fingerprints and stored tags in SQLite
+            company_calls.update(dict.fromkeys(await asyncio.to_thread(self.get_sync_calls, retriever)))
+
+        loop = asyncio.get_running_loop()
+        pool = get_process_pool()
+        # CPU-bound aggregation runs in the pool, one job per company, so only
+        # the pool processes load the datasets. Their results seed the memo of
+        # every report of the company, and its sync tags then run no queries here.
+        companies = [company for company, company_calls in calls.items() if company_calls]
+        jobs = [loop.run_in_executor(pool, prepare_company, list(calls[company])) for company in companies]
+        for company, results in zip(companies, await asyncio.gather(*jobs, return_exceptions=True)):
+            if isinstance(results, Exception):
+                # Reports build anything that failed here themselves
+                print(f"Batch preparation of {company} failed: {results!r}")
+                continue
+            for retriever in self.retrievers:
+                if retriever.company == company:
+                    retriever.memo.results.update(results)
+
+    async def run_report(self, index: int, emit: Callable):
+        retriever = self.retrievers[index]
+
+        async def on_tag_done(page, tag):
+            self.tags_processed[index] += 1
+            await emit("progress", {
+                "report": index,
+                "tagId": tag.id,
+                "report_progress": self.tags_processed[index] / self.total_tags[index],
+                "overall_progress": sum(self.tags_processed) / sum(self.total_tags),
+                "stats": retriever.tag_stats[(page.page_number, tag.id)].model_dump(),
+            })
+
+        async with self.semaphore:
+            try:
+                await retriever.populate_all(on_tag_done)
+            except Exception as e:
+                print(f"Batch report {index} failed: {e!r}")
+                await emit("report_error", {"report": index, "error": repr(e)})
+                return False
+        await emit("report_done", {"report": index, "data": await retriever.get_document_data()})
+        return True
+
+    async def run(self, emit: Callable):
+        await emit("init", {
+            "reports": [
+                {"report": i, **target.model_dump(), "total_tags": self.total_tags[i]}
+                for i, target in enumerate(self.targets)
+            ],
+            "total_tags": sum(self.total_tags),
+        })
+        await self.prepare()
+        results = await asyncio.gather(*(self.run_report(i, emit) for i in range(len(self.targets))))
+        await emit("done", {"completed": sum(results), "failed": len(results) - sum(results)})
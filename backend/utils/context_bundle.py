@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable
+from pydantic import BaseModel
+from decouple import config
+from utils.datasets import dataset_cache
+from utils.metrics import record_cache
+
+CACHE_DIR = config("CACHE_DIR", default=".cache")
+
+# Bump when the way bundle fields are built changes, so stored bundles are not reused
+BUNDLE_VERSION = 2
+BUNDLE_SOURCES = ("sales_data", "campaigns")
+
+
+class ContextBundle(BaseModel):
+    company: str
+    year: int
+    month: int
+    financial_metrics: str
+    campaigns: str
+    product_sales: str
+
+
+class ContextBundleStore:
+    # Bundles are kept in memory per process and as JSON files under CACHE_DIR,
+    # which every uvicorn worker on the host reads. Keys include the source
+    # files' fingerprints, so changed data never hits a stale bundle.
+    def __init__(self, cache_dir: str = CACHE_DIR, max_entries: int = 128):
+        self.cache_dir = os.path.join(cache_dir, "context_bundles")
+        self.max_entries = max_entries
+        self.bundles: "OrderedDict[str, ContextBundle]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_key(self, company: str, year: int, month: int) -> str:
+        fingerprints = [dataset_cache.fingerprint(company, name) for name in BUNDLE_SOURCES]
+        raw = json.dumps([BUNDLE_VERSION, company, year, month, fingerprints])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def load(self, company: str, year: int, month: int, builder: Callable[[], ContextBundle]) -> ContextBundle:
+        key = self.get_key(company, year, month)
+        with self.lock:
+            if key in self.bundles:
+                self.bundles.move_to_end(key)
+                record_cache("context_bundle", True)
+                return self.bundles[key]
+
+        path = os.path.join(self.cache_dir, f"{key}.json")
+        try:
+            with open(path) as f:
+                bundle = ContextBundle.model_validate_json(f.read())
+            record_cache("context_bundle", True)
+        except (OSError, ValueError):
+            record_cache("context_bundle", False)
+            bundle = builder()
+            self.write(path, bundle)
+
+        with self.lock:
+            self.bundles[key] = bundle
+            while len(self.bundles) > self.max_entries:
+                self.bundles.popitem(last=False)
+        return bundle
+
+    def write(self, path: str, bundle: ContextBundle):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Write-then-rename so other workers never read a partial file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(bundle.model_dump_json())
+        os.replace(tmp_path, path)
+
+
+context_bundle_store = ContextBundleStore()
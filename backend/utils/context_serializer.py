@@ -0,0 +1,135 @@
+import math
+from typing import List, Optional, Sequence
+import pandas as pd
+from decouple import config
+from utils.providers import providers
+
+# Most tokens one data table may take up in a prompt
+PROMPT_TOKEN_BUDGET = config("PROMPT_TOKEN_BUDGET", default=2000, cast=int)
+# Columns left out when the columns they are derived from are in the table
+DERIVED_COLUMNS = {"Date": ("Month", "Year")}
+# Shortest a text value is cut to before rows of a table with measures are summarized
+MIN_TEXT_LENGTH = 40
+
+
+def count_tokens(text: str) -> int:
+    # The same context goes to every provider, so it has to fit the largest count
+    if not providers:
+        return math.ceil(len(text) / 4)
+    return max(provider.count_tokens(text) for provider in providers.values())
+
+
+def get_shared_columns(df: pd.DataFrame) -> List[str]:
+    # Columns with one value on every row, e.g. the Date, Month and Year of a
+    # table filtered to one period
+    if len(df) < 2:
+        return []
+    return [column for column in df.columns if df[column].nunique(dropna=False) == 1]
+
+
+def get_text_columns(df: pd.DataFrame, measures: Sequence[str]) -> List[str]:
+    return [column for column in df.columns if column not in measures and not pd.api.types.is_numeric_dtype(df[column])]
+
+
+def truncate_text(df: pd.DataFrame, columns: Sequence[str], limit: int) -> pd.DataFrame:
+    # Values longer than the limit are cut to it, ending in an ellipsis
+    df = df.copy()
+    for column in columns:
+        df[column] = df[column].map(lambda value: value[:limit - 1] + "…" if isinstance(value, str) and len(value) > limit else value)
+    return df
+
+
+def summarize_tail(
+    df: pd.DataFrame, measures: Sequence[str], group_by: Optional[str] = None
+) -> pd.DataFrame:
+    # Measures are summed, and the first text column says how many rows went into each row
+    text_columns = get_text_columns(df, measures)
+    label_column = next((column for column in text_columns if column != group_by), df.columns[0])
+    groups = [("", df)] if group_by is None else list(df.groupby(group_by, sort=False))
+    rows = []
+    for value, group in groups:
+        row = {column: "" for column in df.columns}
+        row.update(group[list(measures)].sum().to_dict())
+        if group_by is not None:
+            row[group_by] = value
+        row[label_column] = f"Other ({len(group)} rows)"
+        rows.append(row)
+    return pd.DataFrame(rows, columns=df.columns)
+
+
+def serialize_table(
+    df: pd.DataFrame,
+    sort_by: Optional[str] = None,
+    group_by: Optional[str] = None,
+    measures: Sequence[str] = (),
+    budget: int = PROMPT_TOKEN_BUDGET,
+) -> str:
+    """Writes a table as compact CSV for a prompt, within a token budget.
+
+    Columns derived from others are dropped, and columns shared by every row
+    are stated once above the table instead of on each row. Tables over the
+    budget first have their longest text values cut short, down to
+    MIN_TEXT_LENGTH characters when there are measures to summarize the rows
+    with, or as far as needed when there are not. Tables still over it keep
+    their largest rows by sort_by (or their first rows), and the measures of
+    the rest are summed into "Other" rows, one per group_by value. A budget
+    too small for even those gets just the "Other" rows.
+    """
+    derived = [
+        column for column, sources in DERIVED_COLUMNS.items()
+        if column in df.columns and all(source in df.columns for source in sources)
+    ]
+    df = df.drop(columns=derived)
+    shared = get_shared_columns(df)
+    header = ", ".join(f"{column}: {df[column].iloc[0]}" for column in shared) + "\n" if shared else ""
+    df = df.drop(columns=shared)
+    text = header + df.to_csv(index=False)
+    if df.empty or count_tokens(text) <= budget:
+        return text
+
+    # The longest cut that fits, as long as it doesn't go below the shortest
+    columns = [column for column in get_text_columns(df, measures) if column != group_by]
+    longest = max((df[column].map(lambda value: len(value) if isinstance(value, str) else 0).max() for column in columns), default=0)
+    shortest = MIN_TEXT_LENGTH if measures else 1
+    if longest > shortest:
+        def fits_truncated(limit: int) -> bool:
+            return count_tokens(header + truncate_text(df, columns, limit).to_csv(index=False)) <= budget
+
+        if fits_truncated(shortest):
+            low, high = shortest, longest - 1
+            while low < high:
+                middle = (low + high + 1) // 2
+                if fits_truncated(middle):
+                    low = middle
+                else:
+                    high = middle - 1
+            return header + truncate_text(df, columns, low).to_csv(index=False)
+        df = truncate_text(df, columns, shortest)
+
+    if sort_by is not None:
+        df = df.sort_values(sort_by, ascending=False, kind="stable")
+    lines = df.to_csv(index=False).split("\n")[:-1]
+    if len(lines) != len(df) + 1:
+        # Quoted values span lines, so rows are written one at a time
+        lines = lines[:1] + [df.iloc[[i]].to_csv(index=False, header=False) for i in range(len(df))]
+    fixed = count_tokens(header) + count_tokens(lines[0])
+    # Rows are counted one line at a time, so each candidate cut costs a sum
+    row_tokens = [0]
+    for line in lines[1:]:
+        row_tokens.append(row_tokens[-1] + count_tokens(line))
+
+    def get_tail(kept: int) -> pd.DataFrame:
+        return summarize_tail(df.iloc[kept:], measures, group_by)
+
+    def fits(kept: int) -> bool:
+        return fixed + row_tokens[kept] + count_tokens(get_tail(kept).to_csv(index=False, header=False)) <= budget
+
+    # The most rows that still fit beside the summary of the others
+    low, high = 0, len(df) - 1
+    while low < high:
+        middle = (low + high + 1) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle - 1
+    return header + pd.concat([df.iloc[:low], get_tail(low)]).to_csv(index=False)
@@ -0,0 +1,192 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+import numpy as np
+import pandas as pd
+from decouple import config
+from utils.metrics import record_csv_load, record_rows_scanned
+
+DATA_DIR = config("DATA_DIR", default="data")
+DATA_BACKEND = config("DATA_BACKEND", default="csv")
+DATASET_CACHE_BYTES = config("DATASET_CACHE_BYTES", default=512 * 1024 * 1024, cast=int)
+
+
+def freeze_frame(df: pd.DataFrame) -> pd.DataFrame:
+    # Cached frames are shared by every caller, so their numeric columns are
+    # made read-only: writing into one raises instead of changing the cache,
+    # while assigning whole columns on a copy stays local to that copy. Text
+    # columns stay writable, as pandas can't work on read-only object arrays,
+    # and callers must not write into them.
+    columns = {}
+    for column in df.columns:
+        values = df[column].to_numpy(copy=True) if df[column].dtype.kind in "biufcmM" else df[column].array
+        if isinstance(values, np.ndarray):
+            values.flags.writeable = False
+        columns[column] = values
+    return pd.DataFrame(columns, index=df.index, copy=False)
+
+
+class DatasetEntry(NamedTuple):
+    df: pd.DataFrame
+    fingerprint: Tuple[int, int]
+    nbytes: int
+    derived: Dict[str, Any]
+
+
+class DatasetCache:
+    def __init__(self, data_dir: str = DATA_DIR, max_bytes: int = DATASET_CACHE_BYTES):
+        self.data_dir = data_dir
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, DatasetEntry]" = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.RLock()
+
+    def get_path(self, company: str, name: str) -> str:
+        return os.path.join(self.data_dir, f"{company}_{name}.csv")
+
+    def fingerprint(self, company: str, name: str) -> Tuple[int, int]:
+        stat = os.stat(self.get_path(company, name))
+        return stat.st_mtime_ns, stat.st_size
+
+    def read(self, company: str, name: str) -> pd.DataFrame:
+        start = time.perf_counter()
+        df = pd.read_csv(self.get_path(company, name))
+        record_csv_load(name, time.perf_counter() - start)
+        return df
+
+    def load(
+        self,
+        company: str,
+        name: str,
+        periods: Optional[List[Tuple[int, int]]] = None,
+        columns: Optional[List[str]] = None,
+        filters: Optional[Dict[str, Any]] = None,
+    ) -> pd.DataFrame:
+        # periods keeps only rows of those (year, month) pairs and filters only
+        # rows equal to each value, in file order. The frame shares its
+        # read-only data with the cache.
+        df = self.get_entry(company, name).df
+        if periods is not None:
+            period_rows = self.load_derived(company, name, "period_rows", get_period_rows)
+            df = df.iloc[sorted(row for period in periods for row in period_rows.get(period, ()))]
+        df = apply_filters(df, filters)
+        if columns is not None:
+            df = df[columns]
+        return df.copy(deep=False)
+
+    def load_derived(
+        self,
+        company: str,
+        name: str,
+        key: str,
+        builder: Callable[[pd.DataFrame], Any],
+        columns: Optional[List[str]] = None,
+        group_by: Optional[List[str]] = None,
+    ) -> Any:
+        # columns lists what the builder reads, and group_by that it only needs
+        # the other columns summed per distinct group_by values. Backends that
+        # can skip the rest or aggregate at the source use them.
+        # Structures built from a dataset live on its entry, so they are
+        # rebuilt exactly when the file is reloaded and evicted along with it
+        entry = self.get_entry(company, name)
+        with self.lock:
+            if key in entry.derived:
+                return entry.derived[key]
+        record_rows_scanned(len(entry.df))
+        value = builder(entry.df)
+        with self.lock:
+            return entry.derived.setdefault(key, value)
+
+    def get_entry(self, company: str, name: str) -> DatasetEntry:
+        path = self.get_path(company, name)
+        fingerprint = self.fingerprint(company, name)
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry.fingerprint == fingerprint:
+                self.entries.move_to_end(path)
+                return entry
+
+        # Parse outside the lock so different files can load in parallel
+        df = self.read(company, name)
+        entry = DatasetEntry(freeze_frame(df), fingerprint, int(df.memory_usage(deep=True).sum()), {})
+
+        with self.lock:
+            self.discard(path)
+            self.entries[path] = entry
+            self.total_bytes += entry.nbytes
+            # Least recently used files go first, but the one just loaded always stays
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                self.discard(next(iter(self.entries)))
+
+        return entry
+
+    def discard(self, path: str):
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.total_bytes -= entry.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+
+def apply_filters(df: pd.DataFrame, filters: Optional[Dict[str, Any]]) -> pd.DataFrame:
+    for column, value in (filters or {}).items():
+        df = df[df[column] == value]
+    return df
+
+
+def restore_csv_nulls(df: pd.DataFrame) -> pd.DataFrame:
+    # Other sources give None for missing strings, the CSV reader gives NaN
+    for column in df.columns[df.dtypes == object]:
+        df[column] = df[column].fillna(np.nan)
+    return df
+
+
+def get_period_rows(df: pd.DataFrame) -> Dict[Tuple[int, int], List[int]]:
+    if "Year" not in df.columns or "Month" not in df.columns:
+        return {}
+    return {period: rows.tolist() for period, rows in df.groupby(["Year", "Month"], sort=False).indices.items()}
+
+
+def create_dataset_cache() -> DatasetCache:
+    if DATA_BACKEND == "csv":
+        return DatasetCache()
+    if DATA_BACKEND == "arrow":
+        from utils.arrow_store import ArrowDatasetCache
+
+        return ArrowDatasetCache()
+    if DATA_BACKEND == "sql":
+        from utils.sql_backend import SqlDatasetCache
+
+        return SqlDatasetCache()
+    raise ValueError(f"Unknown DATA_BACKEND {DATA_BACKEND!r}, expected csv, arrow or sql")
+
+
+dataset_cache = create_dataset_cache()
+
+
+def load_dataset(
+    company: str,
+    name: str,
+    periods: Optional[List[Tuple[int, int]]] = None,
+    columns: Optional[List[str]] = None,
+    filters: Optional[Dict[str, Any]] = None,
+) -> pd.DataFrame:
+    return dataset_cache.load(company, name, periods, columns, filters)
+
+
+def load_derived(
+    company: str,
+    name: str,
+    key: str,
+    builder: Callable[[pd.DataFrame], Any],
+    columns: Optional[List[str]] = None,
+    group_by: Optional[List[str]] = None,
+) -> Any:
+    return dataset_cache.load_derived(company, name, key, builder, columns, group_by)
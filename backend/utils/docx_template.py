@@ -0,0 +1,320 @@
+import io
+import os
+import re
+import struct
+import threading
+import zipfile
+import zlib
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from xml.sax.saxutils import escape
+
+# Parts of a docx that can hold template tags
+TEMPLATE_PARTS = re.compile(r"word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml")
+
+TEXT_RE = re.compile(r"<w:t(?:\s[^>]*)?>(.*?)</w:t>", re.S)
+TOKEN_RE = re.compile(r"<w:p[\s>]|<w:p/>|</w:p>|<w:t(?:\s[^>]*)?>(.*?)</w:t>", re.S)
+TAG_RE = re.compile(r"\{([^{}]*)\}")
+LOOP_START_RE = re.compile(r"\{#([^{}]+)\}")
+TEXT_NODE_RE = re.compile(r"(?:(?<=>)|^)[^<]*\{[^<]*")
+PRESERVED_TEXT = '<w:t xml:space="preserve">'
+
+
+def format_value(value: Any) -> str:
+    # Matches what docxtemplater prints for JSON values
+    if value is None:
+        return "undefined"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, list):
+        return ",".join(format_value(v) for v in value)
+    return str(value)
+
+
+def render_text(value: Any) -> str:
+    # linebreaks: true, newlines become <w:br/> within the run
+    return f'</w:t><w:br/>{PRESERVED_TEXT}'.join(escape(line) for line in format_value(value).split("\n"))
+
+
+def join_split_tags(xml: str) -> str:
+    # Word splits "{tag}" over several runs whenever formatting, spell checking
+    # or editing history differs inside it. Like docxtemplater, the whole tag
+    # is moved into the run where it starts, within each paragraph.
+    paragraphs: List[List[re.Match]] = []
+    stack: List[int] = []
+    for token in TOKEN_RE.finditer(xml):
+        text = token.group(0)
+        if text.startswith("<w:t"):
+            if stack:
+                paragraphs[stack[-1]].append(token)
+        elif text == "</w:p>":
+            if stack:
+                stack.pop()
+        elif text != "<w:p/>":
+            stack.append(len(paragraphs))
+            paragraphs.append([])
+
+    edits: List[Tuple[int, int, str]] = []
+    for segments in paragraphs:
+        texts = [segment.group(1) for segment in segments]
+        joined = "".join(texts)
+        if "{" not in joined:
+            continue
+        # Which segment each character of the paragraph's text belongs to
+        owners = [i for i, text in enumerate(texts) for _ in text]
+        for tag in TAG_RE.finditer(joined):
+            first = owners[tag.start()]
+            owners[tag.start():tag.end()] = [first] * (tag.end() - tag.start())
+        new_texts = [[] for _ in texts]
+        for char, owner in zip(joined, owners):
+            new_texts[owner].append(char)
+        for i, segment in enumerate(segments):
+            text = "".join(new_texts[i])
+            # Runs holding a tag keep the spaces of the value rendered into them
+            if text != texts[i] or "{" in text:
+                edits.append((segment.start(), segment.end(), f"{PRESERVED_TEXT}{text}</w:t>"))
+
+    if not edits:
+        return xml
+    parts, position = [], 0
+    for start, end, replacement in sorted(edits):
+        parts.append(xml[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(xml[position:])
+    return "".join(parts)
+
+
+def find_element(xml: str, position: int, name: str) -> Optional[Tuple[int, int]]:
+    # Innermost <name> element around position, as (start, end) offsets
+    pattern = re.compile(rf"<{name}[\s>]|<{name}/>|</{name}>")
+    stack = []
+    for token in pattern.finditer(xml):
+        if token.start() > position and not stack:
+            return None
+        text = token.group(0)
+        if text == f"</{name}>":
+            start = stack.pop()
+            if start <= position < token.end():
+                return start, token.end()
+        elif not text.endswith("/>"):
+            stack.append(token.start())
+    return None
+
+
+def get_items(value: Any, data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # Loop sections repeat per list item, render once for other truthy values
+    if isinstance(value, list):
+        return [{**data, **item} if isinstance(item, dict) else data for item in value]
+    if value:
+        return [{**data, **value} if isinstance(value, dict) else data]
+    return []
+
+
+def paragraph_text(xml: str) -> str:
+    return "".join(TEXT_RE.findall(xml))
+
+
+# A compiled part is a list of nodes: literal strings, Value(name) slots and
+# Loop(name, nodes) sections, so rendering only splices strings together
+class Value(NamedTuple):
+    name: str
+
+
+class Loop(NamedTuple):
+    name: str
+    nodes: list
+
+
+def compile_tags(xml: str) -> list:
+    # Tags sit in text nodes, which in these parts are the contents of <w:t>
+    nodes, position = [], 0
+    for node in TEXT_NODE_RE.finditer(xml):
+        for tag in TAG_RE.finditer(xml, node.start(), node.end()):
+            nodes.append(xml[position:tag.start()])
+            nodes.append(Value(tag.group(1).strip()))
+            position = tag.end()
+    nodes.append(xml[position:])
+    return nodes
+
+
+def compile_xml(xml: str) -> list:
+    nodes, position = [], 0
+    while True:
+        start_tag = LOOP_START_RE.search(xml, position)
+        if start_tag is None:
+            nodes.extend(compile_tags(xml[position:]))
+            return merge_literals(nodes)
+        name = start_tag.group(1)
+        end_marker = "{/" + name + "}"
+        end_start = xml.find(end_marker, start_tag.end())
+        if end_start == -1:
+            raise ValueError(f"Unclosed loop tag {start_tag.group(0)}")
+        end_end = end_start + len(end_marker)
+
+        start_paragraph = find_element(xml, start_tag.start(), "w:p")
+        end_paragraph = find_element(xml, end_start, "w:p")
+        start_row = find_element(xml, start_tag.start(), "w:tr")
+        end_row = find_element(xml, end_start, "w:tr")
+        if start_paragraph == end_paragraph:
+            # Inline loop: only the content between the tags repeats
+            region_start, region_end = start_tag.start(), end_end
+            head, body, tail = "", xml[start_tag.end():end_start], ""
+        elif start_row is not None and start_row == end_row:
+            # Loop inside one table row: the row repeats
+            region_start, region_end = start_row
+            head, tail = "", ""
+            body = xml[region_start:start_tag.start()] + xml[start_tag.end():end_start] + xml[end_end:region_end]
+        else:
+            # Paragraph loop: paragraphs holding nothing but a loop tag are dropped
+            region_start, region_end = start_paragraph[0], end_paragraph[1]
+            head = xml[region_start:start_tag.start()]
+            tail = xml[end_end:region_end]
+            body = xml[start_tag.end():end_start]
+            if paragraph_text(xml[start_paragraph[0]:start_paragraph[1]]).strip() == start_tag.group(0):
+                head, body = "", body[body.find("</w:p>") + len("</w:p>"):]
+            if paragraph_text(xml[end_paragraph[0]:end_paragraph[1]]).strip() == end_marker:
+                body, tail = body[:body.rfind("<w:p")], ""
+
+        nodes.extend(compile_tags(xml[position:region_start]))
+        nodes.extend(compile_tags(head))
+        # Loops nested in the body are compiled into it
+        nodes.append(Loop(name, compile_xml(body)))
+        nodes.extend(compile_tags(tail))
+        position = region_end
+
+
+def merge_literals(nodes: list) -> list:
+    merged = []
+    for node in nodes:
+        if isinstance(node, str) and merged and isinstance(merged[-1], str):
+            merged[-1] += node
+        elif node != "":
+            merged.append(node)
+    return merged
+
+
+def render_nodes(nodes: list, data: Dict[str, Any], parts: List[str]):
+    for node in nodes:
+        if isinstance(node, str):
+            parts.append(node)
+        elif isinstance(node, Value):
+            parts.append(render_text(data.get(node.name)))
+        else:
+            for item in get_items(data.get(node.name), data):
+                render_nodes(node.nodes, item, parts)
+
+
+class ZipEntry(NamedTuple):
+    name: bytes
+    flag_bits: int
+    method: int
+    dos_time: int
+    dos_date: int
+    crc: int
+    compressed: bytes
+    size: int
+    external_attr: int
+
+
+def make_entry(info: zipfile.ZipInfo, content: bytes) -> ZipEntry:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    compressed = compressor.compress(content) + compressor.flush()
+    return make_raw_entry(info, zipfile.ZIP_DEFLATED, zlib.crc32(content), compressed, len(content))
+
+
+def make_raw_entry(info: zipfile.ZipInfo, method: int, crc: int, compressed: bytes, size: int) -> ZipEntry:
+    year, month, day, hour, minute, second = info.date_time
+    return ZipEntry(
+        name=info.filename.encode("utf-8"),
+        # Sizes are known up front, so no data descriptors; keep the utf-8 name flag
+        flag_bits=info.flag_bits & 0x800,
+        method=method,
+        dos_time=(hour << 11) | (minute << 5) | (second // 2),
+        dos_date=((year - 1980) << 9) | (month << 5) | day,
+        crc=crc,
+        compressed=compressed,
+        size=size,
+        external_attr=info.external_attr,
+    )
+
+
+def read_raw_entry(template: bytes, info: zipfile.ZipInfo) -> ZipEntry:
+    # The entry's compressed bytes as stored, so it is copied without inflating
+    name_length, extra_length = struct.unpack("<HH", template[info.header_offset + 26:info.header_offset + 30])
+    start = info.header_offset + 30 + name_length + extra_length
+    return make_raw_entry(info, info.compress_type, info.CRC, template[start:start + info.compress_size], info.file_size)
+
+
+def write_zip(entries: List[ZipEntry]) -> bytes:
+    parts, directory, offset = [], [], 0
+    for entry in entries:
+        header = struct.pack(
+            "<IHHHHHIIIHH", 0x04034B50, 20, entry.flag_bits, entry.method, entry.dos_time, entry.dos_date,
+            entry.crc, len(entry.compressed), entry.size, len(entry.name), 0,
+        )
+        directory.append(struct.pack(
+            "<IHHHHHHIIIHHHHHII", 0x02014B50, 20, 20, entry.flag_bits, entry.method, entry.dos_time, entry.dos_date,
+            entry.crc, len(entry.compressed), entry.size, len(entry.name), 0, 0, 0, 0, entry.external_attr, offset,
+        ) + entry.name)
+        parts += [header, entry.name, entry.compressed]
+        offset += len(header) + len(entry.name) + len(entry.compressed)
+    directory_bytes = b"".join(directory)
+    end = struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, len(entries), len(entries), len(directory_bytes), offset, 0)
+    return b"".join(parts) + directory_bytes + end
+
+
+class CompiledTemplate:
+    """A docx template prepared for repeated rendering.
+
+    Entries without tags are kept as their stored compressed bytes and parts
+    with tags as compiled nodes with split tags already joined, so a render
+    splices strings, deflates the rendered parts and writes the zip.
+    """
+
+    def __init__(self, template: bytes):
+        self.entries: List[Tuple[zipfile.ZipInfo, Any]] = []
+        with zipfile.ZipFile(io.BytesIO(template)) as source:
+            for info in source.infolist():
+                content = source.read(info.filename)
+                if TEMPLATE_PARTS.fullmatch(info.filename) and b"{" in content:
+                    nodes = compile_xml(join_split_tags(content.decode("utf-8")))
+                    if any(not isinstance(node, str) for node in nodes):
+                        self.entries.append((info, nodes))
+                        continue
+                self.entries.append((info, read_raw_entry(template, info)))
+
+    def render(self, data: Dict[str, Any]) -> bytes:
+        entries = []
+        for info, entry in self.entries:
+            if isinstance(entry, ZipEntry):
+                entries.append(entry)
+            else:
+                parts = []
+                render_nodes(entry, data, parts)
+                entries.append(make_entry(info, "".join(parts).encode("utf-8")))
+        return write_zip(entries)
+
+
+class TemplateCache:
+    # Compiled templates are reused until the file's mtime or size changes
+    def __init__(self):
+        self.templates: Dict[str, Tuple[Tuple[int, int], CompiledTemplate]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, path: str) -> CompiledTemplate:
+        stat = os.stat(path)
+        fingerprint = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.templates.get(path)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+        with open(path, "rb") as f:
+            compiled = CompiledTemplate(f.read())
+        with self.lock:
+            self.templates[path] = (fingerprint, compiled)
+        return compiled
+
+
+template_cache = TemplateCache()
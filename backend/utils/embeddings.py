@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List
+import numpy as np
+from decouple import config
+from utils.metrics import record_cache
+from utils.providers import providers
+from utils.sqlite_store import SQLiteStore
+
+CACHE_DIR = config("CACHE_DIR", default=".cache")
+EMBEDDING_CACHE_PATH = config("EMBEDDING_CACHE_PATH", default=os.path.join(CACHE_DIR, "embeddings.sqlite3"))
+EMBEDDING_MODEL = config("EMBEDDING_MODEL", default="text-embedding-ada-002")
+EMBEDDING_BATCH_SIZE = config("EMBEDDING_BATCH_SIZE", default=256, cast=int)
+# Embeddings are served by this provider, which needs an embed method
+EMBEDDING_PROVIDER = config("EMBEDDING_PROVIDER", default="gpt")
+
+
+class EmbeddingCache(SQLiteStore):
+    # Vectors keyed by a hash of model and text, so nothing is embedded twice
+    # unless the text changes
+    schema = [
+        """
+        CREATE TABLE IF NOT EXISTS embeddings (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            vector BLOB NOT NULL,
+            created_at REAL NOT NULL
+        )
+        """,
+    ]
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH):
+        super().__init__(path)
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        raw = json.dumps([model, text])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        vectors = {}
+        with self.connection() as conn:
+            # Stays under SQLite's limit on bound parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({', '.join('?' * len(chunk))})", chunk
+                )
+                for key, vector in rows:
+                    vectors[key] = np.frombuffer(vector, dtype=np.float32)
+        return vectors
+
+    def set_many(self, model: str, vectors: Dict[str, np.ndarray]):
+        now = time.time()
+        with self.connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                [(key, model, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in vectors.items()],
+            )
+
+
+embedding_cache = EmbeddingCache()
+
+
+def get_embedder():
+    provider = providers.get(EMBEDDING_PROVIDER)
+    return provider if provider is not None and hasattr(provider, "embed") else None
+
+
+async def embed_texts(texts: List[str], model: str = EMBEDDING_MODEL) -> np.ndarray:
+    # Looks every text up by content hash and embeds only the misses, in batches
+    keys = [embedding_cache.make_key(model, text) for text in texts]
+    vectors = await asyncio.to_thread(embedding_cache.get_many, list(dict.fromkeys(keys)))
+    missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in vectors))
+    for key in keys:
+        record_cache("embeddings", key in vectors)
+
+    if missing:
+        embedder = get_embedder()
+        if embedder is None:
+            raise RuntimeError(f"Embedding provider {EMBEDDING_PROVIDER!r} is not enabled")
+        for i in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+            batch = missing[i:i + EMBEDDING_BATCH_SIZE]
+            embedded = await embedder.embed(batch, model)
+            new_vectors = {
+                embedding_cache.make_key(model, text): np.asarray(vector, dtype=np.float32)
+                for text, vector in zip(batch, embedded)
+            }
+            await asyncio.to_thread(embedding_cache.set_many, model, new_vectors)
+            vectors.update(new_vectors)
+
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.stack([vectors[key] for key in keys])
+
+
+class VectorIndex:
+    # Exact nearest neighbours by cosine similarity over one normalised matrix.
+    # Around a thousand sections take a fraction of a millisecond per query.
+    def __init__(self, ids: List[int], vectors: np.ndarray):
+        self.ids = ids
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True) if len(ids) else 1
+        self.matrix = np.ascontiguousarray(vectors / np.maximum(norms, 1e-12), dtype=np.float32)
+
+    def search(self, vector: np.ndarray, k: int) -> List[int]:
+        if not self.ids or k <= 0:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        scores = self.matrix @ (query / max(float(np.linalg.norm(query)), 1e-12))
+        if k < len(self.ids):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(self.ids))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [self.ids[i] for i in top]
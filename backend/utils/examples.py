@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from string import Template
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+from decouple import config
+from utils.embeddings import VectorIndex, embed_texts, get_embedder
+from utils.sqlite_store import SQLiteStore
+from utils.openai_utils import (
+    exec_summary_examples,
+    financial_performance_examples,
+    product_sales_examples,
+    recommendations_examples,
+    recommendation_bullets_examples,
+)
+
+CACHE_DIR = config("CACHE_DIR", default=".cache")
+EXAMPLES_PATH = config("EXAMPLES_PATH", default=os.path.join(CACHE_DIR, "examples.sqlite3"))
+# Approved sections put into each prompt as few-shot examples
+FEW_SHOT_EXAMPLES = config("FEW_SHOT_EXAMPLES", default=2, cast=int)
+
+
+class ExampleSet(NamedTuple):
+    seeds: List[str]
+    # Between examples in the prompt, and after the last one
+    separator: str
+    suffix: str = ""
+    # Joins sections approved as a list of bullets
+    item_separator: str = "\n"
+
+    def format(self, examples: List[str]) -> str:
+        return self.separator.join(examples) + self.suffix
+
+    def to_text(self, section: Union[str, List[str]]) -> str:
+        return self.item_separator.join(section) if isinstance(section, list) else section
+
+
+# Keyed by the tag whose prompt uses them. With only the seeds approved, the
+# rendered prompts are the ones these examples were taken from.
+example_sets: Dict[str, ExampleSet] = {
+    "executive_summary": ExampleSet(exec_summary_examples, "\n- \n", "\n-"),
+    "fin_perf_bullets": ExampleSet(financial_performance_examples, "\n\n### Example\n", item_separator=" |\n"),
+    "product_sales_bullets": ExampleSet(product_sales_examples, "\n\n### Example\n", item_separator=" |\n"),
+    "recommendations_intro": ExampleSet(recommendations_examples, "\n\nExample:\n\n"),
+    "recommendation_bullets": ExampleSet(recommendation_bullets_examples, "\n\nAnother example:\n\n", item_separator="\n|\n"),
+}
+
+
+def get_content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class ExampleStore(SQLiteStore):
+    schema = [
+        """
+        CREATE TABLE IF NOT EXISTS sections (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tag_id TEXT NOT NULL,
+            text TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            seed INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            UNIQUE (tag_id, content_hash)
+        )
+        """,
+    ]
+
+    def __init__(self, path: str = EXAMPLES_PATH):
+        super().__init__(path)
+
+    def initialize(self):
+        if self.initialized:
+            return
+        super().initialize()
+        # Seeds come from the prompts and follow their edits
+        with self.connection() as conn:
+            for tag_id, example_set in example_sets.items():
+                hashes = [get_content_hash(text) for text in example_set.seeds]
+                conn.execute(
+                    f"DELETE FROM sections WHERE tag_id = ? AND seed = 1 AND content_hash NOT IN ({', '.join('?' * len(hashes))})",
+                    [tag_id, *hashes],
+                )
+                conn.executemany(
+                    "INSERT OR IGNORE INTO sections (tag_id, text, content_hash, seed, created_at) VALUES (?, ?, ?, 1, ?)",
+                    [(tag_id, text, content_hash, time.time()) for text, content_hash in zip(example_set.seeds, hashes)],
+                )
+
+    def add(self, tag_id: str, text: str) -> Tuple[int, bool]:
+        with self.connection() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO sections (tag_id, text, content_hash, seed, created_at) VALUES (?, ?, ?, 0, ?)",
+                (tag_id, text, get_content_hash(text), time.time()),
+            )
+            if cursor.rowcount:
+                return cursor.lastrowid, True
+            (section_id,) = conn.execute(
+                "SELECT id FROM sections WHERE tag_id = ? AND content_hash = ?", (tag_id, get_content_hash(text))
+            ).fetchone()
+        return section_id, False
+
+    def get_sections(self, tag_id: str) -> List[Tuple[int, str]]:
+        with self.connection() as conn:
+            return conn.execute("SELECT id, text FROM sections WHERE tag_id = ? ORDER BY id", (tag_id,)).fetchall()
+
+    def get_version(self, tag_id: Optional[str] = None) -> Tuple[int, int]:
+        # Changes whenever sections are added or removed
+        with self.connection() as conn:
+            if tag_id is None:
+                row = conn.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM sections").fetchone()
+            else:
+                row = conn.execute(
+                    "SELECT COUNT(*), COALESCE(MAX(id), 0) FROM sections WHERE tag_id = ?", (tag_id,)
+                ).fetchone()
+        return tuple(row)
+
+
+example_store = ExampleStore()
+
+
+class ExampleSelector:
+    """Picks the approved sections closest to a tag's context as its examples.
+
+    Sections are embedded in batches through the embedding cache when a tag's
+    index is first built or its sections change, and the context is embedded
+    once per distinct text. The chosen examples keep the order they were
+    approved in. Without an embedding provider, the first sections are used.
+    """
+
+    def __init__(self, store: ExampleStore = example_store, k: int = FEW_SHOT_EXAMPLES):
+        self.store = store
+        self.k = k
+        self.indexes: Dict[str, Tuple[Tuple[int, int], VectorIndex, Dict[int, str]]] = {}
+        self.lock = threading.Lock()
+
+    async def get_index(self, tag_id: str) -> Tuple[VectorIndex, Dict[int, str]]:
+        version = await asyncio.to_thread(self.store.get_version, tag_id)
+        with self.lock:
+            cached = self.indexes.get(tag_id)
+        if cached is not None and cached[0] == version:
+            return cached[1], cached[2]
+        sections = await asyncio.to_thread(self.store.get_sections, tag_id)
+        ids = [section_id for section_id, _ in sections]
+        index = VectorIndex(ids, await embed_texts([text for _, text in sections]))
+        texts = dict(sections)
+        with self.lock:
+            self.indexes[tag_id] = (version, index, texts)
+        return index, texts
+
+    async def select(self, tag_id: str, context: str) -> List[str]:
+        if get_embedder() is not None:
+            try:
+                index, texts = await self.get_index(tag_id)
+                query = (await embed_texts([context]))[0]
+                return [texts[section_id] for section_id in sorted(index.search(query, self.k))]
+            except Exception as e:
+                print(f"Example selection for {tag_id} failed, using the first examples: {e!r}")
+        return [text for _, text in (await asyncio.to_thread(self.store.get_sections, tag_id))[:self.k]]
+
+
+example_selector = ExampleSelector()
+
+
+async def render_prompt(template: str, tag_id: str, context: str) -> str:
+    examples = await example_selector.select(tag_id, context)
+    return Template(template).safe_substitute(examples=example_sets[tag_id].format(examples))
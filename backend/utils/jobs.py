@@ -0,0 +1,341 @@
+import asyncio
+import json
+import os
+import socket
+import time
+import uuid
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
+from decouple import config
+from utils.sqlite_store import SQLiteStore
+
+CACHE_DIR = config("CACHE_DIR", default=".cache")
+JOBS_PATH = config("JOBS_PATH", default=os.path.join(CACHE_DIR, "jobs.sqlite3"))
+# Jobs run at once by each worker process
+JOB_WORKERS = config("JOB_WORKERS", default=4, cast=int)
+# Seconds between checks for queued jobs, and for events written by other processes
+JOB_POLL_INTERVAL = config("JOB_POLL_INTERVAL", default=0.5, cast=float)
+# Events are written in batches, at most this many seconds after they are emitted
+JOB_FLUSH_INTERVAL = config("JOB_FLUSH_INTERVAL", default=0.05, cast=float)
+JOB_HEARTBEAT_INTERVAL = config("JOB_HEARTBEAT_INTERVAL", default=5.0, cast=float)
+# Running jobs without a heartbeat for this long are requeued, their worker is gone
+JOB_STALE_AFTER = config("JOB_STALE_AFTER", default=30.0, cast=float)
+JOB_MAX_ATTEMPTS = config("JOB_MAX_ATTEMPTS", default=3, cast=int)
+JOB_RETENTION = config("JOB_RETENTION", default=24 * 60 * 60, cast=int)
+
+# Events after which a job has nothing more to say
+TERMINAL_EVENTS = ("done", "error")
+
+
+def make_event_id(job_id: str, seq: int) -> str:
+    return f"{job_id}:{seq}"
+
+
+def parse_event_id(event_id: Optional[str]) -> Tuple[Optional[str], int]:
+    job_id, _, seq = (event_id or "").rpartition(":")
+    if not job_id or not seq.isdigit():
+        return None, 0
+    return job_id, int(seq)
+
+
+class JobStore(SQLiteStore):
+    # Jobs and the events they emitted, shared by every worker process on the
+    # host. Events are numbered per job, so subscribers can resume after any of them.
+    schema = [
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            params TEXT NOT NULL,
+            status TEXT NOT NULL,
+            worker TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            heartbeat_at REAL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)",
+        "CREATE INDEX IF NOT EXISTS jobs_params ON jobs (kind, params, status)",
+        """
+        CREATE TABLE IF NOT EXISTS events (
+            job_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            event TEXT NOT NULL,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (job_id, seq)
+        )
+        """,
+    ]
+
+    def __init__(self, path: str = JOBS_PATH):
+        super().__init__(path)
+
+    def submit(self, kind: str, params: dict, reuse: bool = True) -> Tuple[str, bool]:
+        # A queued or running job with the same parameters is shared instead of started again
+        raw = json.dumps(params, sort_keys=True)
+        now = time.time()
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if reuse:
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE kind = ? AND params = ? AND status IN ('queued', 'running') "
+                    "ORDER BY created_at DESC LIMIT 1",
+                    (kind, raw),
+                ).fetchone()
+                if row is not None:
+                    return row[0], False
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (id, kind, params, status, created_at, updated_at) VALUES (?, ?, ?, 'queued', ?, ?)",
+                (job_id, kind, raw, now, now),
+            )
+        return job_id, True
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self.connection() as conn:
+            row = conn.execute(
+                "SELECT kind, params, status, attempts, error, created_at, updated_at FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        kind, params, status, attempts, error, created_at, updated_at = row
+        return {
+            "id": job_id,
+            "kind": kind,
+            "params": json.loads(params),
+            "status": status,
+            "attempts": attempts,
+            "error": error,
+            "created_at": created_at,
+            "updated_at": updated_at,
+        }
+
+    def claim(self, worker: str) -> Optional[Tuple[str, str, dict]]:
+        # One statement, so two workers never take the same job
+        now = time.time()
+        with self.connection() as conn:
+            row = conn.execute(
+                """
+                UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, heartbeat_at = ?, updated_at = ?
+                WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1)
+                RETURNING id, kind, params
+                """,
+                (worker, now, now),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def heartbeat(self, job_id: str, worker: str) -> bool:
+        # False once the job was requeued and belongs to another worker
+        now = time.time()
+        with self.connection() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET heartbeat_at = ?, updated_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (now, now, job_id, worker),
+            )
+        return cursor.rowcount > 0
+
+    def finish(self, job_id: str, worker: str, status: str, error: Optional[str] = None):
+        with self.connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ? AND worker = ?",
+                (status, error, time.time(), job_id, worker),
+            )
+
+    def append_events(self, job_id: str, events: List[Tuple[str, str]]) -> int:
+        now = time.time()
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            (last,) = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM events WHERE job_id = ?", (job_id,)).fetchone()
+            conn.executemany(
+                "INSERT INTO events VALUES (?, ?, ?, ?, ?)",
+                [(job_id, last + i, event, data, now) for i, (event, data) in enumerate(events, start=1)],
+            )
+        return last + len(events)
+
+    def get_events(self, job_id: str, after: int = 0) -> List[Tuple[int, str, str]]:
+        with self.connection() as conn:
+            return conn.execute(
+                "SELECT seq, event, data FROM events WHERE job_id = ? AND seq > ? ORDER BY seq", (job_id, after)
+            ).fetchall()
+
+    def requeue_stale(self, stale_after: float = JOB_STALE_AFTER, max_attempts: int = JOB_MAX_ATTEMPTS) -> List[str]:
+        # Jobs whose worker stopped heartbeating go back to the queue, or fail
+        # for good after max_attempts. Returns the jobs that failed.
+        cutoff = time.time() - stale_after
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            stale = conn.execute(
+                "SELECT id, attempts FROM jobs WHERE status = 'running' AND heartbeat_at < ?", (cutoff,)
+            ).fetchall()
+            failed = [job_id for job_id, attempts in stale if attempts >= max_attempts]
+            conn.executemany(
+                "UPDATE jobs SET status = 'queued', worker = NULL, updated_at = ? WHERE id = ?",
+                [(time.time(), job_id) for job_id, attempts in stale if attempts < max_attempts],
+            )
+            conn.executemany(
+                "UPDATE jobs SET status = 'failed', worker = NULL, error = 'Worker lost', updated_at = ? WHERE id = ?",
+                [(time.time(), job_id) for job_id in failed],
+            )
+        for job_id, attempts in stale:
+            print(f"Job {job_id} lost its worker on attempt {attempts}, {'failed' if job_id in failed else 'requeued'}")
+        return failed
+
+    def purge(self, retention: int = JOB_RETENTION):
+        cutoff = time.time() - retention
+        with self.connection() as conn:
+            conn.execute(
+                "DELETE FROM events WHERE job_id IN (SELECT id FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?)",
+                (cutoff,),
+            )
+            conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (cutoff,))
+
+
+job_store = JobStore()
+
+
+class JobWorkerPool:
+    """Runs queued jobs with the handler registered for their kind.
+
+    A handler is called as handler(params, emit) and reports progress with
+    emit(event, data). Events are buffered and written to the job store in
+    batches, together with the job's heartbeat. Subscribers read them back
+    from the store, so they can attach, drop and resume from any event, in
+    any worker process. Uncaught handler errors end the job with an "error"
+    event. A job whose worker dies is requeued by another worker once its
+    heartbeat is stale, and runs again from the start.
+    """
+
+    def __init__(
+        self,
+        handlers: Dict[str, Callable],
+        store: JobStore = job_store,
+        workers: int = JOB_WORKERS,
+        poll_interval: float = JOB_POLL_INTERVAL,
+    ):
+        self.handlers = handlers
+        self.store = store
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.tasks: List[asyncio.Task] = []
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        # Subscribers in this process, woken as soon as their job writes events
+        self.listeners: Dict[str, Set[asyncio.Event]] = {}
+        self.maintained_at = 0.0
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is loop and self.tasks:
+            return
+        self.loop = loop
+        prefix = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.tasks = [asyncio.create_task(self.run_worker(f"{prefix}:{i}")) for i in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def notify(self, job_id: str):
+        for listener in self.listeners.get(job_id, ()):
+            listener.set()
+
+    async def maintain(self):
+        # Shared by the workers of every process, at most once per heartbeat interval here
+        if time.time() - self.maintained_at < JOB_HEARTBEAT_INTERVAL:
+            return
+        self.maintained_at = time.time()
+        for job_id in await asyncio.to_thread(self.store.requeue_stale):
+            await asyncio.to_thread(self.store.append_events, job_id, [("error", json.dumps({"error": "Worker lost"}))])
+            self.notify(job_id)
+        await asyncio.to_thread(self.store.purge)
+
+    async def run_worker(self, worker: str):
+        while True:
+            try:
+                await self.maintain()
+                claimed = await asyncio.to_thread(self.store.claim, worker)
+            except Exception as e:
+                print(f"Job worker {worker} could not reach the job store: {e!r}")
+                claimed = None
+            if claimed is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            await self.run_job(worker, *claimed)
+
+    async def run_job(self, worker: str, job_id: str, kind: str, params: dict):
+        buffer: List[Tuple[str, str]] = []
+        lost = False
+
+        def emit(event: str, data):
+            buffer.append((event, json.dumps(data)))
+
+        async def flush():
+            if buffer:
+                events = buffer[:]
+                del buffer[:]
+                await asyncio.to_thread(self.store.append_events, job_id, events)
+                self.notify(job_id)
+
+        async def flush_loop():
+            nonlocal lost
+            beat_at = time.monotonic()
+            while True:
+                await asyncio.sleep(JOB_FLUSH_INTERVAL)
+                await flush()
+                if time.monotonic() - beat_at >= JOB_HEARTBEAT_INTERVAL:
+                    beat_at = time.monotonic()
+                    if not await asyncio.to_thread(self.store.heartbeat, job_id, worker):
+                        lost = True
+                        task.cancel()
+                        return
+
+        print(f"Job {job_id} ({kind}) started on {worker}")
+        task = asyncio.create_task(self.handlers[kind](params, emit))
+        flusher = asyncio.create_task(flush_loop())
+        try:
+            await asyncio.wait([task])
+        finally:
+            # On shutdown the job stays running, and is requeued once its heartbeat is stale
+            task.cancel()
+            flusher.cancel()
+        if lost:
+            print(f"Job {job_id} was requeued to another worker, dropped here")
+            return
+
+        error = task.exception() if not task.cancelled() else asyncio.CancelledError()
+        if error is not None:
+            print(f"Job {job_id} failed: {error!r}")
+            emit("error", {"error": repr(error)})
+        await flush()
+        await asyncio.to_thread(
+            self.store.finish, job_id, worker, "failed" if error is not None else "done", repr(error) if error else None
+        )
+        print(f"Job {job_id} ({kind}) finished on {worker}")
+
+    async def subscribe(self, job_id: str, after: int = 0) -> AsyncIterator[Tuple[int, str, str]]:
+        # Yields (seq, event, data) from after the given seq until a terminal event
+        listener = asyncio.Event()
+        self.listeners.setdefault(job_id, set()).add(listener)
+        try:
+            while True:
+                listener.clear()
+                for seq, event, data in await asyncio.to_thread(self.store.get_events, job_id, after):
+                    yield seq, event, data
+                    after = seq
+                    if event in TERMINAL_EVENTS:
+                        return
+                try:
+                    await asyncio.wait_for(listener.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    job = await asyncio.to_thread(self.store.get, job_id)
+                    if job is None:
+                        return
+        finally:
+            self.listeners[job_id].discard(listener)
+            if not self.listeners[job_id]:
+                del self.listeners[job_id]
@@ -0,0 +1,132 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Optional
+from decouple import config
+from utils.sqlite_store import SQLiteStore
+
+CACHE_DIR = config("CACHE_DIR", default=".cache")
+LLM_CACHE_PATH = config("LLM_CACHE_PATH", default=os.path.join(CACHE_DIR, "llm_responses.sqlite3"))
+LLM_CACHE_TTL = config("LLM_CACHE_TTL", default=7 * 24 * 60 * 60, cast=int)
+LLM_CACHE_MAX_BYTES = config("LLM_CACHE_MAX_BYTES", default=64 * 1024 * 1024, cast=int)
+
+# Set per report to skip cache reads; fresh responses still replace the cached ones
+force_regenerate: ContextVar[bool] = ContextVar("force_regenerate", default=False)
+
+
+@contextmanager
+def regenerate_scope(enabled: bool):
+    token = force_regenerate.set(enabled)
+    try:
+        yield
+    finally:
+        force_regenerate.reset(token)
+
+
+class LLMResponseCache(SQLiteStore):
+    schema = [
+        """
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            provider TEXT NOT NULL,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)",
+        "CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)",
+        # Running total of the response sizes, so eviction needs no scan of the table
+        "CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)",
+        "INSERT OR IGNORE INTO cache_size SELECT 0, COALESCE(SUM(size), 0) FROM responses",
+        """
+        CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses
+        BEGIN UPDATE cache_size SET bytes = bytes + NEW.size WHERE id = 0; END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses
+        BEGIN UPDATE cache_size SET bytes = bytes - OLD.size WHERE id = 0; END
+        """,
+    ]
+    # Seconds between last_access updates of a response, so most hits are read-only
+    touch_interval = 60
+
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl: int = LLM_CACHE_TTL, max_bytes: int = LLM_CACHE_MAX_BYTES):
+        super().__init__(path)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def make_key(provider: str, model: str, prompt: str, input: str) -> str:
+        raw = json.dumps([provider, model, prompt, input])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self.connection() as conn:
+            row = conn.execute("SELECT response, created_at, last_access FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            response, created_at, last_access = row
+            if now - created_at > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            if now - last_access > self.touch_interval:
+                conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        return response
+
+    def set(self, key: str, provider: str, model: str, response: str):
+        now = time.time()
+        with self.connection() as conn:
+            # Replaced rows are deleted first, as REPLACE does not fire the delete trigger
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            conn.execute(
+                "INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, provider, model, response, len(response.encode()), now, now),
+            )
+            self.evict(conn, now)
+
+    def evict(self, conn: sqlite3.Connection, now: float):
+        conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        (total_bytes,) = conn.execute("SELECT bytes FROM cache_size WHERE id = 0").fetchone()
+        if total_bytes <= self.max_bytes:
+            return
+        # Drop least recently used responses until the cache fits its budget again
+        excess = total_bytes - self.max_bytes
+        evicted = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC"):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def cached(self, provider: str, model: str, prompt: str, input: str, generate: Callable[[], str]) -> str:
+        key = self.make_key(provider, model, prompt, input)
+        if not force_regenerate.get():
+            response = self.get(key)
+            if response is not None:
+                return response
+        response = generate()
+        self.set(key, provider, model, response)
+        return response
+
+    async def acached(self, provider: str, model: str, prompt: str, input: str, generate: Callable[[], Awaitable[str]]) -> str:
+        key = self.make_key(provider, model, prompt, input)
+        if not force_regenerate.get():
+            response = await asyncio.to_thread(self.get, key)
+            if response is not None:
+                return response
+        response = await generate()
+        await asyncio.to_thread(self.set, key, provider, model, response)
+        return response
+
+
+llm_cache = LLMResponseCache()
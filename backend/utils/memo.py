@@ -0,0 +1,74 @@
+import asyncio
+import functools
+import inspect
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+
+class ReportMemo:
+    def __init__(self):
+        self.results: Dict[tuple, Any] = {}
+        self.lock = threading.Lock()
+
+
+current_memo: ContextVar[Optional[ReportMemo]] = ContextVar("current_memo", default=None)
+
+
+@contextmanager
+def memo_scope(memo: ReportMemo):
+    token = current_memo.set(memo)
+    try:
+        yield memo
+    finally:
+        current_memo.reset(token)
+
+
+def report_memo(func: Callable) -> Callable:
+    # Memoizes func per report, keyed by (func, arguments with defaults applied),
+    # so positional and keyword spellings of the same call share one result.
+    # Outside a memo_scope the function is simply called.
+    signature = inspect.signature(func)
+
+    def make_key(args, kwargs) -> Optional[tuple]:
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = (func.__module__, func.__qualname__, tuple(bound.arguments.items()))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            memo = current_memo.get()
+            key = make_key(args, kwargs) if memo is not None else None
+            if key is None:
+                return await func(*args, **kwargs)
+            # Concurrent callers await the same in-flight task instead of starting their own
+            with memo.lock:
+                future = memo.results.get(key)
+                if future is None:
+                    future = asyncio.ensure_future(func(*args, **kwargs))
+                    memo.results[key] = future
+            return await asyncio.shield(future)
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        memo = current_memo.get()
+        key = make_key(args, kwargs) if memo is not None else None
+        if key is None:
+            return func(*args, **kwargs)
+        with memo.lock:
+            if key in memo.results:
+                return memo.results[key]
+        result = func(*args, **kwargs)
+        with memo.lock:
+            return memo.results.setdefault(key, result)
+
+    return wrapper
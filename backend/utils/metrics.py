@@ -0,0 +1,217 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+from pydantic import BaseModel
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in self.values.items()]
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> (count per bucket, sum, count)
+        self.values: Dict[Tuple[str, ...], list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.setdefault(label_values, [[0] * len(self.buckets), 0.0, 0])
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for key, (bucket_counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    le = f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}")
+                le = 'le="+Inf"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, le)} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+tag_duration = registry.histogram("report_tag_duration_seconds", "Wall time of populating a tag", ("tag",))
+tag_queue_wait = registry.histogram("report_tag_queue_wait_seconds", "Time a tag waited for a concurrency slot", ("tag",))
+tag_errors = registry.counter("report_tag_errors_total", "Tags whose retriever failed", ("tag",))
+tag_csv_loads = registry.counter("report_tag_csv_loads_total", "CSV files parsed while populating a tag", ("tag",))
+tag_rows_scanned = registry.counter("report_tag_rows_scanned_total", "Dataset rows scanned while populating a tag", ("tag",))
+csv_loads = registry.counter("report_csv_loads_total", "CSV files parsed into the dataset cache", ("dataset",))
+csv_load_duration = registry.histogram("report_csv_load_duration_seconds", "Time spent parsing a CSV file", ("dataset",))
+llm_latency = registry.histogram("report_llm_latency_seconds", "Latency of LLM provider calls that missed the cache", ("provider",))
+llm_tokens = registry.counter("report_llm_tokens_total", "Tokens reported by LLM providers", ("provider", "direction"))
+llm_errors = registry.counter("report_llm_errors_total", "LLM provider calls that failed or timed out", ("provider",))
+prompt_tokens = registry.histogram(
+    "report_prompt_tokens", "Tokens in each prompt sent to an LLM provider, counted before the call", ("provider",),
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000),
+)
+cache_requests = registry.counter("report_cache_requests_total", "Cache lookups by cache and result", ("cache", "result"))
+
+
+class TagStats(BaseModel):
+    tag: str
+    wall_s: float = 0.0
+    queue_wait_s: float = 0.0
+    csv_loads: int = 0
+    rows_scanned: int = 0
+    llm_calls: List[dict] = []
+    tokens_in: int = 0
+    tokens_out: int = 0
+    # Prompt size per provider, counted with each provider's tokenizer
+    prompt_tokens: Dict[str, int] = {}
+    cache_hits: int = 0
+    cache_misses: int = 0
+    errors: List[str] = []
+    failed: bool = False
+
+
+# Stats of the tag whose retriever is running. Tasks spawned by the retriever
+# inherit the same object, so their work is counted towards the tag too.
+current_stats: ContextVar[Optional[TagStats]] = ContextVar("current_stats", default=None)
+
+
+@contextmanager
+def stats_scope(stats: TagStats):
+    token = current_stats.set(stats)
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats.wall_s += time.perf_counter() - start
+        current_stats.reset(token)
+
+
+def record_csv_load(dataset: str, seconds: float):
+    csv_loads.inc(dataset)
+    csv_load_duration.observe(seconds, dataset)
+    stats = current_stats.get()
+    if stats is not None:
+        stats.csv_loads += 1
+
+
+def record_rows_scanned(rows: int):
+    stats = current_stats.get()
+    if stats is not None:
+        stats.rows_scanned += rows
+
+
+def record_cache(cache: str, hit: bool):
+    cache_requests.inc(cache, "hit" if hit else "miss")
+    stats = current_stats.get()
+    if stats is not None:
+        if hit:
+            stats.cache_hits += 1
+        else:
+            stats.cache_misses += 1
+
+
+def record_llm_call(provider: str, seconds: float, cached: bool, error: Optional[str] = None):
+    if error is not None:
+        llm_errors.inc(provider)
+    elif not cached:
+        llm_latency.observe(seconds, provider)
+    stats = current_stats.get()
+    if stats is not None:
+        call = {"provider": provider, "latency_s": round(seconds, 4), "cached": cached}
+        if error is not None:
+            call["error"] = error
+            stats.errors.append(f"{provider}: {error}")
+        stats.llm_calls.append(call)
+
+
+def record_tokens(provider: str, tokens_in: Optional[int], tokens_out: Optional[int]):
+    # Providers report usage with the response; missing counts are skipped
+    stats = current_stats.get()
+    if tokens_in:
+        llm_tokens.inc(provider, "in", amount=tokens_in)
+        if stats is not None:
+            stats.tokens_in += tokens_in
+    if tokens_out:
+        llm_tokens.inc(provider, "out", amount=tokens_out)
+        if stats is not None:
+            stats.tokens_out += tokens_out
+
+
+def record_prompt_tokens(provider: str, tokens: int):
+    prompt_tokens.observe(tokens, provider)
+    stats = current_stats.get()
+    if stats is not None:
+        stats.prompt_tokens[provider] = stats.prompt_tokens.get(provider, 0) + tokens
+
+
+def observe_tag(stats: TagStats):
+    tag_duration.observe(stats.wall_s, stats.tag)
+    tag_queue_wait.observe(stats.queue_wait_s, stats.tag)
+    if stats.failed:
+        tag_errors.inc(stats.tag)
+    if stats.csv_loads:
+        tag_csv_loads.inc(stats.tag, amount=stats.csv_loads)
+    if stats.rows_scanned:
+        tag_rows_scanned.inc(stats.tag, amount=stats.rows_scanned)
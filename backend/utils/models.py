@@ -1,9 +1,17 @@
-import pandas as pd
 from pydantic import BaseModel, Field
 from typing import List, Optional, Union, Callable, Any
 import utils.retrievers as r
+from utils.memo import ReportMemo, memo_scope
+from utils.llm_cache import regenerate_scope
+from utils.openai_utils import ExtractionPolicy, policy_scope, stream_scope
+from utils.report_store import DATASETS, get_code_fingerprint, report_store
+from utils.datasets import dataset_cache
+from utils.examples import example_store
+from utils.metrics import TagStats, observe_tag, record_cache, stats_scope
 import asyncio
 import inspect 
+import time
+from decouple import config
 
 class Tag(BaseModel):
     id: str
@@ -39,40 +47,145 @@ class DataRetriever(BaseModel):
     department: str
     retrieval_functions: dict
     document_schema: DocumentSchema
+    max_concurrency: int = Field(default_factory=lambda: config("TAG_CONCURRENCY", default=8, cast=int))
     lock: asyncio.Lock = Field(default_factory=asyncio.Lock)
+    memo: ReportMemo = Field(default_factory=ReportMemo)
+    force_regenerate: bool = False
+    use_report_store: bool = True
+    snapshot_hits: set = Field(default_factory=set)
+    data_fingerprints: dict = Field(default_factory=dict)
+    tag_stats: dict = Field(default_factory=dict)
+    # Tags that ran but were left out of the report store, failed or partial
+    unstored_tags: set = Field(default_factory=set)
     
     class Config:
         arbitrary_types_allowed = True
 
-    async def populate_tag(self, page: Page, tag: Tag):
-        async with self.lock:
-            if tag.id in self.retrieval_functions:
-                func_or_lambda = self.retrieval_functions[tag.id]["retriever"]
-                multiple_values = self.retrieval_functions[tag.id]["multiple_values"]
-                
-                print(f"Executing tag {tag.id} on page {page.page_number}")
-                
-                async def execute_once():
-                    if callable(func_or_lambda):
-                        result = func_or_lambda(self)
-                        return await result if inspect.iscoroutine(result) else result
-                    func, args = func_or_lambda
-                    evaluated_args = [arg(self) if callable(arg) else arg for arg in args]
-                    if asyncio.iscoroutinefunction(func):
-                        result = await func(*evaluated_args)
-                    else:
-                        result = func(*evaluated_args)
-                    return str(result) if not isinstance(result, (list, dict)) else result
+    async def call_retriever(self, tag_id: str) -> Any:
+        func_or_lambda = self.retrieval_functions[tag_id]["retriever"]
+        # Identical retriever calls across tags and pages run once per report
+        with memo_scope(self.memo), regenerate_scope(self.force_regenerate):
+            if callable(func_or_lambda):
+                result = func_or_lambda(self)
+                return await result if inspect.iscoroutine(result) else result
+            func, args = func_or_lambda
+            evaluated_args = [arg(self) if callable(arg) else arg for arg in args]
+            if asyncio.iscoroutinefunction(func):
+                return await func(*evaluated_args)
+            return func(*evaluated_args)
 
-                if multiple_values:
-                    variations = await execute_once()
+    def get_data_fingerprint(self, name: str):
+        if name not in self.data_fingerprints:
+            try:
+                if name.startswith("examples:"):
+                    # Approved sections feed the LLM prompts like a dataset, one per tag
+                    self.data_fingerprints[name] = example_store.get_version(name.partition(":")[2])
                 else:
-                    variations = [await execute_once()]
+                    self.data_fingerprints[name] = dataset_cache.fingerprint(self.company, name)
+            except OSError:
+                self.data_fingerprints[name] = None
+        return self.data_fingerprints[name]
+
+    def get_tag_key(self, tag_id: str) -> str:
+        # A stored tag is reused while its retriever code, resolved arguments
+        # and the fingerprints of the datasets it reads are all unchanged
+        entry = self.retrieval_functions[tag_id]
+        func_or_lambda = entry["retriever"]
+        if callable(func_or_lambda):
+            code = [func_or_lambda]
+            args = [self.year, self.month, self.company, self.department]
+        else:
+            func, raw_args = func_or_lambda
+            code = [func] + [arg for arg in raw_args if callable(arg)]
+            args = [arg(self) if callable(arg) else arg for arg in raw_args]
+        sources = entry.get("sources", DATASETS)
+        if "examples" in sources:
+            # Only the sections approved for the prompts this tag renders, so an
+            # approval for one tag leaves the stored results of the others valid
+            sources = [name for name in sources if name != "examples"] + [
+                f"examples:{example_tag}" for example_tag in entry.get("example_tags", [tag_id])
+            ]
+        data = [(name, self.get_data_fingerprint(name)) for name in sources]
+        options = [entry["multiple_values"], entry.get("extraction")]
+        return report_store.make_key(tag_id, [get_code_fingerprint(c) for c in code], args, data, options)
+
+    async def populate_tag(self, page: Page, tag: Tag, on_delta: Optional[Callable] = None, stats: Optional[TagStats] = None):
+        # Stats are kept per (page number, tag id) for the progress events
+        stats = stats or TagStats(tag=tag.id)
+        self.tag_stats[(page.page_number, tag.id)] = stats
+        with stats_scope(stats):
+            await self.execute_tag(page, tag, on_delta, stats)
+        observe_tag(stats)
 
-                tag.variations = [{"id": i, "text": variation} for i, variation in enumerate(variations)]
-            else:
-                tag.variations = [{"id": 0, "text": "Tag executor not found"}]
+    async def execute_tag(self, page: Page, tag: Tag, on_delta: Optional[Callable], stats: TagStats):
+        if tag.id in self.retrieval_functions and self.use_report_store:
+            key = await asyncio.to_thread(self.get_tag_key, tag.id)
+            variations = None if self.force_regenerate else await asyncio.to_thread(report_store.get, key)
+            if not self.force_regenerate:
+                record_cache("report_store", variations is not None)
+            if variations is not None:
+                self.snapshot_hits.add(tag.id)
+                async with self.lock:
+                    tag.variations = variations
+                return
+        else:
+            key = None
 
+        if tag.id in self.retrieval_functions:
+            func_or_lambda = self.retrieval_functions[tag.id]["retriever"]
+            multiple_values = self.retrieval_functions[tag.id]["multiple_values"]
+            
+            print(f"Executing tag {tag.id} on page {page.page_number}")
+            
+            async def execute_once():
+                result = await self.call_retriever(tag.id)
+                if callable(func_or_lambda):
+                    return result
+                return str(result) if not isinstance(result, (list, dict)) else result
+
+            # Per-tag overrides of the LLM deadline and variation policy
+            policy = ExtractionPolicy(**self.retrieval_functions[tag.id].get("extraction", {}))
+            # Partial LLM output is forwarded as on_delta(page, tag, provider, text)
+            stream = (lambda provider, delta: on_delta(page, tag, provider, delta)) if on_delta else None
+
+            try:
+                with policy_scope(policy), stream_scope(stream):
+                    if multiple_values:
+                        values = await execute_once()
+                    else:
+                        values = [await execute_once()]
+                variations = [{"id": i, "text": variation} for i, variation in enumerate(values)]
+                # Report which provider produced each variation and how they were chosen
+                if len(policy.outcomes) == 1 and len(policy.outcomes[0]["providers"]) == len(variations):
+                    outcome = policy.outcomes[0]
+                    for variation, provider in zip(variations, outcome["providers"]):
+                        variation["provider"] = provider
+                        variation["policy"] = {field: outcome[field] for field in ("mode", "dropped", "failed")}
+                # A set missing dropped or failed providers is served but not stored, so
+                # later opens run the tag again and pick up the backfilled stragglers
+                if any(outcome["dropped"] or outcome["failed"] for outcome in policy.outcomes):
+                    key = None
+            except Exception as e:
+                print(f"Tag {tag.id} on page {page.page_number} failed: {e!r}")
+                stats.failed = True
+                stats.errors.append(repr(e))
+                variations = [{"id": 0, "text": "Tag executor failed"}]
+                key = None
+        else:
+            variations = [{"id": 0, "text": "Tag executor not found"}]
+
+        # Only the write into the shared schema is serialized, retrievers run concurrently
+        async with self.lock:
+            tag.variations = variations
+
+        if key is not None:
+            await asyncio.to_thread(report_store.set, key, tag.id, variations)
+        elif self.use_report_store and tag.id in self.retrieval_functions:
+            self.unstored_tags.add(tag.id)
+
+    async def populate_all(self, on_tag_done: Optional[Callable] = None, on_delta: Optional[Callable] = None):
+        scheduler = TagScheduler(self, max_concurrency=self.max_concurrency)
+        await scheduler.run(on_tag_done, on_delta)
 
     def get_short_month(self):
         months_map = {
@@ -83,4 +196,104 @@ class DataRetriever(BaseModel):
 
     async def get_document_data(self):
         async with self.lock:
-            return self.document_schema.model_dump(by_alias=True)
\ No newline at end of file
+            return self.document_schema.model_dump(by_alias=True)
+
+
+class TagScheduler:
+    """Runs every tag of a DataRetriever's schema concurrently, bounded by
+    max_concurrency. A retriever entry may declare "depends_on": [tag ids],
+    in which case its tag starts only after every instance of those tags is done.
+    Dependencies that are retriever entries but not tags in the schema run once
+    as stages, e.g. to prepare shared context, and are not written anywhere.
+    """
+
+    def __init__(self, data_retriever: DataRetriever, max_concurrency: int = 8):
+        self.data_retriever = data_retriever
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.pending: dict[str, int] = {}
+        self.finished: dict[str, asyncio.Event] = {}
+
+    def get_dependencies(self, tag_id: str) -> List[str]:
+        entry = self.data_retriever.retrieval_functions.get(tag_id, {})
+        return [dep for dep in entry.get("depends_on", []) if dep in self.finished]
+
+    def get_stages(self) -> List[str]:
+        stages = []
+        unresolved = list(self.finished)
+        while unresolved:
+            entry = self.data_retriever.retrieval_functions.get(unresolved.pop(), {})
+            for dep in entry.get("depends_on", []):
+                if dep not in self.finished and dep not in stages and dep in self.data_retriever.retrieval_functions:
+                    stages.append(dep)
+                    unresolved.append(dep)
+        return stages
+
+    def check_cycles(self):
+        visiting, visited = set(), set()
+
+        def visit(tag_id, path):
+            if tag_id in visited:
+                return
+            if tag_id in visiting:
+                raise ValueError(f"Circular tag dependency: {' -> '.join(path + [tag_id])}")
+            visiting.add(tag_id)
+            for dep in self.get_dependencies(tag_id):
+                visit(dep, path + [tag_id])
+            visiting.discard(tag_id)
+            visited.add(tag_id)
+
+        for tag_id in self.finished:
+            visit(tag_id, [])
+
+    async def run_job(self, job_id: str, job: Callable, stats: Optional[TagStats] = None):
+        try:
+            for dep in self.get_dependencies(job_id):
+                await self.finished[dep].wait()
+            queued_at = time.perf_counter()
+            async with self.semaphore:
+                if stats is not None:
+                    stats.queue_wait_s = time.perf_counter() - queued_at
+                await job()
+        finally:
+            self.pending[job_id] -= 1
+            if self.pending[job_id] == 0:
+                self.finished[job_id].set()
+
+    async def run_stage(self, stage_id: str):
+        async def job():
+            print(f"Executing stage {stage_id}")
+            try:
+                await self.data_retriever.call_retriever(stage_id)
+            except Exception as e:
+                # Dependent tags still run and surface the error themselves
+                print(f"Stage {stage_id} failed: {e!r}")
+
+        await self.run_job(stage_id, job)
+
+    async def run_tag(self, page: Page, tag: Tag, on_tag_done: Optional[Callable], on_delta: Optional[Callable]):
+        stats = TagStats(tag=tag.id)
+        await self.run_job(tag.id, lambda: self.data_retriever.populate_tag(page, tag, on_delta, stats), stats)
+        if on_tag_done:
+            result = on_tag_done(page, tag)
+            if inspect.isawaitable(result):
+                await result
+
+    async def run(self, on_tag_done: Optional[Callable] = None, on_delta: Optional[Callable] = None):
+        jobs = [
+            (page, tag)
+            for page in self.data_retriever.document_schema.pages
+            for tag in page.tags
+        ]
+        for _, tag in jobs:
+            self.pending[tag.id] = self.pending.get(tag.id, 0) + 1
+            self.finished.setdefault(tag.id, asyncio.Event())
+        stages = self.get_stages()
+        for stage_id in stages:
+            self.pending[stage_id] = 1
+            self.finished[stage_id] = asyncio.Event()
+        self.check_cycles()
+
+        await asyncio.gather(
+            *(self.run_stage(stage_id) for stage_id in stages),
+            *(self.run_tag(page, tag, on_tag_done, on_delta) for page, tag in jobs),
+        )
@@ -1,17 +1,25 @@
-from openai import OpenAI
-import instructor
 from decouple import config
 from string import Template
 from pydantic import BaseModel, Field
-from typing import List, Optional
-from anthropic import Anthropic
-from groq import Groq
+from typing import Any, Awaitable, Callable, List, Optional, Tuple, Type
+from contextlib import contextmanager
+from contextvars import ContextVar
 import asyncio
+import functools
+from utils.providers import providers
+from utils.metrics import record_llm_call
 
-oai_client = instructor.patch(OpenAI(api_key=config("OPENAI_API_KEY")))
-anthropic_client = Anthropic(api_key=config("ANTHROPIC_API_KEY"))
-groq_client = Groq(api_key=config("GROQ_API_KEY"))
+LLM_TAG_DEADLINE = config("LLM_TAG_DEADLINE", default=60.0, cast=float)
+LLM_PROVIDER_TIMEOUT = config("LLM_PROVIDER_TIMEOUT", default=45.0, cast=float)
+# 0 waits for every provider, N returns as soon as N variations have succeeded
+LLM_MIN_VARIATIONS = config("LLM_MIN_VARIATIONS", default=0, cast=int)
+# Let providers that missed the cut finish in the background and fill the response cache
+LLM_BACKFILL_STRAGGLERS = config("LLM_BACKFILL_STRAGGLERS", default=True, cast=bool)
+# Generate the sections of fused_prompt in one structured call per provider
+LLM_FUSED_TAGS = config("LLM_FUSED_TAGS", default=False, cast=bool)
 
+# ${examples} is filled per report with the approved sections closest to the
+# tag's context (utils/examples.py). The lists after each prompt seed them.
 product_sales_prompt = """
 You are an expert sales analyst. 
 From the given sales data and business context, generate a list of 3 bullet points to highlight findings in product and category sales for the current month.
@@ -22,10 +30,13 @@ From the given sales data and business context, generate a list of 3 bullet poin
 5. Don't include anything else than the bullets in your response, without titles or intros.
 
 ### Example
-Electronics sales increased significantly, contributing 40% to total revenue. |
-Fashion and Home & Garden categories also showed strong growth, with 28% and 22% of total sales, respectively. |
-Top-selling product, Echo Dot, saw a 15% increase in unit sales, driving overall growth in Electronics.
+${examples}
 """
+product_sales_examples = [
+    """Electronics sales increased significantly, contributing 40% to total revenue. |
+Fashion and Home & Garden categories also showed strong growth, with 28% and 22% of total sales, respectively. |
+Top-selling product, Echo Dot, saw a 15% increase in unit sales, driving overall growth in Electronics.""",
+]
 
 financial_performance_prompt = """
 You are an expert sales analyst. 
@@ -39,11 +50,14 @@ From the given sales data and business context, generate a list of 4 bullet poin
 6. Don't include anything else than the bullets in your response, without titles or intros.
 
 ### Example
-Total Sales Revenue increased by 10% compared to the previous month |
+${examples}
+"""
+financial_performance_examples = [
+    """Total Sales Revenue increased by 10% compared to the previous month |
 Year-over-year sales growth remains strong, with a 15% increase |
 Gross Margin improved to 46%, indicating enhanced profitability |
-Customer loyalty program boosted repeat purchases by 22%, helping drive revenue upward
-"""
+Customer loyalty program boosted repeat purchases by 22%, helping drive revenue upward""",
+]
 
 
 exec_summary_prompt = """
@@ -55,17 +69,18 @@ From the given sales data and market information, generate an executive summary
 4. Don't include anything else than the executive summary in your response, without titles or intros.
 
 Examples:
-In May 2024, the Media & Electronics department achieved $1,458,000 in sales revenue, up 5% month-over-month and 12% year-over-year. This was driven by a new inventory system cutting carrying costs by 15% and a loyalty program boosting repeat purchases by 22%. Improved supplier terms, optimized digital marketing, and dynamic pricing also enhanced revenue and margins.
-
-Key campaigns, "Mother’s Day Tech Gifts" and "Graduation Gear Up," significantly boosted performance. These strategies and operational efficiencies were crucial for our financial success and are essential for ongoing growth.
-- 
-In June 2024, the Energy department achieved $2,475,000 in sales revenue, a 10% month-over-month and 9% year-over-year increase. This was driven by a new inventory system reducing carrying costs by 15% and a loyalty program increasing repeat purchases by 22%. Supplier negotiations, digital marketing, and dynamic pricing also boosted revenue and margins.
-
-Key campaigns, "Beat the Heat with Energy Efficiency" and "Energy Independence Day," focused on energy efficiency and renewable adoption, driving financial growth. Maintaining focus on these strategies is vital for our competitive edge in the energy market.
--
+${examples}
 
 5. Think through your response step by step, to ensure it is never any longer than the given examples. Longer responses could cause people to die.
 """
+exec_summary_examples = [
+    """In May 2024, the Media & Electronics department achieved $1,458,000 in sales revenue, up 5% month-over-month and 12% year-over-year. This was driven by a new inventory system cutting carrying costs by 15% and a loyalty program boosting repeat purchases by 22%. Improved supplier terms, optimized digital marketing, and dynamic pricing also enhanced revenue and margins.
+
+Key campaigns, "Mother’s Day Tech Gifts" and "Graduation Gear Up," significantly boosted performance. These strategies and operational efficiencies were crucial for our financial success and are essential for ongoing growth.""",
+    """In June 2024, the Energy department achieved $2,475,000 in sales revenue, a 10% month-over-month and 9% year-over-year increase. This was driven by a new inventory system reducing carrying costs by 15% and a loyalty program increasing repeat purchases by 22%. Supplier negotiations, digital marketing, and dynamic pricing also boosted revenue and margins.
+
+Key campaigns, "Beat the Heat with Energy Efficiency" and "Energy Independence Day," focused on energy efficiency and renewable adoption, driving financial growth. Maintaining focus on these strategies is vital for our competitive edge in the energy market.""",
+]
 
 recommendations_prompt = """
 You are an expert sales analyst. 
@@ -80,12 +95,15 @@ From the given sales data and business context for a company, ACME, generate a c
 
 Example:
 
-In this month's report, we have observed several key trends and achievements.
+${examples}
+"""
+recommendations_examples = [
+    """In this month's report, we have observed several key trends and achievements.
 
 Total sales revenue has increased by 10% compared to the previous month, demonstrating steady growth.
 
-Despite these successes, we have noted a slight decrease in the average transaction value. To maintain our growth trajectory and address challenges effectively, we recommend the following actions:
-"""
+Despite these successes, we have noted a slight decrease in the average transaction value. To maintain our growth trajectory and address challenges effectively, we recommend the following actions:""",
+]
 
 recommendation_bullets_prompt = """
 You are an expert sales analyst. 
@@ -94,73 +112,163 @@ From the given sales data and business context, generate a list of 3 recommendat
 2. The description should be clear, concise, and not longer than the examples given below, 10-15 words.
 3. Don't include anything else than the bullets in your response, without intros.
 
-### Enhance Average Transaction Value
+${examples}
+
+"""
+recommendation_bullets_examples = [
+    """### Enhance Average Transaction Value
 To counter the dip in average transaction value, explore strategies such as bundling complementary products or introducing upsell and cross-sell opportunities
 |
 ### Customer Segmentation
 Consider implementing customer segmentation to tailor marketing efforts more effectively
 |
 ### Continuous Training and Development
-Continue investing in the training and development of the sales team to ensure they remain at the forefront of industry knowledge and sales techniques
+Continue investing in the training and development of the sales team to ensure they remain at the forefront of industry knowledge and sales techniques""",
+]
 
+# Tags over the same context, generated together when LLM_FUSED_TAGS is set.
+# Each ${tag id} is filled with that tag's own prompt, examples included.
+fused_prompt = """
+You are an expert sales analyst. 
+From the given sales data and business context, write the following sections of a monthly sales report, and return them as the fields of one object.
+Return lists as lists, one item per bullet or recommendation, instead of separating items with a pipe symbol |.
+
+## product_sales_bullets
+${product_sales_bullets}
+## recommendations_intro
+${recommendations_intro}
+## recommendation_bullets
+${recommendation_bullets}
 """
 
-def get_gpt_extraction(prompt: str, input: str):
-    response = oai_client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": prompt},
-            {"role": "user", "content": input},
-        ],
-    )
-    return response.choices[0].message.content
 
+class Recommendation(BaseModel):
+    title: str = Field(description="2-4 words, without ###")
+    description: str = Field(description="10-15 words")
 
-def get_embeddings(text: str):
-    return (
-        oai_client.embeddings.create(input=text, model="text-embedding-ada-002")
-        .data[0]
-        .embedding
-    )
 
+class FusedSections(BaseModel):
+    """Sections of a monthly sales report."""
+
+    product_sales_bullets: List[str]
+    recommendations_intro: str
+    recommendation_bullets: List[Recommendation]
+
+
+async def get_gpt_extraction(prompt: str, input: str):
+    return await providers["gpt"].extract(prompt, input)
+
+
+async def get_embeddings(texts: List[str]):
+    from utils.embeddings import embed_texts
+
+    return await embed_texts(texts)
+
+
+async def get_claude_extraction(prompt: str, input: str):
+    return await providers["claude"].extract(prompt, input)
+
+async def get_llama_extraction(prompt: str, input: str):
+    return await providers["llama"].extract(prompt, input)
+
+class ExtractionPolicy(BaseModel):
+    min_variations: int = LLM_MIN_VARIATIONS
+    deadline: float = LLM_TAG_DEADLINE
+    provider_timeout: float = LLM_PROVIDER_TIMEOUT
+    backfill: bool = LLM_BACKFILL_STRAGGLERS
+    outcomes: List[dict] = []
+
+
+current_policy: ContextVar[Optional[ExtractionPolicy]] = ContextVar("current_policy", default=None)
+# Receives (provider name, text delta) while LLM variations are generated
+current_stream: ContextVar[Optional[Callable]] = ContextVar("current_stream", default=None)
+
+background_tasks = set()
+
+
+@contextmanager
+def policy_scope(policy: ExtractionPolicy):
+    token = current_policy.set(policy)
+    try:
+        yield policy
+    finally:
+        current_policy.reset(token)
+
+
+@contextmanager
+def stream_scope(on_delta: Optional[Callable]):
+    token = current_stream.set(on_delta)
+    try:
+        yield
+    finally:
+        current_stream.reset(token)
+
+
+async def run_providers(call: Callable[[str, Any], Awaitable[Any]], policy: ExtractionPolicy) -> Tuple[List[Any], dict]:
+    # Runs call(name, provider) for every provider under the policy's deadline
+    # and returns the results in provider order, with how they were chosen
+    if not providers:
+        raise RuntimeError("No LLM providers are enabled, check LLM_PROVIDERS and the API keys")
+    wanted = policy.min_variations or len(providers)
+    tasks = {
+        asyncio.create_task(asyncio.wait_for(call(name, provider), policy.provider_timeout)): name
+        for name, provider in providers.items()
+    }
+    results, failed = {}, {}
+    pending = set(tasks)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    deadline = start + policy.deadline
+
+    while pending and len(results) < wanted:
+        done, pending = await asyncio.wait(
+            pending, timeout=max(deadline - loop.time(), 0), return_when=asyncio.FIRST_COMPLETED
+        )
+        if not done:
+            break
+        for task in done:
+            if task.exception() is not None:
+                failed[tasks[task]] = repr(task.exception())
+                record_llm_call(tasks[task], loop.time() - start, cached=False, error=failed[tasks[task]])
+            else:
+                results[tasks[task]] = task.result()
+
+    for task in pending:
+        if policy.backfill:
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        else:
+            task.cancel()
+
+    if not results:
+        raise TimeoutError(f"No provider returned within {policy.deadline}s: {failed or 'deadline exceeded'}")
+
+    names = [name for name in providers if name in results]
+    outcome = {
+        "providers": names,
+        "mode": f"first_{wanted}" if policy.min_variations else "all",
+        "dropped": [tasks[task] for task in pending],
+        "failed": list(failed),
+    }
+    return [results[name] for name in names], outcome
 
-def get_claude_extraction(prompt: str, input: str):
-    response = anthropic_client.messages.create(
-        model="claude-3-5-sonnet-20240620",
-        max_tokens=1000,
-        system=prompt,
-        messages=[
-            {"role": "user", "content": [
-                {
-                    "type": "text",
-                    "text": input,
-                }
-            ]
-            },
-        ],
-    )
-    return response.content[0].text
-
-def get_llama_extraction(prompt: str, input: str):
-    response = groq_client.chat.completions.create(
-        model="llama-3.1-70b-versatile",
-        messages=[
-            {"role": "system", "content": prompt},
-            {"role": "user", "content": input},
-        ],
-    )
-    return response.choices[0].message.content
 
 async def get_all_extractions(prompt: str, input: str) -> List[str]:
-    async def get_extraction(func, prompt, input):
-        return await asyncio.to_thread(func, prompt, input)
-
-    async def get_all_extractions_async(prompt: str, input: str):
-        tasks = [
-            get_extraction(get_gpt_extraction, prompt, input),
-            get_extraction(get_claude_extraction, prompt, input),
-            get_extraction(get_llama_extraction, prompt, input),
-        ]
-        return await asyncio.gather(*tasks)
-
-    return await get_all_extractions_async(prompt, input)
+    policy = current_policy.get() or ExtractionPolicy()
+    on_delta = current_stream.get()
+    results, outcome = await run_providers(
+        lambda name, provider: provider.extract(prompt, input, functools.partial(on_delta, name) if on_delta else None),
+        policy,
+    )
+    policy.outcomes.append(outcome)
+    return results
+
+
+async def get_all_structured(prompt: str, input: str, response_model: Type[BaseModel]) -> Tuple[List[BaseModel], dict]:
+    # One structured reply per provider. The outcome is returned rather than
+    # recorded, since the replies may be fanned out to several tags.
+    policy = current_policy.get() or ExtractionPolicy()
+    return await run_providers(
+        lambda name, provider: provider.extract_structured(prompt, input, response_model), policy
+    )
@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+from decouple import config
+from utils.docx_template import template_cache
+from utils.models import Page
+from utils.pdf_converter import DOCX_MIME_TYPE, get_pdf_converter
+
+RENDER_TEMPLATE_DIR = config("RENDER_TEMPLATE_DIR", default=os.path.join("..", "frontend", "public", "temp"))
+RENDER_CACHE_BYTES = config("RENDER_CACHE_BYTES", default=256 * 1024 * 1024, cast=int)
+RENDER_PREFETCH_LIMIT = config("RENDER_PREFETCH_LIMIT", default=4, cast=int)
+
+PDF_MIME_TYPE = "application/pdf"
+
+
+def prepare_render_data(page: Page, selected_variations: Dict[str, int]) -> Dict[str, Any]:
+    # Same data the frontend's prepareRenderData builds for docxtemplater
+    data = {}
+    for tag in page.tags:
+        if tag.id in data:
+            continue
+        try:
+            if tag.id == "recommendation_bullets":
+                variation = tag.variations[selected_variations.get(tag.id) or 0]
+                if isinstance(variation["text"], list):
+                    for i, bullet in enumerate(variation["text"]):
+                        title, content = bullet.split("\n")[:2]
+                        data[f"recommendation_bullet_title_{i + 1}"] = title.replace("### ", "", 1)
+                        data[f"recommendation_bullet_content_{i + 1}"] = content.strip()
+            elif "bullet" in tag.id:
+                variation = tag.variations[selected_variations.get(tag.id) or 0]
+                if isinstance(variation["text"], list):
+                    for i, bullet in enumerate(variation["text"]):
+                        data[tag.id.replace("bullets", f"bullet_{i + 1}", 1)] = bullet
+            elif tag.id in ("product_sales", "category_sales_chart"):
+                data[tag.id] = tag.variations[0]["text"]
+            elif tag.id in selected_variations:
+                variation = next((v for v in tag.variations if v["id"] == selected_variations[tag.id]), None)
+                if variation is not None:
+                    data[tag.id] = variation["text"]
+            else:
+                data[tag.id] = tag.variations[0]["text"]
+        except Exception as e:
+            print(f"Error processing tag {tag.id}: {e!r}")
+            data[tag.id] = "Empty"
+    return data
+
+
+def generate_pdf_key(page: Page, selected_variations: Dict[str, int]) -> str:
+    # Same key as generatePdfKey in the frontend
+    variations = "_".join(f"{tag.id}-{selected_variations.get(tag.id, 0)}" for tag in page.tags)
+    return f"page{page.page_number}_{variations}"
+
+
+def get_neighbours(page: Page, selected_variations: Dict[str, int]) -> List[Dict[str, int]]:
+    # Selections one variation switch away, the ones a reviewer is likely to view next
+    neighbours = []
+    for tag in page.tags:
+        if isinstance(tag.variations, str):
+            continue
+        for variation in tag.variations:
+            if variation["id"] != selected_variations.get(tag.id, 0):
+                neighbours.append({**selected_variations, tag.id: variation["id"]})
+    return neighbours
+
+
+class RenderCache:
+    # LRU over rendered files, bounded by bytes like the dataset cache
+    def __init__(self, max_bytes: int = RENDER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            content = self.entries.get(key)
+            if content is not None:
+                self.entries.move_to_end(key)
+            return content
+
+    def set(self, key: str, content: bytes):
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= len(previous)
+            self.entries[key] = content
+            self.total_bytes += len(content)
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+
+
+class PageRenderer:
+    """Renders one page of a report for one selection of variations, on demand.
+
+    Results are cached under the frontend's generatePdfKey, prefixed with a
+    hash of the page contents and the template, and concurrent requests for the
+    same render share one job. Prefetching renders the selections one variation
+    switch away in the background.
+    """
+
+    def __init__(self, template_dir: str = RENDER_TEMPLATE_DIR):
+        self.template_dir = template_dir
+        self.cache = RenderCache()
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.background_tasks = set()
+
+    def get_template_path(self, page_number: int) -> str:
+        return os.path.join(self.template_dir, f"page_{page_number}.docx")
+
+    def get_cache_key(self, page: Page, selected_variations: Dict[str, int], format: str) -> str:
+        stat = os.stat(self.get_template_path(page.page_number))
+        raw = json.dumps([page.model_dump(by_alias=True), stat.st_mtime_ns, stat.st_size], sort_keys=True, default=str)
+        page_hash = hashlib.sha256(raw.encode()).hexdigest()[:16]
+        return f"{page_hash}:{generate_pdf_key(page, selected_variations)}.{format}"
+
+    def render_docx(self, page: Page, selected_variations: Dict[str, int]) -> bytes:
+        template = template_cache.get(self.get_template_path(page.page_number))
+        return template.render(prepare_render_data(page, selected_variations))
+
+    async def build(self, page: Page, selected_variations: Dict[str, int], format: str) -> bytes:
+        if format == "docx":
+            return await asyncio.to_thread(self.render_docx, page, selected_variations)
+        docx = await self.render(page, selected_variations, "docx")
+        return await get_pdf_converter().convert(docx)
+
+    async def render(self, page: Page, selected_variations: Dict[str, int], format: str = "pdf") -> bytes:
+        key = self.get_cache_key(page, selected_variations, format)
+        content = self.cache.get(key)
+        if content is not None:
+            return content
+
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.build(page, selected_variations, format))
+            self.pending[key] = future
+            future.add_done_callback(lambda _: self.pending.pop(key, None))
+        content = await asyncio.shield(future)
+        self.cache.set(key, content)
+        return content
+
+    def prefetch(self, page: Page, selected_variations: Dict[str, int], format: str = "pdf", limit: int = RENDER_PREFETCH_LIMIT):
+        for neighbour in get_neighbours(page, selected_variations)[:limit]:
+            task = asyncio.create_task(self.render(page, neighbour, format))
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
+page_renderer = PageRenderer()
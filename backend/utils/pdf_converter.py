@@ -0,0 +1,417 @@
+import asyncio
+import hashlib
+import importlib.util
+import os
+import re
+import shutil
+import signal
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+from decouple import config
+from utils.metrics import registry
+
+PDF_CONVERTER = config("PDF_CONVERTER", default="auto")
+SOFFICE_BINARY = config("SOFFICE_BINARY", default="soffice")
+PDF_WORKERS = config("PDF_WORKERS", default=max((os.cpu_count() or 2) // 2, 1), cast=int)
+PDF_QUEUE_SIZE = config("PDF_QUEUE_SIZE", default=64, cast=int)
+PDF_CONVERT_TIMEOUT = config("PDF_CONVERT_TIMEOUT", default=60.0, cast=float)
+# Most seconds a conversion may spend queued and on a worker, retry included
+PDF_WAIT_TIMEOUT = config("PDF_WAIT_TIMEOUT", default=300.0, cast=float)
+PDF_CACHE_BYTES = config("PDF_CACHE_BYTES", default=256 * 1024 * 1024, cast=int)
+PDF_PROFILE_DIR = config("PDF_PROFILE_DIR", default=os.path.join(config("CACHE_DIR", default=".cache"), "soffice"))
+CONVERT_API_URL = config("CONVERT_API_URL", default="https://v2.convertapi.com/convert/docx/to/pdf")
+RENDER_MAX_CONVERSIONS = config("RENDER_MAX_CONVERSIONS", default=4, cast=int)
+
+DOCX_MIME_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+conversions = registry.counter("report_pdf_conversions_total", "DOCX to PDF conversions by converter and result", ("converter", "result"))
+conversion_duration = registry.histogram("report_pdf_conversion_seconds", "Time spent converting a DOCX to PDF", ("converter",))
+worker_restarts = registry.counter("report_pdf_worker_restarts_total", "Converter workers restarted after a crash or timeout")
+
+
+class ConversionError(Exception):
+    pass
+
+
+class PdfConverter:
+    name = ""
+
+    def __init__(self):
+        # Same DOCX bytes, same PDF: results are cached by content hash
+        from utils.page_renderer import RenderCache
+
+        self.cache = RenderCache(PDF_CACHE_BYTES)
+        self.pending: Dict[str, asyncio.Future] = {}
+
+    async def convert(self, docx: bytes) -> bytes:
+        key = hashlib.sha256(docx).hexdigest()
+        pdf = self.cache.get(key)
+        if pdf is not None:
+            conversions.inc(self.name, "cached")
+            return pdf
+
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.timed_convert(docx))
+            self.pending[key] = future
+            future.add_done_callback(lambda _: self.pending.pop(key, None))
+        pdf = await asyncio.shield(future)
+        self.cache.set(key, pdf)
+        return pdf
+
+    async def timed_convert(self, docx: bytes) -> bytes:
+        start = time.perf_counter()
+        try:
+            pdf = await self.run(docx)
+        except Exception:
+            conversions.inc(self.name, "error")
+            raise
+        conversions.inc(self.name, "converted")
+        conversion_duration.observe(time.perf_counter() - start, self.name)
+        return pdf
+
+    async def run(self, docx: bytes) -> bytes:
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+
+class ConvertApiConverter(PdfConverter):
+    name = "convertapi"
+
+    def __init__(self, max_concurrency: int = RENDER_MAX_CONVERSIONS):
+        super().__init__()
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    def post(self, docx: bytes) -> bytes:
+        import requests
+
+        response = requests.post(
+            CONVERT_API_URL,
+            params={"Secret": config("CONVERT_API_KEY"), "StoreFile": "true"},
+            files={"File": ("document.docx", docx, DOCX_MIME_TYPE)},
+            timeout=120,
+        )
+        response.raise_for_status()
+        pdf_response = requests.get(response.json()["Files"][0]["Url"], timeout=120)
+        pdf_response.raise_for_status()
+        return pdf_response.content
+
+    async def run(self, docx: bytes) -> bytes:
+        async with self.semaphore:
+            return await asyncio.to_thread(self.post, docx)
+
+
+def connect_office(pipe: str):
+    # Runs in a thread: resolving blocks until soffice accepts the connection
+    import uno
+
+    local = uno.getComponentContext()
+    resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+    context = resolver.resolve(f"uno:pipe,name={pipe};urp;StarOffice.ComponentContext")
+    return context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+
+
+def store_pdf(desktop, source: str, target: str):
+    # Runs in a thread: every UNO call blocks until soffice answers
+    import uno
+    from com.sun.star.beans import PropertyValue
+
+    def properties(**values) -> tuple:
+        result = []
+        for name, value in values.items():
+            prop = PropertyValue()
+            prop.Name, prop.Value = name, value
+            result.append(prop)
+        return tuple(result)
+
+    document = desktop.loadComponentFromURL(uno.systemPathToFileUrl(source), "_blank", 0, properties(Hidden=True, ReadOnly=True))
+    if document is None:
+        raise ConversionError("soffice could not open the document")
+    try:
+        document.storeToURL(uno.systemPathToFileUrl(target), properties(FilterName="writer_pdf_Export"))
+    finally:
+        document.close(True)
+
+
+class SofficeConverter(PdfConverter):
+    """Converts with local headless LibreOffice through a pool of workers.
+
+    Each worker keeps one soffice running, listening on a named pipe, and
+    converts its jobs through it over UNO, so a conversion starts no process.
+    Without the UNO Python bindings (python3-uno), workers run soffice once
+    per job instead, on a profile warmed up when the worker starts. Each
+    worker of every process owns its LibreOffice user profile, so workers
+    never contend for a profile lock, and profiles of dead processes are
+    removed on start. Jobs wait in a bounded queue, run at most one per
+    worker, and fail after PDF_WAIT_TIMEOUT. A worker whose soffice crashes
+    or times out starts it again on a fresh profile, and the job is retried
+    once.
+    """
+
+    name = "soffice"
+
+    def __init__(
+        self,
+        binary: str = SOFFICE_BINARY,
+        workers: int = PDF_WORKERS,
+        queue_size: int = PDF_QUEUE_SIZE,
+        timeout: float = PDF_CONVERT_TIMEOUT,
+        wait_timeout: float = PDF_WAIT_TIMEOUT,
+        profile_dir: str = PDF_PROFILE_DIR,
+        listen: Optional[bool] = None,
+    ):
+        super().__init__()
+        self.binary = binary
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.wait_timeout = wait_timeout
+        self.profile_dir = os.path.abspath(profile_dir)
+        self.listen = importlib.util.find_spec("uno") is not None if listen is None else listen
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker_tasks: List[Optional[asyncio.Task]] = []
+        # Per worker, the running soffice and its UNO desktop when listening
+        self.processes: Dict[int, asyncio.subprocess.Process] = {}
+        self.desktops: Dict[int, Any] = {}
+
+    def start(self):
+        # Workers start with the first job, on the running event loop, and a
+        # worker task that ended for any reason is started again
+        if self.queue is None:
+            self.queue = asyncio.Queue(self.queue_size)
+            self.worker_tasks = [None] * self.workers
+            self.remove_stale_profiles()
+            if not self.listen:
+                print("PDF workers run soffice once per job, the UNO Python bindings are unavailable")
+        for index, task in enumerate(self.worker_tasks):
+            if task is None or task.done():
+                if task is not None and not task.cancelled() and task.exception() is not None:
+                    print(f"PDF worker {index} ended: {task.exception()!r}")
+                self.worker_tasks[index] = asyncio.create_task(self.run_worker(index))
+
+    async def stop(self):
+        tasks = [task for task in self.worker_tasks if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for index in list(self.processes):
+            await self.stop_office(index)
+        # Profiles are per process, no later process can reuse them
+        for index in range(self.workers):
+            shutil.rmtree(self.get_profile(index), ignore_errors=True)
+        self.queue, self.worker_tasks = None, []
+
+    async def run(self, docx: bytes) -> bytes:
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+
+        async def submit():
+            # Waits here while the queue is full
+            await self.queue.put((docx, future))
+            return await future
+
+        try:
+            return await asyncio.wait_for(submit(), self.wait_timeout)
+        except asyncio.TimeoutError:
+            # A worker skips a job whose future is cancelled
+            future.cancel()
+            raise ConversionError(f"No PDF worker converted the document within {self.wait_timeout}s")
+
+    def get_profile(self, index: int) -> str:
+        # Per process too, as every uvicorn worker runs its own PDF workers
+        return os.path.join(self.profile_dir, f"worker-{os.getpid()}-{index}")
+
+    def remove_stale_profiles(self):
+        # Profiles of processes that are gone, left behind by crashes and reloads
+        try:
+            names = os.listdir(self.profile_dir)
+        except OSError:
+            return
+        for name in names:
+            match = re.fullmatch(r"worker-(\d+)-\d+", name)
+            if match is not None:
+                try:
+                    os.kill(int(match.group(1)), 0)
+                    continue
+                except ProcessLookupError:
+                    pass
+                except PermissionError:
+                    continue
+            shutil.rmtree(os.path.join(self.profile_dir, name), ignore_errors=True)
+
+    def get_pipe(self, index: int) -> str:
+        return f"report-pdf-{os.getpid()}-{index}"
+
+    async def warm(self, index: int):
+        try:
+            os.makedirs(self.get_profile(index), exist_ok=True)
+            if self.listen:
+                await self.stop_office(index)
+                await self.start_office(index)
+            else:
+                # Starting soffice once creates the profile, the slow part of a first start
+                await self.exec(index, "--terminate_after_init")
+        except (ConversionError, OSError) as e:
+            print(f"Warming PDF worker {index} failed: {e}")
+
+    async def restart(self, index: int):
+        worker_restarts.inc()
+        await self.stop_office(index)
+        shutil.rmtree(self.get_profile(index), ignore_errors=True)
+        await self.warm(index)
+
+    async def spawn(self, index: int, *args: str, output=asyncio.subprocess.PIPE) -> asyncio.subprocess.Process:
+        try:
+            return await asyncio.create_subprocess_exec(
+                self.binary,
+                f"-env:UserInstallation=file://{self.get_profile(index)}",
+                "--headless",
+                "--invisible",
+                "--nologo",
+                "--norestore",
+                "--nolockcheck",
+                *args,
+                stdout=output,
+                stderr=output,
+                start_new_session=True,
+            )
+        except OSError as e:
+            # A missing binary or an unusable profile directory
+            raise ConversionError(f"soffice could not start: {e!r}")
+
+    async def kill(self, process: asyncio.subprocess.Process):
+        # soffice is a launcher script, the group includes soffice.bin
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+    async def exec(self, index: int, *args: str):
+        process = await self.spawn(index, *args)
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            await self.kill(process)
+            raise ConversionError(f"soffice timed out after {self.timeout}s")
+        if process.returncode != 0:
+            raise ConversionError(f"soffice exited with {process.returncode}: {stderr.decode(errors='replace').strip()}")
+
+    async def start_office(self, index: int):
+        process = await self.spawn(
+            index, f"--accept=pipe,name={self.get_pipe(index)};urp;StarOffice.ComponentContext", output=asyncio.subprocess.DEVNULL
+        )
+        self.processes[index] = process
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                self.desktops[index] = await asyncio.to_thread(connect_office, self.get_pipe(index))
+                return
+            except Exception as e:
+                if process.returncode is not None:
+                    await self.stop_office(index)
+                    raise ConversionError(f"soffice exited with {process.returncode} before accepting connections")
+                if time.monotonic() > deadline:
+                    await self.stop_office(index)
+                    raise ConversionError(f"soffice did not accept connections within {self.timeout}s: {e!r}")
+            await asyncio.sleep(0.25)
+
+    async def stop_office(self, index: int):
+        self.desktops.pop(index, None)
+        process = self.processes.pop(index, None)
+        if process is not None and process.returncode is None:
+            await self.kill(process)
+
+    async def convert_with_office(self, index: int, source: str, target: str):
+        process = self.processes.get(index)
+        if index not in self.desktops or process is None or process.returncode is not None:
+            await self.stop_office(index)
+            await self.start_office(index)
+        try:
+            await asyncio.wait_for(asyncio.to_thread(store_pdf, self.desktops[index], source, target), self.timeout)
+        except asyncio.TimeoutError:
+            # The restart kills soffice, which ends the call still waiting in its thread
+            raise ConversionError(f"soffice timed out after {self.timeout}s")
+        except ConversionError:
+            raise
+        except Exception as e:
+            # UNO errors, e.g. the connection dropping when soffice crashes
+            raise ConversionError(f"soffice failed: {e!r}")
+
+    async def convert_file(self, index: int, docx: bytes) -> bytes:
+        with tempfile.TemporaryDirectory(prefix="pdf-") as tmp_dir:
+            source = os.path.join(tmp_dir, "page.docx")
+            target = os.path.join(tmp_dir, "page.pdf")
+            with open(source, "wb") as f:
+                f.write(docx)
+            if self.listen:
+                await self.convert_with_office(index, source, target)
+            else:
+                await self.exec(index, "--convert-to", "pdf", "--outdir", tmp_dir, source)
+            try:
+                with open(target, "rb") as f:
+                    return f.read()
+            except OSError:
+                raise ConversionError("soffice produced no PDF")
+
+    async def run_job(self, index: int, docx: bytes, future: asyncio.Future):
+        for attempt in range(2):
+            try:
+                pdf = await self.convert_file(index, docx)
+            except (ConversionError, OSError) as e:
+                print(f"PDF worker {index} failed: {e}")
+                await self.restart(index)
+                if attempt == 1 and not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(pdf)
+                return
+
+    async def run_worker(self, index: int):
+        await self.warm(index)
+        while True:
+            docx, future = await self.queue.get()
+            try:
+                if not future.done():
+                    await self.run_job(index, docx, future)
+            except Exception as e:
+                # No job may end the worker, queued jobs would wait for it forever
+                print(f"PDF worker {index} failed unexpectedly: {e!r}")
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+
+def create_converter() -> PdfConverter:
+    converter = PDF_CONVERTER
+    if converter == "auto":
+        converter = "soffice" if shutil.which(SOFFICE_BINARY) else "convertapi"
+    if converter == "soffice":
+        return SofficeConverter()
+    if converter == "convertapi":
+        return ConvertApiConverter()
+    raise ValueError(f"Unknown PDF_CONVERTER {converter!r}, expected auto, soffice or convertapi")
+
+
+pdf_converter: Optional[PdfConverter] = None
+
+
+def get_pdf_converter() -> PdfConverter:
+    # Created on first use so importing the app does not look up soffice
+    global pdf_converter
+    if pdf_converter is None:
+        pdf_converter = create_converter()
+    return pdf_converter
+
+
+async def stop_pdf_converter():
+    # Long-lived soffice processes run in their own sessions and would outlive the app
+    global pdf_converter
+    if pdf_converter is not None:
+        await pdf_converter.stop()
+        pdf_converter = None
@@ -0,0 +1,387 @@
+import asyncio
+import inspect
+import json
+import math
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Type
+from decouple import Csv, config
+from pydantic import BaseModel
+from utils.llm_cache import llm_cache
+from utils.metrics import record_cache, record_llm_call, record_prompt_tokens, record_tokens
+
+LLM_MAX_CONNECTIONS = config("LLM_MAX_CONNECTIONS", default=100, cast=int)
+LLM_MAX_KEEPALIVE_CONNECTIONS = config("LLM_MAX_KEEPALIVE_CONNECTIONS", default=20, cast=int)
+# Variations are produced in this order
+LLM_PROVIDERS = config("LLM_PROVIDERS", default="gpt,claude,llama", cast=Csv())
+
+http_client = None
+
+
+def with_json_schema(prompt: str, response_model: Type[BaseModel]) -> str:
+    schema = json.dumps(response_model.model_json_schema())
+    return f"{prompt}\n\nRespond with only a JSON object that matches this JSON schema:\n{schema}"
+
+
+def parse_json_response(response: str, response_model: Type[BaseModel]) -> BaseModel:
+    # Models sometimes wrap the object in a code block or a sentence
+    start, end = response.find("{"), response.rfind("}")
+    return response_model.model_validate_json(response[start:end + 1] if start != -1 else response)
+
+
+def get_http_client():
+    # One connection pool for every provider client, so calls multiplex on the
+    # event loop over kept-alive connections instead of occupying a thread each
+    global http_client
+    if http_client is None:
+        import httpx
+
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+            timeout=httpx.Timeout(600.0, connect=10.0),
+        )
+    return http_client
+
+
+class Provider:
+    name: str = ""
+    cache_name: str = ""
+    api_key_name: str = ""
+    # Rough characters per token of the model's tokenizer, for counting
+    # prompts where no exact tokenizer is available
+    chars_per_token: float = 4.0
+
+    def __init__(self, model: str, max_concurrency: int):
+        self.model = model
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = None
+
+    @property
+    def client(self):
+        # SDKs are imported and clients built on first call, so workers only
+        # pay for the providers they actually use
+        if self._client is None:
+            self._client = self.create_client(config(self.api_key_name))
+        return self._client
+
+    def create_client(self, api_key: str):
+        raise NotImplementedError
+
+    def load_tokenizer(self):
+        pass
+
+    def count_tokens(self, text: str) -> int:
+        return math.ceil(len(text) / self.chars_per_token)
+
+    async def complete(self, prompt: str, input: str) -> str:
+        raise NotImplementedError
+
+    async def stream(self, prompt: str, input: str) -> AsyncIterator[str]:
+        yield await self.complete(prompt, input)
+
+    async def complete_structured(self, prompt: str, input: str, response_model: Type[BaseModel]) -> BaseModel:
+        # Without native structured output the schema goes into the prompt
+        return parse_json_response(await self.complete(with_json_schema(prompt, response_model), input), response_model)
+
+    async def extract(self, prompt: str, input: str, on_delta: Optional[Callable[[str], Any]] = None) -> str:
+        streamed = generated = False
+        start = time.perf_counter()
+        record_prompt_tokens(self.name, self.count_tokens(prompt) + self.count_tokens(input))
+
+        async def emit(delta: str):
+            result = on_delta(delta)
+            if inspect.isawaitable(result):
+                await result
+
+        async def generate():
+            nonlocal streamed, generated
+            generated = True
+            async with self.semaphore:
+                if on_delta is None:
+                    return await self.complete(prompt, input)
+                streamed = True
+                chunks = []
+                async for delta in self.stream(prompt, input):
+                    chunks.append(delta)
+                    await emit(delta)
+                return "".join(chunks)
+
+        response = await llm_cache.acached(self.cache_name, self.model, prompt, input, generate)
+        record_cache("llm", not generated)
+        record_llm_call(self.name, time.perf_counter() - start, cached=not generated)
+        if on_delta is not None and not streamed:
+            # Cached responses reach listeners as a single delta
+            await emit(response)
+        return response
+
+    async def extract_structured(self, prompt: str, input: str, response_model: Type[BaseModel]) -> BaseModel:
+        generated = False
+        start = time.perf_counter()
+        record_prompt_tokens(self.name, self.count_tokens(prompt) + self.count_tokens(input))
+
+        async def generate():
+            nonlocal generated
+            generated = True
+            async with self.semaphore:
+                result = await self.complete_structured(prompt, input, response_model)
+            return result.model_dump_json()
+
+        # The schema is part of the cached prompt, so changing the model regenerates
+        schema = json.dumps(response_model.model_json_schema(), sort_keys=True)
+        response = await llm_cache.acached(self.cache_name, self.model, f"{prompt}\n{schema}", input, generate)
+        record_cache("llm", not generated)
+        record_llm_call(self.name, time.perf_counter() - start, cached=not generated)
+        return response_model.model_validate_json(response)
+
+
+class OpenAIProvider(Provider):
+    name = "gpt"
+    cache_name = "openai"
+    api_key_name = "OPENAI_API_KEY"
+    encoding = None
+    encoding_lock = threading.Lock()
+
+    def create_client(self, api_key: str):
+        import instructor
+        from openai import AsyncOpenAI
+
+        return instructor.patch(AsyncOpenAI(api_key=api_key, http_client=get_http_client()))
+
+    def load_tokenizer(self):
+        # tiktoken is optional and downloads its encodings on first use, so the
+        # app loads them in a thread at startup, see load_tokenizers
+        with self.encoding_lock:
+            if self.encoding is not None:
+                return
+            try:
+                import tiktoken
+
+                self.encoding = tiktoken.encoding_for_model(self.model)
+            except Exception as e:
+                print(f"Counting {self.name} tokens by characters, tiktoken is unavailable: {e!r}")
+                self.encoding = False
+
+    def count_tokens(self, text: str) -> int:
+        if self.encoding is None:
+            self.load_tokenizer()
+        if self.encoding is False:
+            return super().count_tokens(text)
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    async def complete(self, prompt: str, input: str) -> str:
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": input},
+            ],
+        )
+        if response.usage:
+            record_tokens(self.name, response.usage.prompt_tokens, response.usage.completion_tokens)
+        return response.choices[0].message.content
+
+    async def stream(self, prompt: str, input: str) -> AsyncIterator[str]:
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": input},
+            ],
+            stream=True,
+            # Usage arrives in a final chunk without choices
+            stream_options={"include_usage": True},
+        )
+        async for chunk in response:
+            if chunk.usage:
+                record_tokens(self.name, chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def complete_structured(self, prompt: str, input: str, response_model: Type[BaseModel]) -> BaseModel:
+        # instructor validates the reply against response_model and retries on errors
+        result = await self.client.chat.completions.create(
+            model=self.model,
+            response_model=response_model,
+            messages=[
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": input},
+            ],
+        )
+        usage = getattr(getattr(result, "_raw_response", None), "usage", None)
+        if usage:
+            record_tokens(self.name, usage.prompt_tokens, usage.completion_tokens)
+        return result
+
+    async def embed(self, texts: list[str], model: str = "text-embedding-ada-002") -> list[list[float]]:
+        # One request embeds the whole batch
+        async with self.semaphore:
+            response = await self.client.embeddings.create(input=texts, model=model)
+        if response.usage:
+            record_tokens(self.name, response.usage.prompt_tokens, None)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+class AnthropicProvider(Provider):
+    name = "claude"
+    cache_name = "anthropic"
+    api_key_name = "ANTHROPIC_API_KEY"
+    chars_per_token = 3.5
+
+    def create_client(self, api_key: str):
+        from anthropic import AsyncAnthropic
+
+        return AsyncAnthropic(api_key=api_key, http_client=get_http_client())
+
+    async def complete(self, prompt: str, input: str) -> str:
+        response = await self.client.messages.create(
+            model=self.model,
+            max_tokens=1000,
+            system=prompt,
+            messages=[
+                {"role": "user", "content": [
+                    {
+                        "type": "text",
+                        "text": input,
+                    }
+                ]
+                },
+            ],
+        )
+        record_tokens(self.name, response.usage.input_tokens, response.usage.output_tokens)
+        return response.content[0].text
+
+    async def stream(self, prompt: str, input: str) -> AsyncIterator[str]:
+        async with self.client.messages.stream(
+            model=self.model,
+            max_tokens=1000,
+            system=prompt,
+            messages=[
+                {"role": "user", "content": [
+                    {
+                        "type": "text",
+                        "text": input,
+                    }
+                ]
+                },
+            ],
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+            message = await stream.get_final_message()
+            record_tokens(self.name, message.usage.input_tokens, message.usage.output_tokens)
+
+    async def complete_structured(self, prompt: str, input: str, response_model: Type[BaseModel]) -> BaseModel:
+        # Forcing a single tool call makes the tool input the structured reply
+        tool = {
+            "name": response_model.__name__,
+            "description": response_model.__doc__ or response_model.__name__,
+            "input_schema": response_model.model_json_schema(),
+        }
+        response = await self.client.messages.create(
+            model=self.model,
+            max_tokens=2000,
+            system=prompt,
+            messages=[{"role": "user", "content": input}],
+            tools=[tool],
+            tool_choice={"type": "tool", "name": tool["name"]},
+        )
+        record_tokens(self.name, response.usage.input_tokens, response.usage.output_tokens)
+        tool_use = next(block for block in response.content if block.type == "tool_use")
+        return response_model.model_validate(tool_use.input)
+
+
+class GroqProvider(Provider):
+    name = "llama"
+    cache_name = "groq"
+    api_key_name = "GROQ_API_KEY"
+
+    def create_client(self, api_key: str):
+        from groq import AsyncGroq
+
+        return AsyncGroq(api_key=api_key, http_client=get_http_client())
+
+    async def complete(self, prompt: str, input: str) -> str:
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": input},
+            ],
+        )
+        if response.usage:
+            record_tokens(self.name, response.usage.prompt_tokens, response.usage.completion_tokens)
+        return response.choices[0].message.content
+
+    async def stream(self, prompt: str, input: str) -> AsyncIterator[str]:
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": input},
+            ],
+            stream=True,
+        )
+        async for chunk in response:
+            # Groq reports usage on the last chunk
+            usage = getattr(getattr(chunk, "x_groq", None), "usage", None)
+            if usage:
+                record_tokens(self.name, usage.prompt_tokens, usage.completion_tokens)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def complete_structured(self, prompt: str, input: str, response_model: Type[BaseModel]) -> BaseModel:
+        # JSON mode guarantees valid JSON, the schema in the prompt shapes it
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": with_json_schema(prompt, response_model)},
+                {"role": "user", "content": input},
+            ],
+            response_format={"type": "json_object"},
+        )
+        if response.usage:
+            record_tokens(self.name, response.usage.prompt_tokens, response.usage.completion_tokens)
+        return parse_json_response(response.choices[0].message.content, response_model)
+
+
+provider_factories: Dict[str, Callable[[], Provider]] = {
+    "gpt": lambda: OpenAIProvider(
+        model="gpt-4o",
+        max_concurrency=config("OPENAI_MAX_CONCURRENCY", default=16, cast=int),
+    ),
+    "claude": lambda: AnthropicProvider(
+        model="claude-3-5-sonnet-20240620",
+        max_concurrency=config("ANTHROPIC_MAX_CONCURRENCY", default=16, cast=int),
+    ),
+    "llama": lambda: GroqProvider(
+        model="llama-3.1-70b-versatile",
+        max_concurrency=config("GROQ_MAX_CONCURRENCY", default=16, cast=int),
+    ),
+}
+
+
+def build_providers() -> Dict[str, Provider]:
+    # Providers are enabled by LLM_PROVIDERS; those without an API key are
+    # skipped so one missing key doesn't take the whole backend down
+    registry = {}
+    for name in LLM_PROVIDERS:
+        if name not in provider_factories:
+            print(f"Unknown LLM provider {name!r} in LLM_PROVIDERS")
+            continue
+        provider = provider_factories[name]()
+        if not config(provider.api_key_name, default=""):
+            print(f"LLM provider {name!r} disabled: {provider.api_key_name} is not set")
+            continue
+        registry[name] = provider
+    return registry
+
+
+providers: Dict[str, Provider] = build_providers()
+
+
+async def load_tokenizers():
+    # Run once at startup, so no prompt waits on an encoding download on the event loop
+    await asyncio.gather(*(asyncio.to_thread(provider.load_tokenizer) for provider in providers.values()))
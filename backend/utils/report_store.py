@@ -0,0 +1,101 @@
+import hashlib
+import inspect
+import json
+import os
+import time
+import types
+from typing import Any, Dict, List, Optional
+from decouple import config
+from utils.sqlite_store import SQLiteStore
+
+CACHE_DIR = config("CACHE_DIR", default=".cache")
+REPORT_STORE_PATH = config("REPORT_STORE_PATH", default=os.path.join(CACHE_DIR, "reports.sqlite3"))
+REPORT_STORE_TTL = config("REPORT_STORE_TTL", default=30 * 24 * 60 * 60, cast=int)
+
+# Tags that don't declare "sources" are assumed to read every dataset of their company.
+# A tag reading "examples" depends on the sections approved for its own prompt, or
+# for the prompts listed in its "example_tags".
+DATASETS = ["sales_data", "customer_metrics", "campaigns"]
+
+code_fingerprints: Dict[Any, str] = {}
+
+
+def iter_code_names(code: types.CodeType):
+    yield from code.co_names
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from iter_code_names(const)
+
+
+def get_code_fingerprint(func: Any) -> str:
+    # Hashes a retriever's source together with the helpers of ours it calls,
+    # recursively, and the module-level strings it reads such as prompts, so
+    # editing any of them invalidates the results stored for its tags
+    if func in code_fingerprints:
+        return code_fingerprints[func]
+
+    parts, seen = [], set()
+
+    def visit(value):
+        value = inspect.unwrap(value)
+        if not isinstance(value, types.FunctionType) or value in seen:
+            return
+        seen.add(value)
+        try:
+            parts.append(inspect.getsource(value))
+        except (OSError, TypeError):
+            parts.append(value.__qualname__)
+        for name in iter_code_names(value.__code__):
+            referenced = value.__globals__.get(name)
+            if isinstance(referenced, str):
+                parts.append(f"{name}={referenced}")
+            elif callable(referenced) and getattr(referenced, "__module__", "").startswith("utils."):
+                visit(referenced)
+
+    visit(func)
+    fingerprint = hashlib.sha256("\n".join(parts).encode()).hexdigest()
+    code_fingerprints[func] = fingerprint
+    return fingerprint
+
+
+class ReportStore(SQLiteStore):
+    schema = [
+        """
+        CREATE TABLE IF NOT EXISTS tag_results (
+            key TEXT PRIMARY KEY,
+            tag_id TEXT NOT NULL,
+            variations TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS tag_results_created_at ON tag_results (created_at)",
+    ]
+
+    def __init__(self, path: str = REPORT_STORE_PATH, ttl: int = REPORT_STORE_TTL):
+        super().__init__(path)
+        self.ttl = ttl
+
+    @staticmethod
+    def make_key(tag_id: str, code: List[str], args: List[Any], data: List[Any], options: Any) -> str:
+        raw = json.dumps([tag_id, code, args, data, options], default=str, sort_keys=True)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[List[dict]]:
+        with self.connection() as conn:
+            row = conn.execute(
+                "SELECT variations FROM tag_results WHERE key = ? AND created_at >= ?",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, tag_id: str, variations: List[dict]):
+        now = time.time()
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO tag_results VALUES (?, ?, ?, ?)",
+                (key, tag_id, json.dumps(variations), now),
+            )
+            conn.execute("DELETE FROM tag_results WHERE created_at < ?", (now - self.ttl,))
+
+
+report_store = ReportStore()
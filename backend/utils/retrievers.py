@@ -1,5 +1,17 @@
 import pandas as pd
+from utils.datasets import load_dataset, load_derived
+from utils.memo import report_memo
+from utils.metrics import record_rows_scanned
+from utils.context_bundle import ContextBundle, context_bundle_store
+from utils.sales_cube import get_sales_cube
+from utils.examples import render_prompt
+from utils.context_serializer import serialize_table
+from string import Template
 from utils.openai_utils import (
+    FusedSections,
+    current_policy,
+    fused_prompt,
+    get_all_structured,
     get_gpt_extraction,
     get_claude_extraction,
     product_sales_prompt,
@@ -20,6 +32,7 @@ def _filter_sales_df(
     product: str = "",
     metric: str = "",
 ) -> pd.DataFrame:
+    record_rows_scanned(len(df))
     filtered_df = df[(df["Month"] == month) & (df["Year"] == year)]
     if category:
         filtered_df = filtered_df[filtered_df["Category"] == category]
@@ -30,33 +43,57 @@ def _filter_sales_df(
     return filtered_df
 
 
+def _get_previous_month(month_num: int, year: int) -> tuple[int, int]:
+    if month_num == 1:
+        return 12, year - 1
+    return month_num - 1, year
+
+
+@report_memo
 def _get_product_sales_table_text(month_num: int, year: int, company: str = "comp1") -> str:
-    df = pd.read_csv(f"data/{company}_sales_data.csv")
+    df = load_dataset(company, "sales_data", periods=[(year, month_num)])
     df = _filter_sales_df(df, month_num, year)
-    return df.to_csv(index=False)
+    # Past the token budget, the smallest products are summed per category
+    return serialize_table(
+        df,
+        sort_by="Sales Revenue ($)",
+        group_by="Category",
+        measures=["Sales Quantity", "Sales Revenue ($)", "Margin ($)"],
+    )
 
 
-def _get_product_sales_table(month_num: int, year: int, company: str = "comp1") -> dict:
-    df = pd.read_csv(f"data/{company}_sales_data.csv")
-    df = _filter_sales_df(df, month_num, year)
-    product_measures = []
-    print(df.head(4))
-    for _, row in df.iterrows():
-        product_dict = {
-            "product_name": row["Product Name"],
-            "sales_qty": row["Sales Quantity"],
-            "sales_change_mom_qty": _get_sales_growth_mom(month_num, year, company=company, product=row["Product Name"]),
-            "sales_revenue": row["Sales Revenue ($)"],
-            "sales_change_mom_revenue": _get_sales_growth_mom(month_num, year, company=company, product=row["Product Name"])
-        }
-        product_measures.append(product_dict)
-
-    return product_measures
+@report_memo
+def _get_product_sales_table(month_num: int, year: int, company: str = "comp1") -> list[dict]:
+    prev_month, prev_year = _get_previous_month(month_num, year)
+    sales_df = load_dataset(company, "sales_data", periods=[(year, month_num), (prev_year, prev_month)])
+    df = _filter_sales_df(sales_df, month_num, year)
+
+    measures = ["Sales Quantity", "Sales Revenue ($)"]
+    current_totals = df.groupby("Product Name", sort=False)[measures].sum()
+    previous_totals = (
+        _filter_sales_df(sales_df, prev_month, prev_year)
+        .groupby("Product Name", sort=False)[measures].sum()
+        .reindex(current_totals.index, fill_value=0)
+    )
+    growth = ((current_totals - previous_totals) / previous_totals) * 100
+    # Products without sales last month get 0, same as _get_sales_growth_mom
+    growth = growth.where(previous_totals != 0, 0).round().astype(int)
+    growth = growth.reindex(df["Product Name"])
+
+    table = pd.DataFrame({
+        "product_name": df["Product Name"].to_numpy(),
+        "sales_qty": df["Sales Quantity"].to_numpy(),
+        "sales_change_mom_qty": growth["Sales Quantity"].to_numpy(),
+        "sales_revenue": df["Sales Revenue ($)"].to_numpy(),
+        "sales_change_mom_revenue": growth["Sales Revenue ($)"].to_numpy(),
+    })
+    return table.to_dict(orient="records")
 
 # --------------------------------------------------------------------------------
 # Sales, Revenue, Margin
 # --------------------------------------------------------------------------------
 
+@report_memo
 def _get_sales_revenue(
     month_num: int,
     year: int,
@@ -64,12 +101,10 @@ def _get_sales_revenue(
     category: str = "",
     product: str = "",
 ) -> float:
-    df = pd.read_csv(f"data/{company}_sales_data.csv")
-    filtered_df = _filter_sales_df(df, month_num, year, category, product)
-    revenue = filtered_df["Sales Revenue ($)"].sum()
-    return revenue
+    return get_sales_cube(company).lookup(year, month_num, category, product).sales_revenue
 
 
+@report_memo
 def _get_gross_margin(
     month_num: int,
     year: int,
@@ -77,13 +112,11 @@ def _get_gross_margin(
     category: str = "",
     product: str = "",
 ) -> float:
-    df = pd.read_csv(f"data/{company}_sales_data.csv")
-    filtered_df = _filter_sales_df(df, month_num, year, category, product)
-    margin = (
-        filtered_df["Margin ($)"].sum() / filtered_df["Sales Revenue ($)"].sum()
-    ) * 100
+    totals = get_sales_cube(company).lookup(year, month_num, category, product)
+    margin = (totals.margin / totals.sales_revenue) * 100
     return round(margin)
 
+@report_memo
 def _get_sales_growth_mom(
     month_num: int,
     year: int,
@@ -92,14 +125,7 @@ def _get_sales_growth_mom(
     product: str = "",
 ) -> float:
     current_month_sales = _get_sales_revenue(month_num, year, company, category, product)
-    
-    # Calculate previous month and year
-    prev_month = month_num - 1
-    prev_year = year
-    if prev_month == 0:
-        prev_month = 12
-        prev_year -= 1
-    
+    prev_month, prev_year = _get_previous_month(month_num, year)
     previous_month_sales = _get_sales_revenue(prev_month, prev_year, company, category, product)
     
     if previous_month_sales == 0:
@@ -108,6 +134,7 @@ def _get_sales_growth_mom(
     growth_rate = ((current_month_sales - previous_month_sales) / previous_month_sales) * 100
     return round(growth_rate)
 
+@report_memo
 def _get_sales_growth_yoy(
     month_num: int,
     year: int,
@@ -127,10 +154,11 @@ def _get_sales_growth_yoy(
     return round(growth_rate)
 
 
+@report_memo
 def _get_customer_data(
     month_num: int, year: int, metric: str = "", company: str = "comp1"
 ) -> str:
-    df = pd.read_csv(f"data/{company}_customer_metrics.csv")
+    df = load_dataset(company, "customer_metrics", periods=[(year, month_num)], filters={"Metric": metric} if metric else None)
     filtered_df = _filter_sales_df(df, month_num, year, metric=metric)
 
     if filtered_df.empty:
@@ -139,13 +167,15 @@ def _get_customer_data(
         value = filtered_df["Value"].iloc[0]
         return value
 
+@report_memo
 def _get_campaign_data(month_num: int, company: str = "comp1") -> str:
-    df = pd.read_csv(f"data/{company}_campaigns.csv")
+    df = load_dataset(company, "campaigns")
     filtered_df = _filter_sales_df(df, month=month_num)
     prefix = "Our sales campaigns this month:\n"
-    return prefix + filtered_df.to_csv(index=False)
+    return prefix + serialize_table(filtered_df)
 
 
+@report_memo
 def _get_financial_metrics_text(
     month_num: int, year: int, company: str = "comp1"
 ) -> str:
@@ -188,24 +218,43 @@ def _get_financial_metrics_text(
 
 
 
+@report_memo
+def _get_context_bundle(month_num: int, year: int, company: str = "comp1") -> ContextBundle:
+    return context_bundle_store.load(
+        company,
+        year,
+        month_num,
+        lambda: ContextBundle(
+            company=company,
+            year=year,
+            month=month_num,
+            financial_metrics=_get_financial_metrics_text(month_num, year, company=company),
+            campaigns=_get_campaign_data(month_num, company=company),
+            product_sales=_get_product_sales_table_text(month_num, year, company=company),
+        ),
+    )
+
+
+@report_memo
 async def _get_executive_summary(month_num: int, year: int, department: str, company: str = "comp1") -> str:
-    data = _get_financial_metrics_text(month_num, year, company=company)
+    bundle = _get_context_bundle(month_num, year, company=company)
     context = f"""
     This pertains to the {department} -department. 
-    {_get_campaign_data(month_num, company=company)}
+    {bundle.campaigns}
     Financial metrics:
-    {data}
+    {bundle.financial_metrics}
     """
     # response = get_gpt_extraction(exec_summary_prompt, context)
-    response = await get_all_extractions(exec_summary_prompt, context)
+    prompt = await render_prompt(exec_summary_prompt, "executive_summary", context)
+    response = await get_all_extractions(prompt, context)
     return [r.strip() for r in response]
 
 
+@report_memo
 async def _get_fin_perf_bullets(month_num: int, year: int, company: str = "comp1") -> str:
-    data = _get_financial_metrics_text(month_num, year, company=company)
-    response = await get_all_extractions(
-        financial_performance_prompt, data
-    )
+    bundle = _get_context_bundle(month_num, year, company=company)
+    prompt = await render_prompt(financial_performance_prompt, "fin_perf_bullets", bundle.financial_metrics)
+    response = await get_all_extractions(prompt, bundle.financial_metrics)
     bullets = [[bullet.strip() for bullet in r.split("|")] for r in response]
     return bullets
 
@@ -213,21 +262,23 @@ async def _get_fin_perf_bullets(month_num: int, year: int, company: str = "comp1
 # Product Sales
 # --------------------------------------------------------------------------------
 
+@report_memo
 async def _get_product_sales_bullets(
     month_num: int, year: int, company: str = "comp1"
 ) -> str:
-    data = _get_product_sales_table_text(month_num, year, company=company)
-    campaign_context = _get_campaign_data(month_num, company=company)
-    response = await get_all_extractions(product_sales_prompt, data + campaign_context)
+    bundle = _get_context_bundle(month_num, year, company=company)
+    context = bundle.product_sales + bundle.campaigns
+    prompt = await render_prompt(product_sales_prompt, "product_sales_bullets", context)
+    response = await get_all_extractions(prompt, context)
     return [[bullet.strip() for bullet in r.split("|")] for r in response]
 
 
+@report_memo
 def _get_category_sales_chart(
     month_num: int, year: int, company: str = "comp1"
 ) -> dict:
     # Get unique categories
-    df = pd.read_csv(f"data/{company}_sales_data.csv")
-    categories = df["Category"].unique().tolist()
+    categories = list(load_derived(company, "sales_data", "categories", lambda df: df["Category"].unique().tolist(), ["Category"]))
 
     # Get sales data for current month, last month, and same month last year
     current_sales = [
@@ -257,32 +308,31 @@ def _get_category_sales_chart(
 # Recommendations
 # --------------------------------------------------------------------------------
 
+@report_memo
 async def _get_recommendations_intro(
     month_num: int, year: int, department: str, company: str = "comp1"
 ) -> str:
-    data = _get_product_sales_table_text(month_num, year, company=company)
-    campaign_context = _get_campaign_data(month_num, company=company)
+    bundle = _get_context_bundle(month_num, year, company=company)
     context = f"""
     This pertains to the {department} -department. 
-    {campaign_context}
+    {bundle.campaigns}
     
     Financial metrics:
-    {data}
+    {bundle.product_sales}
     """
-    response = await get_all_extractions(
-        recommendations_prompt, context
-    )
+    prompt = await render_prompt(recommendations_prompt, "recommendations_intro", context)
+    response = await get_all_extractions(prompt, context)
     return [r.strip() for r in response]
 
 
+@report_memo
 async def _get_recommendation_bullets(
     month_num: int, year: int, company: str = "comp1"
 ) -> list[str]:
-    data = _get_product_sales_table_text(month_num, year, company=company)
-    campaign_context = _get_campaign_data(month_num, company=company)
-    response = await get_all_extractions(
-        recommendation_bullets_prompt, campaign_context + data
-    )
+    bundle = _get_context_bundle(month_num, year, company=company)
+    context = bundle.campaigns + bundle.product_sales
+    prompt = await render_prompt(recommendation_bullets_prompt, "recommendation_bullets", context)
+    response = await get_all_extractions(prompt, context)
     return [[bullet.strip() for bullet in r.split("|")] for r in response]
 
 
@@ -292,3 +342,52 @@ def _get_recommendation_bullet_titles(bullets: list[str]) -> list[str]:
 
 def _get_recommendation_bullet_contents(bullets: list[str]) -> list[str]:
     return ["\n".join(bullet.split("\n")[1:]).strip() for bullet in bullets]
+
+
+# --------------------------------------------------------------------------------
+# Fused sections
+# --------------------------------------------------------------------------------
+
+# How each fused tag's variation is read from a provider's FusedSections, in
+# the same shape as its own retriever returns
+fused_tags = {
+    "product_sales_bullets": lambda sections: [bullet.strip() for bullet in sections.product_sales_bullets],
+    "recommendations_intro": lambda sections: sections.recommendations_intro.strip(),
+    "recommendation_bullets": lambda sections: [
+        f"### {item.title.strip()}\n{item.description.strip()}" for item in sections.recommendation_bullets
+    ],
+}
+
+
+@report_memo
+async def _get_fused_sections(
+    month_num: int, year: int, department: str, company: str = "comp1"
+) -> tuple[list[FusedSections], dict]:
+    bundle = _get_context_bundle(month_num, year, company=company)
+    # The recommendations intro context covers what the other two tags read
+    context = f"""
+    This pertains to the {department} -department. 
+    {bundle.campaigns}
+    
+    Financial metrics:
+    {bundle.product_sales}
+    """
+    templates = {
+        "product_sales_bullets": product_sales_prompt,
+        "recommendations_intro": recommendations_prompt,
+        "recommendation_bullets": recommendation_bullets_prompt,
+    }
+    sections = {tag_id: await render_prompt(template, tag_id, context) for tag_id, template in templates.items()}
+    prompt = Template(fused_prompt).safe_substitute(sections)
+    return await get_all_structured(prompt, context, FusedSections)
+
+
+async def _get_fused_tag(
+    tag_id: str, month_num: int, year: int, department: str, company: str = "comp1"
+) -> list:
+    sections, outcome = await _get_fused_sections(month_num, year, department, company=company)
+    # Every fused tag reports the providers of the shared call as its own
+    policy = current_policy.get()
+    if policy is not None:
+        policy.outcomes.append(outcome)
+    return [fused_tags[tag_id](provider_sections) for provider_sections in sections]
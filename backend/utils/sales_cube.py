@@ -0,0 +1,44 @@
+from typing import Dict, NamedTuple, Tuple
+import pandas as pd
+from utils.datasets import load_derived
+
+KEY_COLUMNS = ["Year", "Month", "Category", "Product Name"]
+
+
+class SalesTotals(NamedTuple):
+    sales_qty: int
+    sales_revenue: float
+    margin: float
+
+
+class SalesCube:
+    measures = {
+        "sales_qty": "Sales Quantity",
+        "sales_revenue": "Sales Revenue ($)",
+        "margin": "Margin ($)",
+    }
+
+    def __init__(self, df: pd.DataFrame):
+        columns = list(self.measures.values())
+        grouped = df.groupby(KEY_COLUMNS, sort=False, dropna=False)[columns].sum()
+
+        # Every (year, month) is indexed at product, category and company level.
+        # Levels a lookup does not filter on are keyed by "" like in _filter_sales_df.
+        self.index: Dict[Tuple, SalesTotals] = {}
+        for levels in (KEY_COLUMNS, ["Year", "Month", "Category"], ["Year", "Month", "Product Name"], ["Year", "Month"]):
+            rolled = grouped.groupby(level=levels, sort=False).sum().reset_index()
+            keys = [
+                rolled[column].tolist() if column in levels else [""] * len(rolled)
+                for column in KEY_COLUMNS
+            ]
+            values = [rolled[column].tolist() for column in columns]
+            self.index.update(zip(zip(*keys), (SalesTotals(*row) for row in zip(*values))))
+
+    def lookup(self, year: int, month: int, category: str = "", product: str = "") -> SalesTotals:
+        return self.index.get((year, month, category, product), SalesTotals(0, 0, 0))
+
+
+def get_sales_cube(company: str) -> SalesCube:
+    columns = KEY_COLUMNS + list(SalesCube.measures.values())
+    # Sums are all the cube needs, so backends can aggregate before handing rows over
+    return load_derived(company, "sales_data", "sales_cube", SalesCube, columns, group_by=KEY_COLUMNS)
@@ -1,5 +1,6 @@
 import utils.retrievers as r
 from utils.models import DocumentSchema, Page, Tag
+from utils.openai_utils import LLM_FUSED_TAGS
 
 sales_report_schema = DocumentSchema(
     pages=[
@@ -132,94 +133,122 @@ sales_report_schema = DocumentSchema(
 )
 
 sales_report_retrievers = {
+    # Stage, not a tag: builds the LLM prompt inputs once before any LLM tag runs
+    "context_bundle": {
+        "retriever": (r._get_context_bundle, (lambda self: self.month, lambda self: self.year, lambda self: self.company)),
+        "multiple_values": False,
+        "sources": ["sales_data", "campaigns"]
+    },
+    # Stage, not a tag: one structured call per provider for every fused tag
+    "fused_sections": {
+        "retriever": (r._get_fused_sections, (lambda self: self.month, lambda self: self.year, lambda self: self.department, lambda self: self.company)),
+        "multiple_values": True,
+        "sources": ["sales_data", "campaigns", "examples"],
+        "example_tags": list(r.fused_tags),
+        "depends_on": ["context_bundle"]
+    },
     "executive_summary": {
         "retriever": (r._get_executive_summary, 
                       (lambda self: self.month, lambda self: self.year, lambda self: self.department, lambda self: self.company)),
-        "multiple_values": True
+        "multiple_values": True,
+        "sources": ["sales_data", "campaigns", "examples"],
+        "depends_on": ["context_bundle"]
     },
     "sales_revenue": {
         "retriever": (
             r._get_sales_revenue,
             (lambda self: self.month, lambda self: self.year, lambda self: self.company),
         ),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": ["sales_data"]
     },
     "sales_revenue_prevmo": {
         "retriever": (
             r._get_sales_revenue,
             (lambda self: self.month - 1, lambda self: self.year, lambda self: self.company),
         ),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": ["sales_data"]
     },
     "sales_revenue_ly": {
         "retriever": (
             r._get_sales_revenue,
             (lambda self: self.month, lambda self: self.year - 1, lambda self: self.company),
         ),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": ["sales_data"]
     },
     "sales_growth_mom": {
         "retriever": (
             r._get_sales_growth_mom,
             (lambda self: self.month, lambda self: self.year, lambda self: self.company),
         ),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": ["sales_data"]
     },
     "sales_growth_mom_prevmo": {
         "retriever": (
             r._get_sales_growth_mom,
             (lambda self: self.month - 1, lambda self: self.year, lambda self: self.company),
         ),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": ["sales_data"]
     },
     "sales_growth_mom_ly": {
         "retriever": (
             r._get_sales_growth_mom,
             (lambda self: self.month, lambda self: self.year - 1, lambda self: self.company),
         ),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": ["sales_data"]
     },
     "gross_margin": {
         "retriever": (
             r._get_gross_margin,
             (lambda self: self.month, lambda self: self.year, lambda self: self.company),
         ),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": ["sales_data"]
     },
     "gross_margin_prevmo": {
         "retriever": (
             r._get_gross_margin,
             (lambda self: self.month - 1, lambda self: self.year, lambda self: self.company),
         ),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": ["sales_data"]
     },
     "gross_margin_ly": {
         "retriever": (
             r._get_gross_margin,
             (lambda self: self.month, lambda self: self.year - 1, lambda self: self.company),
         ),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": ["sales_data"]
     },
     "sales_growth_yoy": {
         "retriever": (
             r._get_sales_growth_yoy,
             (lambda self: self.month, lambda self: self.year, lambda self: self.company),
         ),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": ["sales_data"]
     },
     "sales_growth_yoy_prevmo": {
         "retriever": (
             r._get_sales_growth_yoy,
             (lambda self: self.month - 1, lambda self: self.year, lambda self: self.company),
         ),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": ["sales_data"]
     },
     "sales_growth_yoy_ly": {
         "retriever": (
             r._get_sales_growth_yoy,
             (lambda self: self.month, lambda self: self.year - 1, lambda self: self.company),
         ),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": ["sales_data"]
     },
     "customer_retention": {
         "retriever": (
@@ -230,7 +259,8 @@ sales_report_retrievers = {
                 "Customer Retention Rate (%)",
             ),
         ),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": ["customer_metrics"]
     },
     "new_customers": {
         "retriever": (
@@ -241,56 +271,79 @@ sales_report_retrievers = {
                 "Customer Acquisition Rate (%)",
             ),
         ),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": ["customer_metrics"]
     },
     "fin_perf_bullets": {
         "retriever": (r._get_fin_perf_bullets, 
                       (lambda self: self.month, lambda self: self.year, lambda self: self.company)),
-        "multiple_values": True
+        "multiple_values": True,
+        "sources": ["sales_data", "examples"],
+        "depends_on": ["context_bundle"]
     },
     "product_sales": {
         "retriever": (
             r._get_product_sales_table,
             (lambda self: self.month, lambda self: self.year, lambda self: self.company),
         ),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": ["sales_data"]
     },
     "product_sales_bullets": {
         "retriever": (
             r._get_product_sales_bullets,
             (lambda self: self.month, lambda self: self.year, lambda self: self.company),
         ),
-        "multiple_values": True
+        "multiple_values": True,
+        "sources": ["sales_data", "campaigns", "examples"],
+        "depends_on": ["context_bundle"]
     },
     "category_sales_chart": {
         "retriever": (
             r._get_category_sales_chart,
             (lambda self: self.month, lambda self: self.year, lambda self: self.company),
         ),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": ["sales_data"]
     },
     "recommendations_intro": {
         "retriever": (r._get_recommendations_intro, (lambda self: self.month, lambda self: self.year, lambda self: self.department, lambda self: self.company)),
-        "multiple_values": True
+        "multiple_values": True,
+        "sources": ["sales_data", "campaigns", "examples"],
+        "depends_on": ["context_bundle"]
     },
     "recommendation_bullets": {
         "retriever": (r._get_recommendation_bullets, (lambda self: self.month, lambda self: self.year, lambda self: self.company)),
-        "multiple_values": True
+        "multiple_values": True,
+        "sources": ["sales_data", "campaigns", "examples"],
+        "depends_on": ["context_bundle"]
     },
     "month": {
         "retriever": (lambda self: self.month),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": []
     },
     "month_short": {
         "retriever": (lambda self: self.get_short_month()),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": []
     },
     "year": {
         "retriever": (lambda self: self.year),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": []
     },
     "department": {
         "retriever": (lambda self: self.department),
-        "multiple_values": False
+        "multiple_values": False,
+        "sources": []
     },
 }
+
+if LLM_FUSED_TAGS:
+    for tag_id in r.fused_tags:
+        sales_report_retrievers[tag_id].update(
+            retriever=(r._get_fused_tag, (tag_id, lambda self: self.month, lambda self: self.year, lambda self: self.department, lambda self: self.company)),
+            depends_on=["fused_sections"],
+            example_tags=list(r.fused_tags),
+        )
@@ -0,0 +1,177 @@
+import asyncio
+import fcntl
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+from decouple import Csv, config
+from utils.batch import BatchRunner, ReportTarget
+from utils.datasets import dataset_cache, load_derived
+from utils.models import DocumentSchema
+from utils.report_store import DATASETS
+from utils.examples import example_store
+
+CACHE_DIR = config("CACHE_DIR", default=".cache")
+# Pre-generates the latest reports in the background whenever their data changes
+PREGENERATE = config("PREGENERATE", default=False, cast=bool)
+# Seconds between checks of the data fingerprints
+PREGENERATE_INTERVAL = config("PREGENERATE_INTERVAL", default=300.0, cast=float)
+# Local hours in which runs may start, e.g. "1-5" or "22,23,0-4"; empty allows any hour
+PREGENERATE_HOURS = config("PREGENERATE_HOURS", default="", cast=Csv())
+# How many of the most recent months of each company are pre-generated
+PREGENERATE_PERIODS = config("PREGENERATE_PERIODS", default=1, cast=int)
+# Reports generated at once, kept low so interactive requests keep their LLM capacity
+PREGENERATE_MAX_REPORTS = config("PREGENERATE_MAX_REPORTS", default=2, cast=int)
+
+
+def parse_hours(spec: List[str]) -> set:
+    hours = set()
+    for part in spec:
+        start, _, end = part.partition("-")
+        start, end = int(start), int(end or start)
+        # Ranges may wrap past midnight, e.g. 22-4
+        hours.update(range(start, end + 1) if start <= end else [*range(start, 24), *range(0, end + 1)])
+    return hours
+
+
+def get_periods(df) -> List[Tuple[int, int]]:
+    periods = df[["Year", "Month"]].dropna().drop_duplicates().astype(int)
+    return sorted(map(tuple, periods.to_numpy().tolist()), reverse=True)
+
+
+class PregenerationScheduler:
+    """Generates the reports of every department for the latest periods in
+    the background, so /retrieval serves them from the report store.
+
+    Every PREGENERATE_INTERVAL seconds, the fingerprints of each company's
+    datasets and of the approved examples are compared with those of its last
+    run. Companies whose data changed are generated again through a
+    BatchRunner, in the PREGENERATE_HOURS window only. Tags whose inputs did
+    not change hit the report store and cost nothing. One worker process per
+    host runs the scheduler, the others find its lock taken.
+    """
+
+    def __init__(
+        self,
+        company_name_map: Dict[str, str],
+        retrieval_functions: dict,
+        document_schema: DocumentSchema,
+        interval: float = PREGENERATE_INTERVAL,
+        hours: Optional[List[str]] = None,
+        periods: int = PREGENERATE_PERIODS,
+        max_reports: int = PREGENERATE_MAX_REPORTS,
+        lock_path: str = os.path.join(CACHE_DIR, "pregenerate.lock"),
+    ):
+        self.company_name_map = company_name_map
+        self.retrieval_functions = retrieval_functions
+        self.document_schema = document_schema
+        self.interval = interval
+        self.hours = parse_hours(PREGENERATE_HOURS if hours is None else hours)
+        self.periods = periods
+        self.max_reports = max_reports
+        self.lock_path = lock_path
+        self.lock_file = None
+        self.task: Optional[asyncio.Task] = None
+        # Company -> fingerprints its reports were last generated from
+        self.generated: Dict[str, tuple] = {}
+
+    def acquire_lock(self) -> bool:
+        os.makedirs(os.path.dirname(self.lock_path) or ".", exist_ok=True)
+        self.lock_file = open(self.lock_path, "w")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            self.lock_file = None
+            return False
+        return True
+
+    def is_open(self, now: Optional[float] = None) -> bool:
+        return not self.hours or time.localtime(now).tm_hour in self.hours
+
+    def get_fingerprint(self, company: str) -> Optional[tuple]:
+        try:
+            datasets = tuple(dataset_cache.fingerprint(company, name) for name in DATASETS)
+        except OSError:
+            return None
+        return datasets + (example_store.get_version(),)
+
+    def get_latest_periods(self, company: str) -> List[Tuple[int, int]]:
+        periods = load_derived(company, "sales_data", "periods", get_periods, ["Year", "Month"])
+        return list(periods[:self.periods])
+
+    def get_targets(self) -> Tuple[List[ReportTarget], Dict[str, tuple]]:
+        targets, fingerprints = [], {}
+        for department, company in self.company_name_map.items():
+            fingerprint = fingerprints.get(company) or self.get_fingerprint(company)
+            if fingerprint is None or fingerprint == self.generated.get(company):
+                continue
+            fingerprints[company] = fingerprint
+            targets.extend(
+                ReportTarget(department=department, year=year, month=month)
+                for year, month in self.get_latest_periods(company)
+            )
+        return targets, fingerprints
+
+    async def run_once(self) -> int:
+        # Fingerprints are SQLite reads and the periods may parse a whole CSV
+        targets, fingerprints = await asyncio.to_thread(self.get_targets)
+        if not targets:
+            return 0
+
+        start = time.perf_counter()
+        print(f"Pre-generating {len(targets)} reports: {[target.model_dump() for target in targets]}")
+        runner = BatchRunner(
+            targets,
+            self.company_name_map,
+            self.retrieval_functions,
+            self.document_schema,
+            max_reports=self.max_reports,
+        )
+        failed = set()
+
+        async def emit(event, data):
+            if event == "report_error":
+                failed.add(self.company_name_map[targets[data["report"]].department])
+
+        await runner.run(emit)
+        # Tag failures are caught per tag, so a report with any tag left out of
+        # the report store, failed or missing providers, counts as failed too
+        for target, retriever in zip(targets, runner.retrievers):
+            if retriever.unstored_tags:
+                failed.add(self.company_name_map[target.department])
+        # Companies with a failed report are tried again at the next check
+        for company, fingerprint in fingerprints.items():
+            if company not in failed:
+                self.generated[company] = fingerprint
+        print(f"Pre-generated {len(targets)} reports in {time.perf_counter() - start:.1f}s, failed companies: {sorted(failed)}")
+        return len(targets)
+
+    async def run(self):
+        while True:
+            if self.is_open():
+                try:
+                    await self.run_once()
+                except Exception as e:
+                    print(f"Pre-generation failed: {e!r}")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> bool:
+        if self.task is not None:
+            return True
+        if not self.acquire_lock():
+            print("Pre-generation runs in another worker")
+            return False
+        self.task = asyncio.create_task(self.run())
+        return True
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
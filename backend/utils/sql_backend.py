@@ -0,0 +1,324 @@
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import pandas as pd
+from decouple import config
+from utils.datasets import DATA_DIR, DatasetCache, restore_csv_nulls
+from utils.metrics import record_csv_load, record_rows_scanned
+
+SQL_DATABASE_URL = config("SQL_DATABASE_URL", default=f"sqlite:///{os.path.join(config('CACHE_DIR', default='.cache'), 'datasets.db')}")
+SQL_MAX_CONNECTIONS = config("SQL_MAX_CONNECTIONS", default=8, cast=int)
+SQL_FINGERPRINT_TTL = config("SQL_FINGERPRINT_TTL", default=5.0, cast=float)
+
+# Position of each row in the source CSV, so results keep file order and the
+# same index as the CSV frames
+ROW_COLUMN = "__row"
+VERSIONS_TABLE = "dataset_versions"
+
+SQL_TYPES = {"integer": "BIGINT", "float": "DOUBLE PRECISION", "boolean": "BOOLEAN", "text": "TEXT"}
+PANDAS_TYPES = {"integer": "int64", "float": "float64", "boolean": "bool", "text": "object"}
+
+
+def get_column_type(series: pd.Series) -> str:
+    if pd.api.types.is_bool_dtype(series):
+        return "boolean"
+    if pd.api.types.is_integer_dtype(series):
+        return "integer"
+    if pd.api.types.is_float_dtype(series):
+        return "float"
+    return "text"
+
+
+def get_table_name(company: str, name: str) -> str:
+    return f"{company}_{name}"
+
+
+class ConnectionPool:
+    # Hands out up to max_connections connections, reusing idle ones. Callers
+    # wait for a free connection instead of opening more.
+    def __init__(self, connect: Callable[[], Any], max_connections: int = SQL_MAX_CONNECTIONS):
+        self.connect = connect
+        self.idle: List[Any] = []
+        self.semaphore = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    @contextmanager
+    def connection(self):
+        with self.semaphore:
+            with self.lock:
+                # Connections inherited by a forked process belong to the parent
+                if self.pid != os.getpid():
+                    self.idle, self.pid = [], os.getpid()
+                conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                conn = self.connect()
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                # A connection that cannot roll back is broken and not reused.
+                # Either way the caller gets the original error.
+                try:
+                    conn.rollback()
+                except Exception:
+                    conn.close()
+                else:
+                    with self.lock:
+                        self.idle.append(conn)
+                raise
+            with self.lock:
+                self.idle.append(conn)
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle.clear()
+
+
+class SqlDatabase:
+    def __init__(self, url: str = SQL_DATABASE_URL, max_connections: int = SQL_MAX_CONNECTIONS):
+        self.url = url
+        if url.startswith("sqlite:///"):
+            self.path = url[len("sqlite:///"):]
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.placeholder = "?"
+            self.pool = ConnectionPool(self.connect_sqlite, max_connections)
+        elif url.startswith(("postgres://", "postgresql://")):
+            self.placeholder = "%s"
+            self.pool = ConnectionPool(self.connect_postgres, max_connections)
+        else:
+            raise ValueError(f"Unsupported SQL_DATABASE_URL {url!r}, expected sqlite:/// or postgresql://")
+
+    def connect_sqlite(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def connect_postgres(self):
+        import psycopg2
+
+        return psycopg2.connect(self.url)
+
+    def quote(self, identifier: str) -> str:
+        quoted = '"' + identifier.replace('"', '""') + '"'
+        # psycopg2 reads % as the start of a parameter
+        return quoted.replace("%", "%%") if self.placeholder == "%s" else quoted
+
+    def query(self, sql: str, params: Tuple = ()) -> Tuple[List[str], List[tuple]]:
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(sql, params)
+                return [column[0] for column in cursor.description], cursor.fetchall()
+            finally:
+                cursor.close()
+
+
+class SqlDatasetCache(DatasetCache):
+    """Runs dataset queries against a database instead of reading CSVs.
+
+    Tables are loaded from the CSVs with load_csv, one per company and
+    dataset. Period and equality filters become WHERE clauses, and derived
+    structures that only need sums, like the sales cube, are built from a
+    GROUP BY, so the app receives grouped rows instead of whole tables.
+    Connections come from a bounded pool shared by all threads.
+    """
+
+    def __init__(self, database: Optional[SqlDatabase] = None, fingerprint_ttl: float = SQL_FINGERPRINT_TTL, **kwargs):
+        super().__init__(**kwargs)
+        self.database = database or SqlDatabase()
+        self.fingerprint_ttl = fingerprint_ttl
+        self.versions: Dict[str, Tuple[float, Tuple[int, int], Dict[str, str]]] = {}
+        self.derived_values: Dict[str, Tuple[Tuple[int, int], Dict[str, Any]]] = {}
+
+    def get_path(self, company: str, name: str) -> str:
+        return get_table_name(company, name)
+
+    def get_version(self, company: str, name: str) -> Tuple[Tuple[int, int], Dict[str, str]]:
+        # The version row changes with every load, and is re-read at most once per TTL
+        table = get_table_name(company, name)
+        cached = self.versions.get(table)
+        if cached is not None and time.monotonic() - cached[0] < self.fingerprint_ttl:
+            return cached[1], cached[2]
+        q = self.database.placeholder
+        try:
+            _, rows = self.database.query(
+                f"SELECT version, row_count, columns FROM {VERSIONS_TABLE} WHERE table_name = {q}", (table,)
+            )
+        except Exception as e:
+            raise FileNotFoundError(f"No table for {company} {name}: {e}") from e
+        if not rows:
+            raise FileNotFoundError(f"No table for {company} {name}")
+        version, row_count, columns = rows[0]
+        fingerprint, column_types = (int(version), int(row_count)), json.loads(columns)
+        self.versions[table] = (time.monotonic(), fingerprint, column_types)
+        return fingerprint, column_types
+
+    def fingerprint(self, company: str, name: str) -> Tuple[int, int]:
+        return self.get_version(company, name)[0]
+
+    def select(
+        self,
+        company: str,
+        name: str,
+        columns: Optional[List[str]] = None,
+        periods: Optional[List[Tuple[int, int]]] = None,
+        filters: Optional[Dict[str, Any]] = None,
+        group_by: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        _, column_types = self.get_version(company, name)
+        columns = columns if columns is not None else list(column_types)
+        quote, q = self.database.quote, self.database.placeholder
+
+        where, params = [], []
+        if periods is not None:
+            periods = list(dict.fromkeys(periods))
+            where.append("(" + (" OR ".join([f"({quote('Year')} = {q} AND {quote('Month')} = {q})"] * len(periods)) or "1 = 0") + ")")
+            params += [value for period in periods for value in period]
+        for column, value in (filters or {}).items():
+            where.append(f"{quote(column)} = {q}")
+            params.append(value)
+        where_sql = f" WHERE {' AND '.join(where)}" if where else ""
+        table = quote(get_table_name(company, name))
+
+        if group_by is not None:
+            # Sums are cast back to the column type, Postgres widens them to numeric
+            keys = ", ".join(quote(column) for column in group_by)
+            sums = [
+                f"CAST(SUM({quote(column)}) AS {SQL_TYPES[column_types[column]]})"
+                for column in columns if column not in group_by
+            ]
+            sql = f"SELECT {', '.join([keys] + sums)} FROM {table}{where_sql} GROUP BY {keys}"
+            selected = group_by + [column for column in columns if column not in group_by]
+        else:
+            selected = columns + [ROW_COLUMN]
+            sql = f"SELECT {', '.join(quote(column) for column in selected)} FROM {table}{where_sql} ORDER BY {quote(ROW_COLUMN)}"
+
+        _, rows = self.database.query(sql, tuple(params))
+        record_rows_scanned(len(rows))
+        df = pd.DataFrame.from_records(rows, columns=selected)
+        # Empty results carry no types, and SQLite returns booleans as integers
+        df = df.astype({
+            column: PANDAS_TYPES[column_types[column]]
+            for column in selected
+            if column in column_types and (df.empty or (column_types[column] == "boolean" and df[column].notna().all()))
+        })
+        df = restore_csv_nulls(df)
+        if group_by is not None:
+            return df
+        index = df.pop(ROW_COLUMN).astype("int64")
+        df.index = pd.RangeIndex(len(df)) if periods is None and filters is None else pd.Index(index.to_numpy())
+        return df
+
+    def read(self, company: str, name: str) -> pd.DataFrame:
+        return self.select(company, name)
+
+    def load(
+        self,
+        company: str,
+        name: str,
+        periods: Optional[List[Tuple[int, int]]] = None,
+        columns: Optional[List[str]] = None,
+        filters: Optional[Dict[str, Any]] = None,
+    ) -> pd.DataFrame:
+        if periods is None and columns is None and filters is None:
+            return super().load(company, name)
+        return self.select(company, name, columns, periods, filters)
+
+    def load_derived(
+        self,
+        company: str,
+        name: str,
+        key: str,
+        builder: Callable[[pd.DataFrame], Any],
+        columns: Optional[List[str]] = None,
+        group_by: Optional[List[str]] = None,
+    ) -> Any:
+        table = get_table_name(company, name)
+        fingerprint = self.fingerprint(company, name)
+        with self.lock:
+            cached = self.derived_values.get(table)
+            if cached is not None and cached[0] == fingerprint and key in cached[1]:
+                return cached[1][key]
+        value = builder(self.select(company, name, columns, group_by=group_by))
+        with self.lock:
+            cached = self.derived_values.get(table)
+            if cached is None or cached[0] != fingerprint:
+                cached = self.derived_values[table] = (fingerprint, {})
+            return cached[1].setdefault(key, value)
+
+    def clear(self):
+        super().clear()
+        with self.lock:
+            self.versions.clear()
+            self.derived_values.clear()
+
+
+def load_csv(database: SqlDatabase, company: str, name: str, path: str, batch_size: int = 10000):
+    # Replaces the table and its version row in one transaction, so readers
+    # see either the old or the new data
+    start = time.perf_counter()
+    df = pd.read_csv(path)
+    record_csv_load(name, time.perf_counter() - start)
+    column_types = {column: get_column_type(df[column]) for column in df.columns}
+    stat = os.stat(path)
+
+    quote, q = database.quote, database.placeholder
+    table = get_table_name(company, name)
+    columns = list(df.columns) + [ROW_COLUMN]
+    values = df.astype(object).where(df.notna(), None)
+    values[ROW_COLUMN] = range(len(df))
+    rows = [tuple(row) for row in values.itertuples(index=False)]
+    insert = f"INSERT INTO {quote(table)} ({', '.join(quote(c) for c in columns)}) VALUES ({', '.join([q] * len(columns))})"
+
+    with database.pool.connection() as conn:
+        cursor = conn.cursor()
+        if database.placeholder == "?":
+            # sqlite3 only opens transactions before DML and would commit the
+            # DROP and CREATE on their own, psycopg2 opens one before any statement
+            cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {VERSIONS_TABLE} "
+            "(table_name TEXT PRIMARY KEY, version BIGINT, row_count BIGINT, columns TEXT)"
+        )
+        cursor.execute(f"DROP TABLE IF EXISTS {quote(table)}")
+        definitions = [f"{quote(c)} {SQL_TYPES[t]}" for c, t in column_types.items()] + [f"{quote(ROW_COLUMN)} BIGINT"]
+        cursor.execute(f"CREATE TABLE {quote(table)} ({', '.join(definitions)})")
+        for i in range(0, len(rows), batch_size):
+            if database.placeholder == "%s":
+                from psycopg2.extras import execute_batch
+
+                execute_batch(cursor, insert, rows[i:i + batch_size], page_size=1000)
+            else:
+                cursor.executemany(insert, rows[i:i + batch_size])
+        if "Year" in column_types and "Month" in column_types:
+            cursor.execute(f"CREATE INDEX {quote(table + '_period')} ON {quote(table)} ({quote('Year')}, {quote('Month')})")
+        cursor.execute(f"DELETE FROM {VERSIONS_TABLE} WHERE table_name = {q}", (table,))
+        cursor.execute(
+            f"INSERT INTO {VERSIONS_TABLE} (table_name, version, row_count, columns) VALUES ({q}, {q}, {q}, {q})",
+            (table, stat.st_mtime_ns, len(df), json.dumps(column_types)),
+        )
+        cursor.close()
+    print(f"Loaded {path} into {table} ({len(df)} rows) in {time.perf_counter() - start:.2f}s")
+
+
+def load_data_dir(database: SqlDatabase, data_dir: str = DATA_DIR):
+    for path in sorted(glob.glob(os.path.join(data_dir, "*_*.csv"))):
+        company, name = os.path.basename(path)[:-len(".csv")].split("_", 1)
+        load_csv(database, company, name, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the dataset CSVs into the SQL data backend")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--url", default=SQL_DATABASE_URL)
+    args = parser.parse_args()
+    load_data_dir(SqlDatabase(args.url), args.data_dir)
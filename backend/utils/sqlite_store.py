@@ -0,0 +1,45 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import List
+
+
+class SQLiteStore:
+    # Calls wait up to the busy timeout while another process holds the write
+    # lock, so async code makes them through asyncio.to_thread
+    # Statements run once per process before first use, e.g. CREATE TABLE IF NOT EXISTS
+    schema: List[str] = []
+
+    def __init__(self, path: str):
+        self.path = path
+        self.initialized = False
+        self.init_lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        # One short-lived connection per operation keeps this safe across the
+        # threads and worker processes that share the file
+        if not self.initialized:
+            self.initialize()
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def initialize(self):
+        with self.init_lock:
+            if self.initialized:
+                return
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            try:
+                with conn:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    for statement in self.schema:
+                        conn.execute(statement)
+            finally:
+                conn.close()
+            self.initialized = True
@@ -28,6 +28,7 @@ const App: React.FC = () => {
   const [totalPages, setTotalPages] = useState(0);
   const [pdfRenderProgress, setPdfRenderProgress] = useState(0);
   const [shouldGeneratePdf, setShouldGeneratePdf] = useState(false);
+  const [streamingTexts, setStreamingTexts] = useState<Record<string, Record<string, string>>>({});
 
 
   const defaultPage: Page = { pageNumber: 0, tags: [] };
@@ -75,6 +76,7 @@ const App: React.FC = () => {
     setTotalPages(0);
     setPdfRenderProgress(0);
     setShouldGeneratePdf(false);
+    setStreamingTexts({});
 
 
     const [year, month] = selectedDate.split('/').map(part => part.trim());
@@ -102,6 +104,17 @@ const App: React.FC = () => {
       }
     });
   
+    eventSource.addEventListener('delta', (event) => {
+      const data = JSON.parse(event.data);
+      setStreamingTexts(prev => ({
+        ...prev,
+        [data.tagId]: {
+          ...prev[data.tagId],
+          [data.provider]: (prev[data.tagId]?.[data.provider] || '') + data.text
+        }
+      }));
+    });
+
     eventSource.addEventListener('done', (event) => {
       const data = JSON.parse(event.data) as DocumentContents;
       console.log("EventSource done:", data);
@@ -121,10 +134,23 @@ const App: React.FC = () => {
       eventSource.close();
     });
   
-    eventSource.onerror = (error) => {
-      console.error('EventSource failed:', error);
-      setIsLoading(false);
-      eventSource.close();
+    // Gets both the job's "error" event, which carries data, and connection
+    // errors, after which the browser reconnects with the id of the last event
+    // it got and the backend resumes the same job
+    eventSource.onerror = (event) => {
+      if (event instanceof MessageEvent) {
+        const data = JSON.parse(event.data);
+        console.error('Report generation failed:', data.error);
+        setIsLoading(false);
+        eventSource.close();
+        alert(`Report generation failed: ${data.error}`);
+      } else if (eventSource.readyState === EventSource.CLOSED) {
+        console.error('EventSource failed:', event);
+        setIsLoading(false);
+        alert('Lost the connection to the server. Please try again.');
+      } else {
+        console.warn('EventSource connection lost, reconnecting:', event);
+      }
     };
   };
 
@@ -179,6 +205,7 @@ const App: React.FC = () => {
           progress={progress}
           totalPages={totalPages}
           pdfRenderProgress={pdfRenderProgress}
+          streamingTexts={streamingTexts}
         />
         {isLoading || isGeneratingPdf ? (
         <PdfPlaceholder message="Loading PDF preview..." />
@@ -17,6 +17,7 @@ interface VariationsPanelProps {
     progress: { [page: number]: number };
     totalPages: number;
     pdfRenderProgress: number;
+    streamingTexts: Record<string, Record<string, string>>;
   }
   
   const VariationsPanel: React.FC<VariationsPanelProps> = ({
@@ -29,7 +30,8 @@ interface VariationsPanelProps {
     variationsGenerated,
     progress,
     totalPages,
-    pdfRenderProgress
+    pdfRenderProgress,
+    streamingTexts
   }) => {
     const [carouselIndex, setCarouselIndex] = useState<Record<string, number>>({});
 
@@ -86,6 +88,28 @@ interface VariationsPanelProps {
 
     const llmModels = ['GPT-4o', 'Claude-3.5-Sonnet', 'Llama3.1-70B'];
     const modelColors = ['#FF6B6B', '#4ECDC4', '#3b82f6'];
+    const providerIds = ['gpt', 'claude', 'llama'];
+
+    const renderStreamingTexts = () => (
+      <div className="variations-content">
+        {Object.entries(streamingTexts).map(([tagId, texts]) => (
+          <div key={tagId} className="variation-section">
+            <h3 className="variation-title">{tagId}</h3>
+            <div className="variations-container">
+              {Object.entries(texts).map(([provider, text]) => (
+                <div
+                  key={provider}
+                  className="variation-box"
+                  style={{ borderColor: modelColors[providerIds.indexOf(provider)] }}
+                >
+                  {renderVariationText(text)}
+                </div>
+              ))}
+            </div>
+          </div>
+        ))}
+      </div>
+    );
   
     const renderLegend = () => (
       <div className="variations-legend">
@@ -174,6 +198,7 @@ interface VariationsPanelProps {
             <h2>Generating Variations</h2>
             <LoadingSpinner />
             {renderProgressBars()}
+            {isLoading && renderStreamingTexts()}
           </div>
     )}
       {variationsGenerated && !isLoading && (
@@ -1,6 +1,6 @@
-import { useState, useCallback, useEffect } from 'react';
+import { useState, useCallback, useEffect, useRef } from 'react';
 import { DocumentContents } from '../models/CustomDocument';
-import { renderAllCombinations, generatePdfKey } from '../utils/pdfUtils';
+import { renderPageOnServer, generatePdfKey } from '../utils/pdfUtils';
 
 const usePdfGeneration = (
   contents: DocumentContents,
@@ -12,28 +12,39 @@ const usePdfGeneration = (
   const [isLoading, setIsLoading] = useState(false);
   const [variationsGenerated, setVariationsGenerated] = useState(false);
   const [iframeSrc, setIframeSrc] = useState('');
+  const pendingKeys = useRef<Set<string>>(new Set());
 
+  // Pages are rendered on view by the backend instead of every combination up front
   const generatePdfVariations = useCallback(async () => {
     console.log('Generating variations');
-    setIsLoading(true);
-    setVariationsGenerated(false);
+    pendingKeys.current.clear();
     setPdfBlobs({}); // Clear existing blobs
-    
-    try {
-      const allPdfBlobs = await renderAllCombinations(contents, (progress) => {
-        console.log('PDF render progress:', progress);
-        setPdfRenderProgress(progress);
-      });
-      setPdfBlobs(allPdfBlobs);
-      setVariationsGenerated(true);
-    } catch (error) {
-      console.error('Error generating variations:', error);
-    } finally {
-      setIsLoading(false);
-      setPdfRenderProgress(100); // Ensure it reaches 100% at the end
+    setVariationsGenerated(true);
+  }, []);
+
+  useEffect(() => {
+    if (!variationsGenerated || contents.pages.length === 0) {
+      return;
     }
-  }, [contents, setPdfRenderProgress]);
-  
+    const pageNumber = currentPage + 1;
+    const key = generatePdfKey(pageNumber, selectedVariations, contents);
+    if (pdfBlobs[key] || pendingKeys.current.has(key)) {
+      return;
+    }
+
+    pendingKeys.current.add(key);
+    setIsLoading(true);
+    setPdfRenderProgress(0);
+    renderPageOnServer(contents, pageNumber, selectedVariations)
+      .then(blob => setPdfBlobs(prev => ({ ...prev, [key]: blob })))
+      .catch(error => console.error('Error rendering page:', error))
+      .finally(() => {
+        pendingKeys.current.delete(key);
+        setIsLoading(pendingKeys.current.size > 0);
+        setPdfRenderProgress(100);
+      });
+  }, [variationsGenerated, currentPage, selectedVariations, contents, pdfBlobs, setPdfRenderProgress]);
+
 
   const getCurrentPdfBlob = useCallback(() => {
     const key = generatePdfKey(currentPage + 1, selectedVariations, contents);
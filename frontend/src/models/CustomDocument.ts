@@ -1,6 +1,7 @@
 interface Variation {
     id: number;
     text: string;
+    provider?: string;
 }
 
 interface Tag {
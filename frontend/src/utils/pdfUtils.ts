@@ -84,4 +84,29 @@ export const generatePdfKey = (
   });
 
   return `page${pageNumber}_${pageVariations.join('_')}`;
-};
\ No newline at end of file
+};
+
+export async function renderPageOnServer(
+  contents: DocumentContents,
+  pageNumber: number,
+  selectedVariations: Record<string, number>,
+  prefetch: boolean = true
+): Promise<Blob> {
+  const page = contents.pages.find(page => page.pageNumber === pageNumber);
+  if (!page) {
+    throw new Error(`Page ${pageNumber} not found in the document`);
+  }
+
+  // The backend renders and caches one selection at a time, and with prefetch
+  // also renders the selections one variation switch away
+  const response = await fetch('http://localhost:8000/render', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ page, selectedVariations, format: 'pdf', prefetch }),
+  });
+
+  if (!response.ok) {
+    throw new Error(`HTTP error! status: ${response.status}`);
+  }
+  return await response.blob();
+}